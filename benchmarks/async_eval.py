@@ -0,0 +1,57 @@
+'''
+    Training wall-clock with latent-sample evaluations run in the training process vs in a background worker.
+
+    python -m benchmarks.async_eval
+'''
+import time
+import tempfile
+import torch
+from transformers import default_data_collator
+
+from benchmarks.utils import benchmark_model, IdTokenizer
+from transformer_vae.sinks import RecordingSink
+from transformer_vae.train import VAE_TrainingArguments
+from transformer_vae.trainer import VAE_Trainer
+
+
+def main():
+    batch_size, seq_len, n_steps, eval_steps = 8, 60, 30, 10
+    dataset = [{"input_ids": ids, "labels": ids} for ids in torch.randint(1, 1000, (16, seq_len)).tolist()]
+    batch = default_data_collator(dataset[:batch_size])
+    print(f'{n_steps} training steps, evaluating every {eval_steps}')
+    print(f'{"mode":>6} {"train s":>8} {"eval blocking s":>16} {"worker eval s":>14}')
+    for async_latent_eval in [False, True]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            args = VAE_TrainingArguments(
+                output_dir=tmp_dir, no_cuda=not torch.cuda.is_available(), report_to=[], sample_from_latent=True,
+                generate_max_len=seq_len, per_device_eval_batch_size=batch_size, async_latent_eval=async_latent_eval,
+            )
+            model = benchmark_model(seq_len)
+            trainer = VAE_Trainer(
+                model, args, metrics_sink=RecordingSink(), eval_dataset=dataset, tokenizer=IdTokenizer(),
+                data_collator=default_data_collator,
+            )
+            optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+            model.global_step = 0
+            eval_seconds = 0
+            start = time.perf_counter()
+            for step in range(1, n_steps + 1):
+                trainer.state.global_step = step
+                trainer.training_step(model, dict(batch))
+                optimizer.step()
+                optimizer.zero_grad()
+                if step % eval_steps == 0:
+                    eval_start = time.perf_counter()
+                    trainer.evaluate()
+                    eval_seconds += time.perf_counter() - eval_start
+            train_seconds = time.perf_counter() - start
+            trainer.finish_async_evals()
+            worker_seconds = sum(
+                record[1].get("eval_async_latent_samples_time", 0) for record in trainer.metrics_sink.records if record[0] == "log"
+            )
+        mode = "async" if async_latent_eval else "sync"
+        print(f'{mode:>6} {train_seconds:>8.1f} {eval_seconds:>16.1f} {worker_seconds:>14.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+'''
+    Compare the stock T5 attention with the `sdpa` attention backend, with & without the window presets.
+
+    python -m benchmarks.attention
+'''
+import torch
+
+from benchmarks.utils import time_fn, peak_memory, benchmark_model
+
+
+# (name, set_seq_size, attention_window_size)
+PRESETS = [
+    ("full 90", 90, 0),
+    ("window60", 90, 60),
+    ("full 250", 250, 0),
+    ("window200", 250, 200),
+]
+
+
+def main():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch_size = 8
+    print(f'{"preset":>10} {"backend":>8} {"fwd ms":>8} {"fwd+bwd ms":>11} {"peak MB":>8} {"max diff":>9}')
+    for name, seq_size, window_size in PRESETS:
+        input_ids = torch.randint(1, 1000, (batch_size, seq_size), device=device)
+        expected = None
+        for backend in ["", "sdpa"]:
+            model = benchmark_model(seq_size, attention_window_size=window_size, attention_backend=backend).to(device)
+            model.config.use_extra_logs = False
+
+            def forward():
+                with torch.no_grad():
+                    return model(input_ids=input_ids, labels=input_ids).logits
+
+            def train_step():
+                model(input_ids=input_ids, labels=input_ids).loss.backward()
+
+            model.eval()
+            logits = forward()
+            expected = logits if expected is None else expected
+            max_diff = (logits - expected).abs().max().item()
+            forward_ms = time_fn(forward, 5) * 1000
+            model.train()
+            train_ms = time_fn(train_step, 3) * 1000
+            memory = peak_memory(train_step) / 2 ** 20
+            print(f'{name:>10} {backend or "t5":>8} {forward_ms:>8.1f} {train_ms:>11.1f} {memory:>8.1f} {max_diff:>9.1e}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+'''
+    Training step, evaluation & generation throughput with bf16 autocast vs fp32 on CPU, plus loss parity.
+
+    python -m benchmarks.bf16
+'''
+import torch
+
+from benchmarks.utils import time_fn, benchmark_model
+from transformer_vae.utils import autocast_bf16
+
+
+def main():
+    batch_size, seq_len, n_tokens = 16, 60, 30
+    model = benchmark_model(seq_len).train()
+    model.global_step = 10_000
+    batches = [torch.randint(1, 1000, (batch_size, seq_len)) for _ in range(5)]
+    input_ids = batches[0]
+    start_ids = torch.zeros((batch_size, 1), dtype=torch.long)
+    with torch.no_grad():
+        latent = model(input_ids=input_ids).latent
+
+    def train_step():
+        model.zero_grad()
+        with autocast_bf16("cpu", enabled=bf16):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+
+    def evaluate():
+        with torch.no_grad(), autocast_bf16("cpu", enabled=bf16):
+            model(input_ids=input_ids, labels=input_ids)
+
+    def generate():
+        with torch.no_grad(), autocast_bf16("cpu", enabled=bf16):
+            model.generate(input_ids=start_ids, latent=latent, bos_token_id=0, min_length=n_tokens, max_length=n_tokens)
+
+    print(f'{"":>24} {"fp32":>10} {"bf16":>10} {"speedup":>8}')
+    for name, fn, n_items in [
+        ("train (tokens/sec)", train_step, batch_size * seq_len),
+        ("eval (tokens/sec)", evaluate, batch_size * seq_len),
+        ("generate (tokens/sec)", generate, batch_size * n_tokens),
+    ]:
+        throughput = []
+        for bf16 in [False, True]:
+            model.train(fn is train_step)
+            throughput.append(n_items / time_fn(fn, 3))
+        print(f'{name:>24} {throughput[0]:>10.0f} {throughput[1]:>10.0f} {throughput[1] / throughput[0]:>7.2f}x')
+
+    model.eval()
+    print(f'\n{"batch":>6} {"fp32 loss":>10} {"bf16 loss":>10} {"fp32 reg":>10} {"bf16 reg":>10}')
+    for i, batch in enumerate(batches):
+        results = []
+        for bf16 in [False, True]:
+            torch.manual_seed(i)
+            with torch.no_grad(), autocast_bf16("cpu", enabled=bf16):
+                outputs = model(input_ids=batch, labels=batch)
+            results.append(outputs)
+        print(
+            f'{i:>6} {results[0].decoder_ce.item():>10.4f} {results[1].decoder_ce.item():>10.4f} '
+            f'{results[0].reg_loss.item():>10.4f} {results[1].reg_loss.item():>10.4f}'
+        )
+
+
+if __name__ == "__main__":
+    main()
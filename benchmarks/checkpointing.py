@@ -0,0 +1,70 @@
+'''
+    Training step time & activation memory checkpointing with the old knobs vs the memory budget policy.
+
+    Saved MB is the memory kept for the backward pass after the forward pass (peak CUDA memory on GPU).
+
+    python -m benchmarks.checkpointing
+'''
+import torch
+
+from benchmarks.utils import time_fn, peak_memory, benchmark_model
+from transformer_vae.checkpoint_policy import (
+    apply_checkpoint_plan, choose_checkpointed_units, profile_checkpoint_units, _storage, MB
+)
+
+
+def saved_activation_bytes(model, inputs):
+    '''
+        Bytes saved for the backward pass by a training forward pass, excluding parameters.
+    '''
+    parameter_storage = set(_storage(param)[0] for param in model.parameters())
+    saved = {}
+
+    def pack_hook(tensor):
+        ptr, nbytes = _storage(tensor)
+        if ptr not in parameter_storage:
+            saved[ptr] = nbytes
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        model(**inputs)
+    return sum(saved.values())
+
+
+def main():
+    seq_len, batch_size = 200, 8
+    model = benchmark_model(seq_len, num_layers=6).train()
+    model.global_step = 0
+    if torch.cuda.is_available():
+        model = model.cuda()
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len), device=model.device)
+    inputs = {"input_ids": input_ids, "labels": input_ids}
+
+    def step():
+        model.zero_grad()
+        model(**inputs).loss.backward()
+
+    units, forward_seconds = profile_checkpoint_units(model, inputs)
+    activation_mb = sum(unit.activation_bytes for unit in units) / MB
+    print(f'layer activations {activation_mb:.1f}MB, forward {forward_seconds * 1000:.1f}ms')
+    print(f'{"mode":>26} {"layers":>7} {"est. MB":>8} {"saved MB":>9} {"ms/step":>8}')
+
+    modes = [("none", None, 1.0, True), ("decoder rate 3", 3, 1.0, True)]
+    for fraction in [0.75, 0.5, 0.25]:
+        modes.append((f"budget {fraction:.0%}", None, fraction, True))
+        modes.append((f"budget {fraction:.0%} non-reentrant", None, fraction, False))
+    for name, rate, fraction, use_reentrant in modes:
+        plan = choose_checkpointed_units(units, forward_seconds, activation_mb * fraction)
+        apply_checkpoint_plan(model, plan.checkpointed, use_reentrant)
+        model.config.decoder_grad_chk_pnt_rate = rate or 0
+        if rate is None:
+            layers, estimate = len(plan.checkpointed), f'{plan.peak_activation_bytes / MB:.1f}'
+        else:
+            layers, estimate = len([i for i in range(len(model.decoder.block)) if i % rate]), '-'
+        saved = peak_memory(step) if torch.cuda.is_available() else saved_activation_bytes(model, inputs)
+        seconds = time_fn(step, 3)
+        print(f'{name:>26} {layers:>7} {estimate:>8} {saved / MB:>9.1f} {seconds * 1000:>8.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+'''
+    Data collator throughput finding special tokens per row, vectorised & from a precomputed mask.
+
+    python -m benchmarks.collator
+'''
+import torch
+from transformers import GPT2TokenizerFast
+
+from benchmarks.utils import time_fn
+from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
+
+
+class PerRowCollator(DataCollatorForLanguageAutoencoding):
+    '''
+        The old per-row special tokens mask.
+    '''
+    def _special_tokens_mask(self, inputs):
+        return torch.tensor(
+            [self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in inputs.tolist()],
+            dtype=torch.bool,
+        )
+
+
+def main():
+    tokenizer = GPT2TokenizerFast.from_pretrained("tokenizers/tkn_python-lines_byte")
+    tokenizer.pad_token, tokenizer.eos_token, tokenizer.mask_token = "<pad>", "</s>", "</s>"
+    seq_len = 60
+    tokenizer.model_max_length = seq_len
+    print(f'{"batch":>6} {"mode":>12} {"ms/batch":>10} {"rows/sec":>10}')
+    for batch_size in [32, 256, 1024]:
+        texts = [f"x_{i} = foo({i}, 'bar') + {i * 7}" for i in range(batch_size)]
+        rows = tokenizer(texts, padding="max_length", truncation=True)["input_ids"]
+        rows_with_mask = tokenizer(texts, padding="max_length", truncation=True, return_special_tokens_mask=True)
+        rows_with_mask = [
+            {"input_ids": ids, "special_tokens_mask": mask}
+            for ids, mask in zip(rows_with_mask["input_ids"], rows_with_mask["special_tokens_mask"])
+        ]
+        modes = [
+            ("per row", PerRowCollator(tokenizer, mlm_probability=0.15), [{"input_ids": ids} for ids in rows]),
+            ("isin", DataCollatorForLanguageAutoencoding(tokenizer, mlm_probability=0.15), [{"input_ids": ids} for ids in rows]),
+            ("precomputed", DataCollatorForLanguageAutoencoding(tokenizer, mlm_probability=0.15), rows_with_mask),
+            ("no masking", DataCollatorForLanguageAutoencoding(tokenizer, mlm_probability=0.0), [{"input_ids": ids} for ids in rows]),
+        ]
+        for name, collator, examples in modes:
+            seconds = time_fn(lambda: collator(examples), 5)
+            print(f'{batch_size:>6} {name:>12} {seconds * 1000:>10.2f} {batch_size / seconds:>10.0f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+'''
+    Training step & generation throughput with `torch.compile` vs eager on CPU, plus the graph breaks left in the forward.
+
+    python -m benchmarks.compile
+'''
+import time
+import torch
+import torch._dynamo
+
+from benchmarks.utils import time_fn, benchmark_model
+
+
+def main():
+    batch_size, seq_len, n_tokens = 16, 60, 30
+    model = benchmark_model(seq_len).train()
+    model.global_step = 10_000
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len))
+    start_ids = torch.zeros((batch_size, 1), dtype=torch.long)
+    with torch.no_grad():
+        latent = model(input_ids=input_ids).latent
+
+    explanation = torch._dynamo.explain(lambda: model(input_ids=input_ids, labels=input_ids).loss)()
+    print(f'training forward: {explanation.graph_count} graphs, {explanation.graph_break_count} graph breaks')
+    for reason in explanation.break_reasons:
+        print(f'  {reason.reason}')
+    torch._dynamo.reset()
+
+    # generation compiles a graph per decoded length
+    torch._dynamo.config.cache_size_limit = 64
+    eager_forward = model.forward
+
+    def train_step():
+        model.zero_grad()
+        model(input_ids=input_ids, labels=input_ids).loss.backward()
+
+    def generate():
+        with torch.no_grad():
+            model.generate(input_ids=start_ids, latent=latent, bos_token_id=0, min_length=n_tokens, max_length=n_tokens)
+
+    print(f'\n{"":>24} {"eager":>10} {"compiled":>10} {"speedup":>8} {"compile s":>10}')
+    for name, fn, n_items in [
+        ("train (tokens/sec)", train_step, batch_size * seq_len),
+        ("generate (tokens/sec)", generate, batch_size * n_tokens),
+    ]:
+        model.train(fn is train_step)
+        model.forward = eager_forward
+        eager = n_items / time_fn(fn, 3)
+        torch._dynamo.reset()
+        model.forward = torch.compile(eager_forward)
+        start = time.perf_counter()
+        fn()
+        compile_seconds = time.perf_counter() - start
+        compiled = n_items / time_fn(fn, 3)
+        print(f'{name:>24} {eager:>10.0f} {compiled:>10.0f} {compiled / eager:>7.2f}x {compile_seconds:>10.1f}')
+    model.forward = eager_forward
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+'''
+    Time of the critic updates with real & interpolated samples in separate critic calls vs one batched call.
+    Also the critic's share of the training step with smaller & bf16 critics.
+
+    python -m benchmarks.critic
+'''
+import tempfile
+import torch
+from torch import autograd
+from transformers import FunnelConfig
+
+from benchmarks.utils import time_fn, benchmark_model, IdTokenizer
+from transformer_vae.sinks import RecordingSink
+from transformer_vae.train import VAE_TrainingArguments
+from transformer_vae.trainer import VAE_Trainer
+
+
+def critic_config(d_model=256):
+    return FunnelConfig(
+        vocab_size=1000, block_sizes=[2, 2, 2], d_model=d_model, n_head=4, d_head=d_model // 4, d_inner=d_model * 4
+    ).to_dict()
+
+
+def separate_critic_calls(real, interpolated, ratios, critic):
+    '''
+        The critic updates before batching, 3 critic calls.
+    '''
+    n_samples = interpolated.size(0)
+    critic_loss_on_model = critic(interpolated).mean() / n_samples
+    interpolated.backward(autograd.grad(critic_loss_on_model, interpolated, retain_graph=True), retain_graph=True)
+    critic_loss = critic(real, torch.zeros(n_samples, 1, device=real.device)) + critic(interpolated.detach(), ratios.view(-1, 1))
+    (critic_loss / (2 * n_samples)).backward()
+
+
+def make_trainer(tmp_dir, batch_size, seq_len, critic_num_layers=0, **kwargs):
+    args = VAE_TrainingArguments(
+        output_dir=tmp_dir, no_cuda=not torch.cuda.is_available(), report_to=[], per_device_train_batch_size=batch_size,
+        min_critic_steps=0, interpolation_decoding="nearest", **kwargs
+    )
+    model = benchmark_model(seq_len, critic_name="benchmark", critic=critic_config(), critic_num_layers=critic_num_layers).train()
+    return VAE_Trainer(model, args, metrics_sink=RecordingSink(), tokenizer=IdTokenizer())
+
+
+def main():
+    batch_size, seq_len, d_model = 8, 60, 256
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trainer = make_trainer(tmp_dir, batch_size, seq_len)
+    model = trainer.model
+    trainer.state.global_step = 1
+    device = model.device
+    decoder = torch.nn.Linear(d_model, d_model).to(device)
+    real, inputs = torch.randn(batch_size, seq_len, d_model, device=device), torch.randn(batch_size, seq_len, d_model, device=device)
+    ratios = torch.rand(batch_size, device=device) / 2
+
+    def separate():
+        separate_critic_calls(real, decoder(inputs), ratios, model.critic)
+        model.zero_grad()
+
+    def batched():
+        trainer._critic_step(real, decoder(inputs), ratios, model)
+        model.zero_grad()
+
+    print(f'{batch_size} real & {batch_size} interpolated samples, {seq_len} tokens, 6 layer critic')
+    separate_ms, batched_ms = time_fn(separate, 5) * 1000, time_fn(batched, 5) * 1000
+    print(f'critic update ms: separate calls {separate_ms:.0f}, batched {batched_ms:.0f} ({separate_ms / batched_ms:.2f}x)')
+
+    print(f'\n{"critic":>18} {"step ms":>8} {"critic share":>13}')
+    n_steps = 5
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len))
+    for name, critic_num_layers, critic_bf16 in [("6 layers", 0, False), ("6 layers bf16", 0, True), ("2 layers", 2, False)]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = make_trainer(tmp_dir, batch_size, seq_len, critic_num_layers, critic_bf16=critic_bf16)
+            trainer.state.global_step = trainer.model.global_step = 1
+
+            def step():
+                trainer.training_step(trainer.model, {"input_ids": input_ids, "labels": input_ids})
+                trainer.model.zero_grad()
+
+            step()
+            trainer.log({"loss": 0.0})
+            step_ms = time_fn(step, n_steps) * 1000
+            trainer.state.global_step += n_steps + 1
+            trainer.log({"loss": 0.0})
+        share = [record[1] for record in trainer.metrics_sink.records if record[0] == "log"][-1]["train_critic_time_share"]
+        print(f'{name:>18} {step_ms:>8.0f} {share:>12.0%}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+'''
+    Per-token decoding latency from latent codes with & without the decoder caches.
+
+    python -m benchmarks.decoding
+'''
+import torch
+
+from benchmarks.utils import time_fn, benchmark_model
+from transformer_vae.custom_t5 import set_cross_attention_cache
+
+
+def main():
+    batch_size, n_tokens = 16, 30
+    model = benchmark_model(set_seq_size=60).eval()
+    with torch.no_grad():
+        latent = model(input_ids=torch.randint(1, 1000, (batch_size, 60))).latent
+        start_ids = torch.zeros((batch_size, 1), dtype=torch.long)
+        decoder_input_ids = torch.randint(1, 1000, (batch_size, n_tokens))
+
+        def generate(use_cache):
+            return lambda: model.generate(
+                input_ids=start_ids, latent=latent, bos_token_id=0, min_length=n_tokens, max_length=n_tokens,
+                use_cache=use_cache
+            )
+
+        def sweep():
+            # decoding the same latents repeatedly, as done for interpolations
+            for _ in range(5):
+                if not caching:
+                    model.clear_decoding_caches()
+                model(decoder_input_ids=decoder_input_ids, latent=latent)
+
+        caching = False
+        print(f'{"":>32} {"no cache":>12} {"cache":>12}')
+        for name, fn, n in [
+            ('generate, no past (ms/token)', generate(False), n_tokens),
+            ('generate, past (ms/token)', generate(True), n_tokens),
+            ('5x teacher forced (ms/token)', sweep, 5 * n_tokens),
+        ]:
+            timings = []
+            for caching in [False, True]:
+                set_cross_attention_cache(model.decoder, caching)
+                model.clear_decoding_caches()
+                timings.append(time_fn(fn, 3) * 1000 / n)
+            print(f'{name:>32} {timings[0]:>12.3f} {timings[1]:>12.3f}')
+
+
+if __name__ == "__main__":
+    main()
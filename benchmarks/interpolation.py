@@ -0,0 +1,46 @@
+'''
+    Time per interpolation point when interpolating one pair of samples at a time vs batched interpolations.
+
+    python -m benchmarks.interpolation
+'''
+import time
+import torch
+
+from benchmarks.utils import benchmark_model, IdTokenizer
+from transformer_vae.interpolation import interpolation_ratios, batched_interpolations
+
+
+def main():
+    n_pairs, seq_len, n_tokens = 32, 60, 30
+    model = benchmark_model(seq_len).eval()
+    tokenizer = IdTokenizer()
+    input_ids = torch.randint(1, 1000, (2 * n_pairs, seq_len))
+    ratios = interpolation_ratios()
+
+    def decode(latent):
+        start_ids = torch.zeros((latent.size(0), 1), dtype=torch.long)
+        tokens = model.generate(input_ids=start_ids, latent=latent, bos_token_id=0, min_length=n_tokens, max_length=n_tokens)
+        return tokenizer.batch_decode(tokens)
+
+    def run(pairs_per_call, batch_size):
+        with torch.no_grad():
+            for i in range(0, 2 * n_pairs, 2 * pairs_per_call):
+                batched_interpolations(model, {"input_ids": input_ids[i:i + 2 * pairs_per_call]}, ratios, decode, batch_size)
+
+    n_points = n_pairs * ratios.size(0)
+    print(f'{n_pairs} pairs x {ratios.size(0)} ratios, {n_tokens} tokens per point')
+    print(f'{"mode":>24} {"ms/point":>9}')
+    run(1, 11)  # warmup
+    for name, pairs_per_call, batch_size in [
+        ("1 pair per call", 1, 11),
+        ("batched, generate 64", n_pairs, 64),
+        ("batched, generate 128", n_pairs, 128),
+        ("batched, generate 352", n_pairs, 352),
+    ]:
+        start = time.perf_counter()
+        run(pairs_per_call, batch_size)
+        print(f'{name:>24} {(time.perf_counter() - start) / n_points * 1000:>9.2f}')
+
+
+if __name__ == "__main__":
+    main()
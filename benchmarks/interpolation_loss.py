@@ -0,0 +1,56 @@
+'''
+    Training step time with the `critic` & `cycle_loss` interpolation losses for each `interpolation_decoding`.
+
+    python -m benchmarks.interpolation_loss
+'''
+import tempfile
+import torch
+from transformers import FunnelConfig
+
+from benchmarks.utils import time_fn, benchmark_model, IdTokenizer
+from transformer_vae.interpolation import INTERPOLATION_DECODING
+from transformer_vae.sinks import RecordingSink
+from transformer_vae.train import VAE_TrainingArguments
+from transformer_vae.trainer import VAE_Trainer
+
+
+def critic_config(d_model=256):
+    return FunnelConfig(
+        vocab_size=1000, block_sizes=[1, 1], d_model=d_model, n_head=4, d_head=d_model // 4, d_inner=d_model * 4
+    ).to_dict()
+
+
+PRESETS = {
+    "cycle_loss": ({"cycle_loss": True}, {}),
+    "critic": ({}, {"critic_name": "benchmark", "critic": critic_config()}),
+}
+
+
+def main():
+    batch_size, seq_len = 8, 60
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len))
+    print(f'batch size {batch_size}, {seq_len} tokens, interpolation losses every step')
+    print(f'{"preset":>10} {"decoding":>9} {"step ms":>8} {"vs generate":>12}')
+    for preset, (training_kwargs, config_kwargs) in PRESETS.items():
+        generate_ms = None
+        for decoding in INTERPOLATION_DECODING:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                args = VAE_TrainingArguments(
+                    output_dir=tmp_dir, no_cuda=not torch.cuda.is_available(), report_to=[], generate_max_len=seq_len,
+                    per_device_train_batch_size=batch_size, min_critic_steps=0, interpolation_decoding=decoding, **training_kwargs
+                )
+                model = benchmark_model(seq_len, **config_kwargs).train()
+                trainer = VAE_Trainer(model, args, metrics_sink=RecordingSink(), tokenizer=IdTokenizer())
+            trainer.state.global_step = model.global_step = 1
+
+            def step():
+                trainer.training_step(model, {"input_ids": input_ids, "labels": input_ids})
+                model.zero_grad()
+
+            step_ms = time_fn(step, 3) * 1000
+            generate_ms = generate_ms or step_ms
+            print(f'{preset:>10} {decoding:>9} {step_ms:>8.0f} {generate_ms / step_ms:>11.2f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+'''
+    Memory & time of banded local self-attention against full causal self-attention as sequences get longer.
+
+    python -m benchmarks.local_attention
+'''
+import copy
+import torch
+from transformers import T5Config
+from transformers.models.t5.modeling_t5 import T5Attention
+
+from benchmarks.utils import time_fn, peak_memory
+from transformer_vae.custom_t5 import LocalT5Attention
+
+
+def main():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    window_size, window_overlap = 128, 64
+    config = T5Config(d_model=256, d_kv=64, num_heads=4, is_decoder=True)
+    full = T5Attention(config, has_relative_attention_bias=True).to(device)
+    local = LocalT5Attention.from_attention(copy.deepcopy(full), window_size, window_overlap)
+    print(f'window {window_size} overlap {window_overlap}')
+    print(f'{"seq_len":>8} {"mode":>6} {"fwd+bwd ms":>11} {"peak MB":>8}')
+    for seq_len in [512, 1024, 2048, 4096]:
+        hidden_states = torch.randn(2, seq_len, 256, device=device, requires_grad=True)
+        causal_mask = torch.triu(torch.full((seq_len, seq_len), -10000.0, device=device), 1)[None, None]
+        modes = [
+            ("full", lambda: full(hidden_states, mask=causal_mask)[0].sum().backward()),
+            ("local", lambda: local(hidden_states)[0].sum().backward()),
+        ]
+        for name, step in modes:
+            print(f'{seq_len:>8} {name:>6} {time_fn(step, 3) * 1000:>11.1f} {peak_memory(step) / 2 ** 20:>8.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+'''
+    Compare the tiled MMD kernel with the matmul kernel.
+
+    python -m benchmarks.mmd
+'''
+import torch
+
+from benchmarks.utils import time_fn, peak_memory
+from transformer_vae.autoencoders import EncoderDecoderVAE
+
+
+def main():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    latent_size = 1000
+    modes = [('tiled', '', 0), ('matmul', 'matmul', 0), ('matmul chunk=256', 'matmul', 256)]
+    print(f'{"N":>6} {"mode":>18} {"ms/step":>10} {"peak MB":>10} {"reg_loss":>12}')
+    for n in [64, 256, 512]:
+        latent = torch.tanh(torch.randn(n, latent_size, device=device)).requires_grad_()
+        for name, kernel, chunk_size in modes:
+            vae = EncoderDecoderVAE(None, None, mmd_kernel=kernel, mmd_chunk_size=chunk_size)
+
+            def step():
+                torch.manual_seed(0)
+                vae._regularliser_loss(latent).backward()
+
+            torch.manual_seed(0)
+            loss = vae._regularliser_loss(latent).item()
+            print(f'{n:>6} {name:>18} {time_fn(step, 3) * 1000:>10.2f} {peak_memory(step) / 2 ** 20:>10.1f} {loss:>12.6f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+'''
+    Slerp over a large grid of latent pairs & ratios, the previous implementation vs the broadcasting one.
+
+    python -m benchmarks.slerp
+'''
+import torch
+
+from benchmarks.utils import time_fn
+from transformer_vae.utils import slerp, slerp_endpoints, slerp_from_endpoints
+
+
+def previous_slerp(ratio, t1, t2):
+    low_norm = t1 / torch.norm(t1, dim=1, keepdim=True)
+    high_norm = t2 / torch.norm(t2, dim=1, keepdim=True)
+    omega = torch.acos((low_norm * high_norm).sum(1))
+    so = torch.sin(omega)
+    return (torch.sin((1.0 - ratio) * omega) / so).unsqueeze(1) * t1 + (torch.sin(ratio * omega) / so).unsqueeze(1) * t2
+
+
+def main():
+    n_ratios, n_tokens, dim = 11, 4, 64
+    ratios = torch.linspace(0, 1, n_ratios)
+    print(f'{n_ratios} ratios, {n_tokens} latent tokens of size {dim}')
+    print(f'{"pairs":>6} {"previous ms":>12} {"broadcast ms":>13} {"cached ms":>10} {"speedup":>8} {"prev. NaNs":>11}')
+    for n_pairs in [64, 512, 4096]:
+        start, end = torch.randn(n_pairs, n_tokens, dim), torch.randn(n_pairs, n_tokens, dim)
+        # some parallel pairs
+        end[::8] = start[::8] * 2
+
+        def previous():
+            # repeat every pair for each ratio & every ratio for each latent token
+            grid_ratios = ratios.view(1, n_ratios, 1).repeat(n_pairs, 1, n_tokens).view(-1)
+            grid_start = start.unsqueeze(1).repeat(1, n_ratios, 1, 1).view(-1, dim)
+            grid_end = end.unsqueeze(1).repeat(1, n_ratios, 1, 1).view(-1, dim)
+            return previous_slerp(grid_ratios, grid_start, grid_end)
+
+        def broadcast():
+            return slerp(ratios.view(1, n_ratios, 1), start.unsqueeze(1), end.unsqueeze(1))
+
+        endpoints = slerp_endpoints(start.unsqueeze(1), end.unsqueeze(1))
+
+        def cached():
+            return slerp_from_endpoints(ratios.view(1, n_ratios, 1), endpoints)
+
+        torch.testing.assert_close(broadcast()[1::8], previous().view(n_pairs, n_ratios, n_tokens, dim)[1::8])
+        nans = (~torch.isfinite(previous())).any(-1).sum().item()
+        timings = [time_fn(fn, 10) * 1000 for fn in [previous, broadcast, cached]]
+        print(
+            f'{n_pairs:>6} {timings[0]:>12.2f} {timings[1]:>13.2f} {timings[2]:>10.2f} {timings[0] / timings[1]:>7.2f}x {nans:>11}'
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+'''
+    Memory held between interpolation losses by the sample stash & the time to stash a batch & read it back.
+
+    Memory is measured on the `meta` device so large presets don't need allocating.
+
+    python -m benchmarks.stash
+'''
+import torch
+
+from benchmarks.utils import time_fn
+from transformer_vae.stash import SampleStash
+
+MB = 2 ** 20
+# (name, batch size, interpolate_training_step_rate, set_seq_size, d_model)
+PRESETS = [
+    ("batch_large interpolate_batch t5-base", 70, 5, 60, 768),
+    ("batch_large interpolate_batch t5-large", 70, 5, 60, 1024),
+    ("batch_medium interpolate_batch t5-large 256Seq", 30, 5, 256, 1024),
+    ("batch_large interpolate_batch t5-large 512Seq", 70, 5, 512, 1024),
+]
+OPTIONS = [
+    ("float32", torch.float, False),
+    ("float16", torch.float16, False),
+    ("bfloat16", torch.bfloat16, False),
+    ("offload", torch.float16, True),
+]
+
+
+def stash_batch(batch_size, seq_len, d_model, device):
+    return {
+        "latent": torch.empty(batch_size, 5, 64, device=device),
+        "final_decoder_hidden_states": torch.empty(batch_size, seq_len, d_model, device=device),
+        "input_ids": torch.empty(batch_size, seq_len, dtype=torch.long, device=device),
+    }
+
+
+def main():
+    print('MB kept on the training device between interpolation losses, previously fp32 & allocated without the critic or cycle losses')
+    print(f'{"preset":>48} {"previous":>9} ' + " ".join(f'{name:>9}' for name, _, _ in OPTIONS))
+    for name, batch_size, rate, seq_len, d_model in PRESETS:
+        # fp32 (N, latent_size) latent & (N, n_positions, d_model) hidden state stacks
+        previous = rate * batch_size * (64 + seq_len * d_model) * 4
+        device_mb = []
+        for _, dtype, offload in OPTIONS:
+            if offload:
+                # kept in host memory
+                device_mb.append(0.0)
+                continue
+            stash = SampleStash(rate * batch_size, dtype, "meta")
+            stash.add(**stash_batch(batch_size, seq_len, d_model, "meta"))
+            device_mb.append(stash.nbytes() / MB)
+        print(f'{name:>48} {previous / MB:>9.1f} ' + " ".join(f'{mb:>9.1f}' for mb in device_mb))
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    batch_size, rate, seq_len, d_model = 16, 5, 60, 256
+    batch = {
+        name: value.normal_() if value.is_floating_point() else value.random_(1000)
+        for name, value in stash_batch(batch_size, seq_len, d_model, device).items()
+    }
+    print(f'\nms to stash a batch of {batch_size} & read back {rate} batches on {device}')
+    for name, dtype, offload in OPTIONS:
+        stash = SampleStash(rate * batch_size, dtype, device, offload=offload)
+
+        def step():
+            for _ in range(rate):
+                stash.add(**batch)
+            stash.get(device)
+
+        print(f'{name:>9} {time_fn(step) * 1000 / rate:>6.2f}')
+
+
+if __name__ == "__main__":
+    main()
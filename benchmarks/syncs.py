@@ -0,0 +1,60 @@
+'''
+    Host syncs & step time of training steps with extra logs, logging every `log_steps` steps.
+
+    Counts tensor reads by the host (`.item()`, `float(tensor)`, `if tensor:`, `.tolist()`...), each one waits on the device.
+
+    python -m benchmarks.syncs
+'''
+import time
+import torch
+from torch.overrides import TorchFunctionMode
+
+from benchmarks.utils import benchmark_model
+
+SYNC_METHODS = {"item", "tolist", "__bool__", "__float__", "__int__", "__index__", "numpy", "_local_scalar_dense"}
+
+
+class CountHostSyncs(TorchFunctionMode):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if getattr(func, "__name__", None) in SYNC_METHODS:
+            self.count += 1
+        return func(*args, **(kwargs or {}))
+
+
+def main():
+    batch_size, seq_len, n_steps, log_steps = 16, 60, 20, 10
+    model = benchmark_model(seq_len, use_extra_logs=True).train()
+    if torch.cuda.is_available():
+        model = model.cuda()
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len), device=model.device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+
+    def train(steps):
+        for step in range(steps):
+            model.global_step = step
+            optimizer.zero_grad()
+            model(input_ids=input_ids, labels=input_ids).loss.backward()
+            optimizer.step()
+            if (step + 1) % log_steps == 0:
+                model.get_latest_logs()
+
+    train(log_steps)
+    with CountHostSyncs() as counter:
+        train(n_steps)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    train(n_steps)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / n_steps
+    print(f'{n_steps} steps, logging every {log_steps}')
+    print(f'host syncs per step {counter.count / n_steps:.1f}, {seconds * 1000:.1f}ms per step')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import time
+import torch
+
+
+def time_fn(fn, repeats=10):
+    '''
+        Mean seconds per call after a warmup call.
+    '''
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def peak_memory(fn):
+    '''
+        Peak allocated bytes on CUDA, on CPU uses the largest single allocation seen by the profiler.
+    '''
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        fn()
+        return torch.cuda.max_memory_allocated()
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    return max([event.cpu_memory_usage for event in prof.function_events] + [0])
+
+
+def benchmark_config(set_seq_size=60, d_model=256, num_layers=4, **kwargs):
+    '''
+        Mid-sized config built locally so benchmarks don't need to download pretrained configs.
+    '''
+    from transformers import T5Config, FunnelConfig
+    from transformer_vae.config import Funnel_T5_VAE_Config
+
+    funnel = FunnelConfig(
+        vocab_size=1000, block_sizes=[1, 1, 1], d_model=d_model, n_head=4, d_head=d_model // 4, d_inner=d_model * 4
+    )
+    funnel.n_positions = set_seq_size
+    t5 = T5Config(
+        vocab_size=1000, d_model=d_model, d_kv=d_model // 4, d_ff=d_model * 4, num_layers=num_layers, num_heads=4,
+        decoder_start_token_id=0,
+    )
+    t5.n_positions = set_seq_size
+    return Funnel_T5_VAE_Config(
+        funnel=funnel.to_dict(), t5=t5.to_dict(), latent_size=64, set_seq_size=set_seq_size, **kwargs
+    )
+
+
+def benchmark_model(set_seq_size=60, **kwargs):
+    from transformer_vae.model import Funnel_T5_VAE_Model
+    torch.manual_seed(0)
+    return Funnel_T5_VAE_Model(benchmark_config(set_seq_size, **kwargs))
+
+
+class IdTokenizer:
+    '''
+        Decodes token ids as space separated numbers, for benchmarking evaluation without downloading a tokenizer.
+    '''
+    pad_token_id = 0
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        return " ".join(str(i) for i in ids.tolist() if not skip_special_tokens or i != self.pad_token_id)
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.decode(ids, **kwargs) for ids in sequences]
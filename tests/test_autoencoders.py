@@ -0,0 +1,52 @@
+import unittest
+import torch
+
+from transformer_vae.autoencoders import EncoderDecoderVAE
+
+
+class MMDTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.latent = torch.tanh(torch.randn(60, 13))
+        self.true_samples = torch.randn(60, 13)
+
+    def test_matmul_kernel_matches_tiled(self):
+        x, y = self.true_samples, self.latent
+        torch.testing.assert_close(
+            EncoderDecoderVAE._compute_matmul_kernel(x, y), EncoderDecoderVAE._compute_kernel(x, y)
+        )
+
+    def test_matmul_mmd_matches_tiled(self):
+        expected = EncoderDecoderVAE(None, None)._compute_mmd(self.true_samples, self.latent)
+        for chunk_size in [0, 1, 7, 60, 100]:
+            vae = EncoderDecoderVAE(None, None, mmd_kernel="matmul", mmd_chunk_size=chunk_size)
+            torch.testing.assert_close(vae._compute_mmd(self.true_samples, self.latent), expected)
+
+    def test_rff_mmd_converges_to_exact(self):
+        vae = EncoderDecoderVAE(None, None)
+        x, y = torch.randn(500, 3), torch.tanh(torch.randn(500, 3)) * 3
+        expected = vae._compute_mmd(x, y)
+        errors = []
+        for n_features in [16, 4096]:
+            vae.mmd_rff_features = n_features
+            errors.append(torch.stack([(vae._compute_rff_mmd(x, y) - expected).abs() for _ in range(20)]).mean())
+        self.assertLess(errors[1], errors[0])
+        self.assertLess(errors[1], 0.1 * expected)
+
+    def test_linear_mmd_converges_to_exact(self):
+        vae = EncoderDecoderVAE(None, None, mmd_kernel="matmul", mmd_chunk_size=1000)
+        x, y = torch.randn(20_000, 3), torch.tanh(torch.randn(20_000, 3)) * 3
+        expected = vae._compute_mmd(x, y)
+        torch.testing.assert_close(vae._compute_linear_mmd(x, y), expected, rtol=0.1, atol=0)
+
+    @unittest.skipUnless(hasattr(torch, "autocast"), "Needs torch.autocast.")
+    def test_mmd_stays_fp32_with_bf16_autocast(self):
+        for mmd_kernel in ["", "matmul"]:
+            vae = EncoderDecoderVAE(None, None, mmd_kernel=mmd_kernel)
+            torch.manual_seed(1)
+            expected = vae._regularliser_loss(self.latent)
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                torch.manual_seed(1)
+                loss = vae._regularliser_loss(self.latent.bfloat16())
+            self.assertEqual(loss.dtype, torch.float32)
+            torch.testing.assert_close(loss, expected, rtol=1e-2, atol=1e-3)
@@ -0,0 +1,74 @@
+import unittest
+import torch
+
+from transformer_vae.checkpoint_policy import (
+    CheckpointedFunnelLayer, apply_checkpoint_plan, checkpoint_units, choose_checkpointed_units, plan_checkpointing,
+    profile_checkpoint_units, MB
+)
+from transformer_vae.model import Funnel_T5_VAE_Model
+from tests.test_model import tiny_config
+
+
+class CheckpointPolicyTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Funnel_T5_VAE_Model(tiny_config(use_extra_logs=True)).train()
+        self.model.global_step = 0
+        input_ids = torch.randint(1, 50, (3, 8))
+        self.inputs = {"input_ids": input_ids, "labels": input_ids}
+
+    def gradients(self):
+        self.model.zero_grad()
+        torch.manual_seed(1)
+        self.model(**self.inputs).loss.backward()
+        return {name: param.grad.clone() for name, param in self.model.named_parameters() if param.grad is not None}
+
+    def test_profile_records_every_layer(self):
+        units, forward_seconds = profile_checkpoint_units(self.model, self.inputs)
+        self.assertEqual([unit.name for unit in units], [name for name, _ in checkpoint_units(self.model)])
+        for unit in units:
+            self.assertGreater(unit.activation_bytes, unit.input_bytes)
+            self.assertGreater(unit.seconds, 0)
+        self.assertGreater(forward_seconds, sum(unit.seconds for unit in units))
+        # profiling doesn't add to the training logs
+        self.assertEqual(self.model.get_latest_logs(), {})
+
+    def test_profile_scales_batch_slice(self):
+        input_ids = torch.randint(1, 50, (4, 8))
+        inputs = {"input_ids": input_ids, "labels": input_ids}
+        full_batch, _ = profile_checkpoint_units(self.model, inputs, profile_batch_size=4)
+        for profile_batch_size in [1, 2]:
+            units, _ = profile_checkpoint_units(self.model, inputs, profile_batch_size=profile_batch_size)
+            for unit, expected in zip(units, full_batch):
+                self.assertEqual(unit.input_bytes, expected.input_bytes)
+                # tensors shared by the batch are over counted
+                self.assertGreaterEqual(unit.activation_bytes, expected.activation_bytes)
+                self.assertLess(unit.activation_bytes, 1.25 * expected.activation_bytes)
+
+    def test_budget_sets_checkpointed_layers(self):
+        units, forward_seconds = profile_checkpoint_units(self.model, self.inputs)
+        activation_mb = sum(unit.activation_bytes for unit in units) / MB
+        self.assertEqual(choose_checkpointed_units(units, forward_seconds, activation_mb * 2).checkpointed, set())
+        plan = choose_checkpointed_units(units, forward_seconds, activation_mb * 0.6)
+        self.assertTrue(0 < len(plan.checkpointed) < len(units))
+        self.assertLessEqual(plan.peak_activation_bytes, activation_mb * 0.6 * MB)
+        self.assertGreater(plan.logs()["checkpoint_recompute_overhead"], 0)
+        self.assertEqual(len(choose_checkpointed_units(units, forward_seconds, 1e-6).checkpointed), len(units))
+
+    def test_checkpointed_gradients_match(self):
+        expected = self.gradients()
+        for use_reentrant in [True, False]:
+            apply_checkpoint_plan(self.model, set(name for name, _ in checkpoint_units(self.model)), use_reentrant)
+            self.assertIsInstance(self.model.encoder.blocks[0][0], CheckpointedFunnelLayer)
+            self.assertEqual(self.model.decoder.checkpoint_layers, {0, 1})
+            grads = self.gradients()
+            self.assertEqual(grads.keys(), expected.keys())
+            for name, grad in grads.items():
+                torch.testing.assert_close(grad, expected[name])
+
+    def test_plan_checkpointing(self):
+        model = Funnel_T5_VAE_Model(tiny_config(checkpoint_memory_budget=1e-6, checkpoint_non_reentrant=True)).train()
+        plan = plan_checkpointing(model, self.inputs)
+        self.assertEqual(len(plan.checkpointed), len(plan.units))
+        self.assertFalse(model.decoder.checkpoint_use_reentrant)
+        self.assertTrue(all(layer.use_checkpoint for block in model.encoder.blocks for layer in block))
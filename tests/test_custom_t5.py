@@ -0,0 +1,79 @@
+import copy
+import unittest
+import torch
+from transformers import T5Config
+from transformers.models.t5.modeling_t5 import T5Attention
+
+from transformer_vae.custom_t5 import LocalT5Attention, SDPA_T5Attention
+from transformer_vae.model import Funnel_T5_VAE_Model
+from tests.test_model import tiny_config
+
+
+def dense_local_attention(attention, hidden_states, window_size, window_overlap, padding_mask):
+    '''
+        Reference banded attention using a full (seq_len, seq_len) mask.
+    '''
+    seq_len = hidden_states.size(1)
+    query = torch.arange(seq_len)[:, None]
+    key = torch.arange(seq_len)[None, :]
+    allowed = (key <= query) & (key >= (query // window_size) * window_size - window_overlap)
+    position_bias = attention.compute_bias(seq_len, seq_len) + (~allowed).float() * -10000.0
+    position_bias = position_bias + (1.0 - padding_mask[:, None, None, :]) * -10000.0
+    return T5Attention.forward(attention, hidden_states, position_bias=position_bias)[0]
+
+
+class LocalAttentionTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = T5Config(d_model=16, d_kv=8, num_heads=2, is_decoder=True, dropout_rate=0.0)
+        self.attention = T5Attention(config, has_relative_attention_bias=True).eval()
+
+    def local_attention(self, window_size, window_overlap, sdpa=False):
+        attention = copy.deepcopy(self.attention)
+        if sdpa:
+            attention = SDPA_T5Attention.from_attention(attention)
+        return LocalT5Attention.from_attention(attention, window_size, window_overlap)
+
+    def test_matches_dense_reference(self):
+        for seq_len, window_size, window_overlap in [(13, 4, 2), (12, 4, 0), (12, 4, 4), (3, 4, 2), (16, 5, 7)]:
+            for sdpa in [False, True]:
+                hidden_states = torch.randn(2, seq_len, 16, requires_grad=True)
+                padding_mask = torch.ones(2, seq_len)
+                padding_mask[1, -2:] = 0
+                expected = dense_local_attention(self.attention, hidden_states, window_size, window_overlap, padding_mask)
+                expected_grad, = torch.autograd.grad(expected.sum(), hidden_states)
+
+                local = self.local_attention(window_size, window_overlap, sdpa)
+                mask = (1.0 - padding_mask[:, None, None, :]) * -10000.0
+                outputs = local(hidden_states, mask=mask)[0]
+                grad, = torch.autograd.grad(outputs.sum(), hidden_states)
+                torch.testing.assert_close(outputs, expected)
+                torch.testing.assert_close(grad, expected_grad)
+
+    def test_decoding_with_past_matches_full_sequence(self):
+        local = self.local_attention(4, 2)
+        hidden_states = torch.randn(2, 11, 16)
+        expected = local(hidden_states)[0]
+        past, outputs = None, []
+        with torch.no_grad():
+            for i in range(hidden_states.size(1)):
+                step_outputs = local(hidden_states[:, i:i + 1], past_key_value=past, use_cache=True)
+                past = step_outputs[1]
+                outputs.append(step_outputs[0])
+        torch.testing.assert_close(torch.cat(outputs, 1), expected)
+
+    def test_model_cached_decoding(self):
+        model = Funnel_T5_VAE_Model(tiny_config(set_seq_size=20, attention_window_size=6, attention_window_overlap=3)).eval()
+        input_ids = torch.randint(1, 50, (3, 20))
+        with torch.no_grad():
+            latent = model(input_ids=input_ids).latent
+            expected = model(decoder_input_ids=input_ids, latent=latent).logits
+            past, upsampled_encoding, step_logits = None, None, []
+            for i in range(input_ids.size(1)):
+                inputs = model.prepare_inputs_for_generation(
+                    input_ids[:, :i + 1], latent=latent, past=past, upsampled_encoding=upsampled_encoding
+                )
+                outputs = model(**inputs)
+                past, upsampled_encoding = outputs.past_key_values, outputs.upsampled_encoding
+                step_logits.append(outputs.logits[:, -1])
+        torch.testing.assert_close(torch.stack(step_logits, 1), expected)
@@ -0,0 +1,29 @@
+import unittest
+import torch
+from transformers import GPT2TokenizerFast
+
+from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
+
+
+class DataCollatorTests(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = GPT2TokenizerFast.from_pretrained("tokenizers/tkn_python-lines_byte")
+        self.tokenizer.pad_token, self.tokenizer.eos_token, self.tokenizer.mask_token = "<pad>", "</s>", "</s>"
+        self.tokenizer.model_max_length = 12
+
+    def test_special_tokens_mask_matches_tokenizer(self):
+        collator = DataCollatorForLanguageAutoencoding(self.tokenizer, mlm_probability=0.15)
+        input_ids = self.tokenizer(["a = 1</s>", "print(x)", ""], padding="max_length", return_tensors="pt")["input_ids"]
+        expected = torch.tensor(
+            [self.tokenizer.get_special_tokens_mask(row, already_has_special_tokens=True) for row in input_ids.tolist()],
+            dtype=torch.bool,
+        )
+        self.assertTrue(collator._special_tokens_mask(input_ids).equal(expected))
+        self.assertTrue(expected.any())
+
+    def test_no_masking(self):
+        collator = DataCollatorForLanguageAutoencoding(self.tokenizer, mlm_probability=0.0)
+        rows = self.tokenizer(["a = 1", "print(x)"], padding="max_length")["input_ids"]
+        batch = collator([{"input_ids": row} for row in rows])
+        self.assertTrue(batch["input_ids"].equal(torch.tensor(rows)))
+        self.assertTrue(batch["labels"].eq(-100).equal(batch["input_ids"].eq(self.tokenizer.pad_token_id)))
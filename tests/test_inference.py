@@ -0,0 +1,107 @@
+import unittest
+from unittest import mock
+import torch
+
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.inference import VAE_Inference
+from transformer_vae.quantize import nnqd
+from tests.test_model import tiny_config
+from tests.test_quantize import CharTokenizer as EncodingCharTokenizer
+
+
+class CharTokenizer(EncodingCharTokenizer):
+    '''
+        Also decodes the tiny model's ids back into characters.
+    '''
+    def batch_decode(self, sequences, skip_special_tokens=False, **kwargs):
+        return ["".join(chr(ord("0") + i) for i in ids.tolist() if i > 0 or not skip_special_tokens) for ids in sequences]
+
+
+class InferenceTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Funnel_T5_VAE_Model(tiny_config(n_latent_tokens=2))
+        self.texts = ["abc", "hello", "x = 1", "", "print(y)"]
+
+    def inference(self, **kwargs):
+        return VAE_Inference(self.model, CharTokenizer(), **kwargs)
+
+    def test_encode_decode_interpolate(self):
+        inference = self.inference()
+        latents = inference.encode(self.texts)
+        self.assertEqual(latents.shape, (5, 2, 4))
+        self.assertEqual(latents.device.type, "cpu")
+        texts = inference.decode(latents)
+        self.assertEqual(len(texts), 5)
+        self.assertTrue(all(isinstance(text, str) and len(text) < 8 for text in texts))
+
+        interpolations = inference.interpolate_latents(latents[0], latents[1], 4)
+        self.assertEqual(interpolations.shape, (4, 2, 4))
+        torch.testing.assert_close(interpolations[0], latents[0])
+        torch.testing.assert_close(interpolations[-1], latents[1])
+        self.assertEqual(len(inference.interpolate(self.texts[0], latents[1], n=4)), 4)
+        self.assertEqual(len(inference.interpolate(self.texts[0], self.texts[1], n=3, all_at_once=True)), 3)
+
+    def padded_latents(self, texts):
+        input_ids = CharTokenizer()(texts, 8, padding="max_length")["input_ids"]
+        with torch.no_grad():
+            encoding = self.model._get_encoder_outputs(input_ids=input_ids, attention_mask=input_ids.ne(0).long())
+            return self.model.vae.encoder(encoding.last_hidden_state)
+
+    def test_max_batch_tokens(self):
+        expected_texts = self.inference().decode(self.inference().encode(self.texts))
+        inference = self.inference(max_batch_size=4, max_batch_tokens=20)
+        with mock.patch.object(self.model, "generate", wraps=self.model.generate) as generate, \
+                mock.patch.object(self.model, "_get_encoder_outputs", wraps=self.model._get_encoder_outputs) as encode:
+            latents = inference.encode(self.texts)
+            texts = inference.decode(latents)
+        # texts sorted by length, each batch padded to a multiple of the pooling stride & filled up to 20 tokens
+        self.assertEqual([tuple(call[1]["input_ids"].shape) for call in encode.call_args_list], [(2, 8), (3, 6)])
+        # decoding always generates `generate_max_len` tokens
+        self.assertEqual([call[1]["latent"].size(0) for call in generate.call_args_list], [2, 2, 1])
+        # returned in the order given & matching texts padded to `set_seq_size`
+        torch.testing.assert_close(latents, self.padded_latents(self.texts))
+        self.assertEqual(texts, expected_texts)
+
+        # always at least 1 sequence per batch
+        self.assertEqual(self.inference(max_batch_tokens=4)._batch_size(8), 1)
+
+    def test_full_sequence_latents_pad_to_set_seq_size(self):
+        self.model = Funnel_T5_VAE_Model(tiny_config(n_latent_tokens=-1))
+        with mock.patch.object(self.model, "_get_encoder_outputs", wraps=self.model._get_encoder_outputs) as encode:
+            latents = self.inference(max_batch_size=2).encode(self.texts)
+        self.assertEqual([call[1]["input_ids"].size(1) for call in encode.call_args_list], [8, 8, 8])
+        torch.testing.assert_close(latents, self.padded_latents(self.texts))
+
+    def test_encode_nothing(self):
+        self.assertEqual(self.inference().encode([]).shape, (0, 2, 4))
+        self.assertEqual(self.inference().decode(torch.zeros((0, 2, 4))), [])
+
+    def test_checkpointed_encoder(self):
+        expected = self.inference().encode(self.texts)
+        self.model.config.gradient_checkpoint_encoder = True
+        torch.testing.assert_close(self.inference().encode(self.texts), expected)
+        model = Funnel_T5_VAE_Model(tiny_config(n_latent_tokens=2, gradient_checkpoint_encoder=True))
+        latents = VAE_Inference(model, CharTokenizer()).encode(self.texts)
+        self.assertEqual(latents.shape, (5, 2, 4))
+
+    @unittest.skipUnless(hasattr(torch, "autocast"), "Needs torch.autocast.")
+    def test_bf16(self):
+        expected = self.inference().encode(self.texts)
+        inference = self.inference(dtype="bf16")
+        latents = inference.encode(self.texts)
+        self.assertEqual(latents.dtype, torch.float32)
+        torch.testing.assert_close(latents, expected, rtol=5e-2, atol=5e-2)
+        self.assertEqual(len(inference.decode(latents)), 5)
+        with self.assertRaises(ValueError):
+            self.inference(dtype="fp16")
+
+    def test_quantized(self):
+        expected = self.inference().encode(self.texts)
+        inference = self.inference(quantize=True)
+        self.assertIsInstance(inference.model.lm_head, nnqd.Linear)
+        # the original model isn't quantized
+        self.assertIsInstance(self.model.lm_head, torch.nn.Linear)
+        latents = inference.encode(self.texts)
+        self.assertGreater(torch.nn.functional.cosine_similarity(latents, expected, dim=-1).min(), 0.99)
+        self.assertEqual(len(inference.decode(latents)), 5)
@@ -0,0 +1,54 @@
+import unittest
+import torch
+
+from transformer_vae.interpolation import interpolation_ratios, interpolation_grid, decode_in_batches, batched_interpolations
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.utils import slerp
+from tests.test_model import tiny_config
+
+
+class InterpolationTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.start, self.end = torch.randn(5, 3, 4), torch.randn(5, 3, 4)
+        self.ratios = interpolation_ratios()
+
+    def test_grid_matches_pairwise_slerp(self):
+        grid = interpolation_grid(self.start, self.end, self.ratios)
+        self.assertEqual(grid.shape, (5, 11, 3, 4))
+        for k in range(5):
+            for r, ratio in enumerate(self.ratios):
+                expected = slerp(ratio.expand(3), self.start[k], self.end[k])
+                torch.testing.assert_close(grid[k, r], expected)
+        torch.testing.assert_close(grid[:, 0], self.start)
+        torch.testing.assert_close(grid[:, -1], self.end)
+
+    def test_grid_all_at_once(self):
+        grid = interpolation_grid(self.start, self.end, self.ratios, interpolate_all_at_once=True)
+        for k in range(5):
+            expected = slerp(self.ratios, self.start[k].view(1, -1).expand(11, -1), self.end[k].view(1, -1).expand(11, -1))
+            torch.testing.assert_close(grid[k], expected.view(11, 3, 4))
+
+    def test_decode_in_batches(self):
+        sizes = []
+
+        def decode(latents):
+            sizes.append(latents.size(0))
+            return [str(i) for i in range(latents.size(0))]
+
+        texts = decode_in_batches(decode, torch.zeros(10, 2), 4)
+        self.assertEqual(sizes, [4, 4, 2])
+        self.assertEqual(len(texts), 10)
+
+    def test_batched_interpolations(self):
+        model = Funnel_T5_VAE_Model(tiny_config()).eval()
+        input_ids = torch.randint(1, 50, (7, 8))
+        with torch.no_grad():
+            latent = model(input_ids=input_ids).latent
+            grid, texts = batched_interpolations(
+                model, {"input_ids": input_ids}, self.ratios, lambda latents: [str(l.sum().item()) for l in latents], batch_size=5
+            )
+        self.assertEqual(grid.shape, (3, 11) + latent.shape[1:])
+        self.assertEqual([len(pair_texts) for pair_texts in texts], [11, 11, 11])
+        torch.testing.assert_close(grid[:, 0], latent[0:6:2])
+        torch.testing.assert_close(grid[:, -1], latent[1:6:2])
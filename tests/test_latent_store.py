@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+
+from transformer_vae.latent_store import LatentStore, encode_dataset
+
+
+class FakeInference:
+    '''
+        Encodes each text into a latent code derived from its characters, counting encoded texts.
+    '''
+    def __init__(self):
+        self.n_encoded = 0
+
+    def encode(self, texts):
+        self.n_encoded += len(texts)
+        latents = torch.zeros((len(texts), 2, 4))
+        for i, text in enumerate(texts):
+            generator = torch.Generator().manual_seed(sum(ord(c) for c in text))
+            latents[i] = torch.randn((2, 4), generator=generator)
+        return latents
+
+
+class LatentStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name
+        np.random.seed(0)
+        self.latents = np.random.randn(600, 2, 4).astype(np.float32)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, store, shard_size=200):
+        for start in range(0, len(self.latents), shard_size):
+            rows = np.arange(start, start + shard_size)
+            store.write_shard(f"{start // shard_size:06d}", self.latents[rows], rows, class_label=rows % 3)
+
+    def test_write_and_update(self):
+        store = LatentStore(self.path, dtype="float32")
+        self.write(store)
+        store = LatentStore(self.path)
+        self.assertEqual(len(store), 600)
+        self.assertEqual(store.meta["dim"], 8)
+        self.assertEqual(store.shard_ids, ["000000", "000001", "000002"])
+        np.testing.assert_array_equal(store.shard("000001"), self.latents[200:400].reshape(200, 8))
+        dataset_index, class_label = store.shard_metadata("000001")
+        np.testing.assert_array_equal(dataset_index, np.arange(200, 400))
+        np.testing.assert_array_equal(class_label, np.arange(200, 400) % 3)
+
+        store.write_shard("000001", self.latents[:10], np.arange(10))
+        self.assertEqual(len(store), 410)
+        np.testing.assert_array_equal(store.shard_metadata("000001")[1], np.full(10, -1))
+        with self.assertRaises(ValueError):
+            store.write_shard("000003", np.zeros((5, 3)), np.arange(5))
+        with self.assertRaises(ValueError):
+            LatentStore(self.path, dim=3)
+
+    def test_encode_dataset_skips_unchanged_shards(self):
+        texts = [f"text {i}" for i in range(25)]
+        store, inference = LatentStore(self.path), FakeInference()
+        self.assertEqual(encode_dataset(store, inference, texts, "model", shard_size=10), ["000000", "000001", "000002"])
+        self.assertEqual(inference.n_encoded, 25)
+        self.assertEqual(encode_dataset(store, inference, texts, "model", shard_size=10), [])
+        self.assertEqual(inference.n_encoded, 25)
+
+        texts[12] = "changed"
+        self.assertEqual(encode_dataset(store, inference, texts, "model", shard_size=10), ["000001"])
+        self.assertEqual(encode_dataset(store, inference, texts, "new model", shard_size=10), ["000000", "000001", "000002"])
+        np.testing.assert_array_equal(store.shard("000001")[2], inference.encode(["changed"]).numpy().reshape(8).astype(np.float16))
+
+    def test_encode_dataset_deletes_stale_shards(self):
+        texts = [f"text {i}" for i in range(25)]
+        store = LatentStore(self.path)
+        encode_dataset(store, FakeInference(), texts, "model", shard_size=10)
+        store.build_ivf(n_lists=2)
+        self.assertTrue(os.path.exists(os.path.join(self.path, "shard_000002_ivf.npy")))
+
+        encode_dataset(store, FakeInference(), texts[:12], "model", shard_size=10)
+        self.assertEqual(store.shard_ids, ["000000", "000001"])
+        self.assertEqual(len(store), 12)
+        self.assertEqual(LatentStore(self.path).shard_ids, ["000000", "000001"])
+        self.assertFalse(any(name.startswith("shard_000002") for name in os.listdir(self.path)))
+        _, dataset_index, _ = store.nearest(np.random.randn(3, 8), k=12)
+        self.assertEqual(sorted(dataset_index[0]), list(range(12)))
+
+    def test_brute_force_nearest(self):
+        store = LatentStore(self.path, dtype="float32")
+        self.write(store)
+        queries = np.random.randn(4, 2, 4)
+        flat_queries, flat_latents = queries.reshape(4, 8), self.latents.reshape(600, 8)
+        for metric in ["cosine", "l2"]:
+            # small blocks to merge results across blocks & shards
+            scores, dataset_index, class_label = store.nearest(queries, k=5, metric=metric, block_size=64)
+            if metric == "cosine":
+                expected = (flat_queries / np.linalg.norm(flat_queries, axis=1, keepdims=True)) @ (
+                    flat_latents / np.linalg.norm(flat_latents, axis=1, keepdims=True)
+                ).T
+            else:
+                expected = -((flat_queries[:, None] - flat_latents[None]) ** 2).sum(-1)
+            expected_index = np.argsort(-expected, axis=1)[:, :5]
+            np.testing.assert_array_equal(dataset_index, expected_index)
+            np.testing.assert_allclose(scores, np.take_along_axis(expected, expected_index, 1), rtol=1e-4, atol=1e-4)
+            np.testing.assert_array_equal(class_label, expected_index % 3)
+        with self.assertRaises(ValueError):
+            store.nearest(queries, metric="dot")
+        with self.assertRaises(ValueError):
+            store.nearest(queries, n_probe=1)
+
+        # fewer rows than `k`
+        scores, dataset_index, class_label = store.nearest(queries, k=700)
+        self.assertEqual(scores.shape, (4, 700))
+        self.assertFalse(np.isnan(scores[:, :600]).any())
+        self.assertTrue(np.isnan(scores[:, 600:]).all())
+        self.assertTrue((dataset_index[:, 600:] == -1).all() and (class_label[:, 600:] == -1).all())
+
+    def test_ivf_nearest(self):
+        store = LatentStore(self.path, dtype="float32")
+        self.write(store)
+        store.build_ivf(n_lists=4, metric="cosine")
+        queries = np.random.randn(4, 8)
+        expected = store.nearest(queries, k=5)
+        # probing every list is a brute force search
+        for actual, expected_value in zip(store.nearest(queries, k=5, n_probe=4), expected):
+            np.testing.assert_array_equal(actual, expected_value)
+        scores, _, _ = store.nearest(queries, k=5, n_probe=1)
+        self.assertTrue((scores <= expected[0][:, :1]).all())
+
+        # rows written after `build_ivf` are assigned to lists
+        store.write_shard("000003", self.latents[:5], np.arange(600, 605))
+        self.assertEqual(np.load(os.path.join(self.path, "shard_000003_ivf.npy")).shape, (5,))
+
+    def test_ivf_nearest_with_fewer_probed_rows_than_k(self):
+        store = LatentStore(self.path, dtype="float32")
+        self.write(store)
+        store.build_ivf(n_lists=4)
+        queries = np.random.randn(4, 8)
+        scores, dataset_index, class_label = store.nearest(queries, k=500, n_probe=1)
+        self.assertEqual(scores.shape, (4, 500))
+        valid = dataset_index >= 0
+        self.assertFalse(np.isinf(scores).any())
+        np.testing.assert_array_equal(np.isnan(scores), ~valid)
+        np.testing.assert_array_equal(class_label[~valid], -1)
+        self.assertTrue((valid.sum(1) < 500).all())
+        # valid results come first & each is a different row
+        for row_valid, row_index in zip(valid, dataset_index):
+            n_valid = row_valid.sum()
+            self.assertTrue(row_valid[:n_valid].all())
+            self.assertEqual(len(set(row_index[:n_valid])), n_valid)
@@ -0,0 +1,94 @@
+import copy
+import os
+import tempfile
+import threading
+import unittest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from transformer_vae.metrics import MetricsAccumulator
+from transformer_vae.model import Funnel_T5_VAE_Model
+from tests.test_model import tiny_config
+
+
+def _distributed_compute(rank, init_file, results):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    metrics = MetricsAccumulator(["a", "b", "c"])
+    metrics.add(a=torch.tensor(float(rank)))
+    if rank == 1:
+        metrics.add(a=torch.tensor(5.0), b=2)
+    results[rank] = metrics.compute()
+    dist.destroy_process_group()
+
+
+class OtherDeviceTensor(torch.Tensor):
+    '''
+        CPU tensor reporting a different device, stands in for a `DataParallel` replica's values.
+    '''
+    __torch_function__ = torch._C._disabled_torch_function_impl
+
+    @property
+    def device(self):
+        return torch.device("cuda", 1)
+
+
+class MetricsAccumulatorTests(unittest.TestCase):
+    def test_means_per_metric(self):
+        metrics = MetricsAccumulator(["a", "b", "c"])
+        metrics.add(a=torch.tensor(1.0), b=4)
+        metrics.add(a=torch.tensor(3.0, requires_grad=True))
+        self.assertEqual(metrics.compute(reset=False), {"a": 2.0, "b": 4.0})
+        self.assertEqual(metrics.compute(), {"a": 2.0, "b": 4.0})
+        self.assertEqual(metrics.compute(), {})
+        with self.assertRaises(ValueError):
+            metrics.add(d=1)
+
+    def test_sums_per_device(self):
+        metrics = MetricsAccumulator(["a", "b"])
+        metrics.add(a=torch.tensor(1.0, requires_grad=True) * 1, b=1)
+        metrics.add(a=OtherDeviceTensor._make_subclass(OtherDeviceTensor, torch.tensor(3.0)), b=torch.tensor(5.0))
+        metrics.add(a=torch.tensor(2.0))
+        self.assertEqual(set(metrics._sums["a"].keys()), {torch.device("cpu"), torch.device("cuda", 1)})
+        self.assertEqual(set(metrics._sums["b"].keys()), {None, torch.device("cpu")})
+        # stored values don't keep the autograd graph alive
+        self.assertFalse(any(value.requires_grad for value in metrics._sums["a"].values()))
+        self.assertEqual(metrics.compute(), {"a": 2.0, "b": 3.0})
+
+    @unittest.skipUnless(torch.cuda.device_count() >= 2, "Needs 2 GPUs.")
+    def test_sums_on_multiple_gpus(self):
+        metrics = MetricsAccumulator(["a"])
+        metrics.add(a=torch.tensor(1.0, device="cuda:0"))
+        metrics.add(a=torch.tensor(3.0, device="cuda:1"))
+        self.assertEqual(metrics.compute(), {"a": 2.0})
+
+    def test_concurrent_adds(self):
+        metrics = MetricsAccumulator(["a"])
+
+        def add():
+            for _ in range(1000):
+                metrics.add(a=1)
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics._counts["a"], 4000)
+        self.assertEqual(metrics.compute(), {"a": 1.0})
+
+    def test_models_have_their_own_metrics(self):
+        model = Funnel_T5_VAE_Model(tiny_config(use_extra_logs=True)).train()
+        other = Funnel_T5_VAE_Model(tiny_config(use_extra_logs=True)).train()
+        input_ids = torch.randint(1, 50, (3, 8))
+        model(input_ids=input_ids, labels=input_ids)
+        copied = copy.deepcopy(model)
+        self.assertEqual(other.get_latest_logs(), {})
+        self.assertEqual(copied.get_latest_logs().keys(), model.get_latest_logs().keys())
+
+    def test_all_reduce(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = mp.Manager().dict()
+            mp.spawn(_distributed_compute, args=(os.path.join(tmp_dir, "init"), results), nprocs=2)
+        for rank in range(2):
+            self.assertEqual(results[rank], {"a": 2.0, "b": 2.0})
@@ -0,0 +1,200 @@
+import copy
+import unittest
+import torch
+from transformers import T5Config, FunnelConfig
+
+from transformer_vae.config import Funnel_T5_VAE_Config
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.custom_t5 import set_cross_attention_cache
+
+
+def tiny_config(set_seq_size=8, **kwargs):
+    '''
+        Small config that doesn't need to download the pretrained Funnel & T5 configs.
+    '''
+    funnel = FunnelConfig(vocab_size=50, block_sizes=[1, 1], d_model=16, n_head=2, d_head=8, d_inner=32)
+    funnel.n_positions = set_seq_size
+    t5 = T5Config(vocab_size=50, d_model=16, d_kv=8, d_ff=32, num_layers=2, num_heads=2, decoder_start_token_id=0)
+    t5.n_positions = set_seq_size
+    return Funnel_T5_VAE_Config(
+        funnel=funnel.to_dict(), t5=t5.to_dict(), latent_size=4, set_seq_size=set_seq_size, **kwargs
+    )
+
+
+class ModelTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Funnel_T5_VAE_Model(tiny_config()).eval()
+        self.input_ids = torch.randint(1, 50, (3, 8))
+
+    def test_cached_decoding_matches_full_decoding(self):
+        decoder_input_ids = torch.randint(1, 50, (3, 6))
+        with torch.no_grad():
+            latent = self.model(input_ids=self.input_ids).latent
+            expected = self.model(decoder_input_ids=decoder_input_ids, latent=latent).logits
+            past, upsampled_encoding, step_logits = None, None, []
+            for i in range(decoder_input_ids.size(1)):
+                inputs = self.model.prepare_inputs_for_generation(
+                    decoder_input_ids[:, :i + 1], latent=latent, past=past, upsampled_encoding=upsampled_encoding
+                )
+                self.assertEqual(inputs["decoder_input_ids"].size(1), 1)
+                outputs = self.model(**inputs)
+                past, upsampled_encoding = outputs.past_key_values, outputs.upsampled_encoding
+                step_logits.append(outputs.logits[:, -1])
+        torch.testing.assert_close(torch.stack(step_logits, 1), expected)
+
+    def test_cross_attention_cache_follows_weight_updates(self):
+        decoder_input_ids = torch.randint(1, 50, (3, 6))
+        with torch.no_grad():
+            latent = self.model(input_ids=self.input_ids).latent
+            first = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+            cached = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+            self.assertIs(first.upsampled_encoding, cached.upsampled_encoding)
+            torch.testing.assert_close(cached.logits, first.logits)
+
+            for block in self.model.decoder.block:
+                block.layer[1].EncDecAttention.k.weight.mul_(2)
+            self.model.vae.decoder.latent_to_token.weight.mul_(2)
+            updated = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+        self.model.clear_decoding_caches()
+        set_cross_attention_cache(self.model.decoder, False)
+        with torch.no_grad():
+            expected = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+        torch.testing.assert_close(updated.logits, expected.logits)
+
+    def test_decoding_caches_are_cleared(self):
+        decoder_input_ids = torch.randint(1, 50, (3, 6))
+        projections = [block.layer[1].EncDecAttention.k for block in self.model.decoder.block]
+        with torch.no_grad():
+            latent = self.model(input_ids=self.input_ids).latent
+            self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+            self.assertIsNotNone(self.model._latent_cache)
+            self.assertTrue(all(k._cache is not None for k in projections))
+            self.model.eval()
+            self.assertIsNone(self.model._latent_cache)
+            self.assertTrue(all(k._cache is None for k in projections))
+
+            self.model.generate(
+                input_ids=torch.zeros((3, 1), dtype=torch.long), latent=latent, bos_token_id=0, max_length=4, use_cache=False
+            )
+        self.assertIsNone(self.model._latent_cache)
+        self.assertTrue(all(k._cache is None for k in projections))
+
+    @unittest.skipUnless(hasattr(torch, "autocast"), "Needs torch.autocast.")
+    def test_decoding_caches_follow_autocast(self):
+        decoder_input_ids = torch.randint(1, 50, (3, 6))
+        with torch.no_grad():
+            latent = self.model(input_ids=self.input_ids).latent
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+            outputs = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+            self.model.clear_decoding_caches()
+            expected = self.model(decoder_input_ids=decoder_input_ids, latent=latent)
+        self.assertEqual(outputs.upsampled_encoding.dtype, torch.float32)
+        torch.testing.assert_close(outputs.logits, expected.logits)
+
+    def test_checkpointed_encoder_outputs(self):
+        model = Funnel_T5_VAE_Model(tiny_config(gradient_checkpoint_encoder=True))
+        model.load_state_dict(self.model.state_dict())
+        model.eval()
+        expected = self.model._get_encoder_outputs(input_ids=self.input_ids).last_hidden_state
+        torch.testing.assert_close(model._get_encoder_outputs(input_ids=self.input_ids).last_hidden_state, expected)
+        # only checkpointed when training
+        model.train()
+        self.assertEqual(model._get_encoder_outputs(input_ids=self.input_ids).last_hidden_state.shape, expected.shape)
+        model(input_ids=self.input_ids, labels=self.input_ids).loss.backward()
+
+    def test_shorter_padded_batches(self):
+        # batches padded to a multiple of the pooling stride, not `set_seq_size`
+        model = Funnel_T5_VAE_Model(tiny_config(set_seq_size=16, n_latent_tokens=2))
+        for seq_len in [4, 8, 16]:
+            input_ids = torch.randint(1, 50, (3, seq_len))
+            outputs = model(input_ids=input_ids, labels=input_ids)
+            self.assertEqual(outputs.latent.shape, (3, 2, 4))
+            self.assertEqual(outputs.logits.shape, (3, seq_len, 50))
+            outputs.loss.backward()
+
+    def test_sdpa_attention_matches_t5_attention(self):
+        for kwargs in [{}, {"set_seq_size": 20, "attention_window_size": 6}]:
+            model = Funnel_T5_VAE_Model(tiny_config(**kwargs)).eval()
+            sdpa_model = Funnel_T5_VAE_Model(tiny_config(attention_backend="sdpa", **kwargs)).eval()
+            sdpa_model.load_state_dict(model.state_dict())
+            input_ids = torch.randint(1, 50, (3, kwargs.get("set_seq_size", 8)))
+            input_ids[0, -3:] = 0
+            with torch.no_grad():
+                expected = model(input_ids=input_ids, labels=input_ids)
+                outputs = sdpa_model(input_ids=input_ids, labels=input_ids)
+            torch.testing.assert_close(outputs.logits, expected.logits)
+
+    @unittest.skipUnless(hasattr(torch, "autocast"), "Needs torch.autocast.")
+    def test_bf16_autocast(self):
+        self.model.train()
+        self.model.global_step = 1000
+        torch.manual_seed(1)
+        expected = self.model(input_ids=self.input_ids, labels=self.input_ids)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            torch.manual_seed(1)
+            outputs = self.model(input_ids=self.input_ids, labels=self.input_ids)
+        self.assertEqual(outputs.logits.dtype, torch.bfloat16)
+        self.assertEqual(outputs.loss.dtype, torch.float32)
+        self.assertEqual(outputs.reg_loss.dtype, torch.float32)
+        torch.testing.assert_close(outputs.loss, expected.loss, rtol=1e-2, atol=1e-2)
+        outputs.loss.backward()
+
+        self.model.eval()
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            tokens = self.model.generate(
+                input_ids=torch.zeros((3, 1), dtype=torch.long), latent=outputs.latent.detach(), bos_token_id=0, max_length=8
+            )
+        self.assertEqual(tokens.shape, (3, 8))
+
+    def test_deepcopy_has_independent_decoder(self):
+        copied = copy.deepcopy(self.model)
+        with torch.no_grad():
+            expected = self.model(input_ids=self.input_ids, labels=self.input_ids).logits
+            for param in copied.decoder.parameters():
+                param.zero_()
+            outputs = self.model(input_ids=self.input_ids, labels=self.input_ids).logits
+            copied_outputs = copied(input_ids=self.input_ids, labels=self.input_ids).logits
+        torch.testing.assert_close(outputs, expected)
+        self.assertFalse(torch.allclose(copied_outputs, expected))
+
+    @unittest.skipUnless(hasattr(torch, "compile"), "Needs torch.compile.")
+    def test_forward_has_no_graph_breaks(self):
+        import torch._dynamo
+        self.model.train()
+        for model in [self.model, Funnel_T5_VAE_Model(tiny_config(attention_backend="sdpa")).train()]:
+            model.global_step = 1000
+            explanation = torch._dynamo.explain(lambda: model(input_ids=self.input_ids, labels=self.input_ids).loss)()
+            self.assertEqual(explanation.graph_break_count, 0, explanation.break_reasons)
+        torch._dynamo.reset()
+
+    @unittest.skipUnless(hasattr(torch, "compile"), "Needs torch.compile.")
+    def test_global_step_does_not_recompile(self):
+        import torch._dynamo
+        n_graphs = []
+
+        def backend(graph, example_inputs):
+            n_graphs.append(graph)
+            return graph.forward
+
+        schedule = torch.compile(self.model._regulariser_loss_weight_schedule, backend=backend)
+        self.model.global_step = 1000
+        first = schedule()
+        self.model.global_step = 1001
+        second = schedule()
+        self.assertEqual(len(n_graphs), 1)
+        self.assertGreater(second, first)
+        torch.testing.assert_close(second, self.model._regulariser_loss_weight_schedule())
+        torch._dynamo.reset()
+
+    def test_extra_logs_are_averaged(self):
+        model = Funnel_T5_VAE_Model(tiny_config(use_extra_logs=True)).train()
+        model.global_step = 1000
+        ces = []
+        for _ in range(3):
+            ces.append(model(input_ids=self.input_ids, labels=self.input_ids).decoder_ce.item())
+        logs = model.get_latest_logs()
+        self.assertAlmostEqual(logs["decoder_ce"], sum(ces) / 3, places=5)
+        self.assertIsInstance(logs["reg_loss_w"], float)
+        self.assertEqual(model.get_latest_logs(), {})
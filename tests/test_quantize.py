@@ -0,0 +1,80 @@
+import tempfile
+import unittest
+import torch
+
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.quantize import (
+    QuantizedCachedProjection, quantize_model, save_quantized, load_quantized, is_quantized_checkpoint, parity_report, nnqd
+)
+from tests.test_model import tiny_config
+
+
+class CharTokenizer:
+    '''
+        Maps characters to ids in the tiny model's vocab, padding with 0.
+    '''
+    def __call__(self, texts, max_length, padding=False, **kwargs):
+        token_ids = [[1 + ord(c) % 49 for c in text[:max_length]] for text in texts]
+        if padding != "max_length":
+            return {"input_ids": token_ids}
+        input_ids = torch.zeros((len(texts), max_length), dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return {"input_ids": input_ids}
+
+
+class QuantizeTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = Funnel_T5_VAE_Model(tiny_config(vae_decoder_model="t5_norm")).eval()
+        self.input_ids = torch.randint(1, 50, (3, 8))
+
+    def test_quantized_modules(self):
+        quantized = quantize_model(self.model)
+        self.assertIsInstance(quantized.lm_head, nnqd.Linear)
+        self.assertIsInstance(quantized.vae.encoder.token_to_latent, nnqd.Linear)
+        self.assertIsInstance(quantized.vae.decoder.latent_to_token, nnqd.Linear)
+        self.assertIsInstance(quantized.vae.decoder.norm.DenseReluDense.wi, nnqd.Linear)
+        self.assertIsInstance(quantized.encoder.blocks[0][0].attention.q_head, nnqd.Linear)
+        self.assertIsInstance(quantized.decoder.block[0].layer[0].SelfAttention.q, nnqd.Linear)
+        self.assertIsInstance(quantized.decoder.block[0].layer[1].EncDecAttention.k, QuantizedCachedProjection)
+        self.assertIsInstance(quantized.shared_embedding, torch.nn.Embedding)
+        # the original model is unchanged
+        self.assertIsInstance(self.model.lm_head, torch.nn.Linear)
+        with torch.no_grad():
+            expected = self.model(input_ids=self.input_ids, labels=self.input_ids)
+            outputs = quantized(input_ids=self.input_ids, labels=self.input_ids)
+        self.assertGreater(torch.nn.functional.cosine_similarity(outputs.latent, expected.latent, dim=-1).min(), 0.99)
+        self.assertLess((outputs.logits - expected.logits).abs().max(), 0.5)
+
+    def test_save_and_load(self):
+        quantized = quantize_model(self.model)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_quantized(quantized, tmp_dir)
+            self.assertTrue(is_quantized_checkpoint(tmp_dir))
+            loaded = load_quantized(tmp_dir)
+        with torch.no_grad():
+            expected = quantized(input_ids=self.input_ids, labels=self.input_ids)
+            outputs = loaded(input_ids=self.input_ids, labels=self.input_ids)
+        self.assertTrue(outputs.logits.equal(expected.logits))
+        self.assertTrue(outputs.latent.equal(expected.latent))
+
+    def test_parity_report(self):
+        texts = ["abc", "hello", "x = 1", "", "print(y)"]
+        report = parity_report(self.model, quantize_model(self.model), CharTokenizer(), texts, batch_size=2)
+        self.assertEqual(report["n_texts"], len(texts))
+        self.assertGreater(report["latent_cosine_min"], 0.99)
+        self.assertLess(report["int8_weights_mb"], report["fp32_weights_mb"])
+        for name in ["fp32", "int8"]:
+            for key in ["token_accuracy", "seq_accuracy", "encode_ms_per_batch", "reconstruct_ms_per_batch", "generate_ms_per_batch"]:
+                self.assertIn(f"{name}_{key}", report)
+
+    def test_parity_report_checkpointed_encoder(self):
+        model = Funnel_T5_VAE_Model(tiny_config(vae_decoder_model="t5_norm", gradient_checkpoint_encoder=True)).eval()
+        model.load_state_dict(self.model.state_dict())
+        texts = ["abc", "hello", "x = 1"]
+        report = parity_report(model, quantize_model(model), CharTokenizer(), texts, batch_size=2)
+        expected = parity_report(self.model, quantize_model(self.model), CharTokenizer(), texts, batch_size=2)
+        self.assertEqual(report["n_texts"], len(texts))
+        self.assertEqual(report["fp32_token_accuracy"], expected["fp32_token_accuracy"])
+        self.assertGreater(report["latent_cosine_min"], 0.99)
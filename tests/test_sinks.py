@@ -0,0 +1,66 @@
+import os
+import json
+import tempfile
+import unittest
+import numpy as np
+import torch
+from transformers import TrainerState
+
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.sinks import JsonlSink
+from transformer_vae.trainer_callback import MetricsSinkCallback
+from tests.test_model import tiny_config
+
+
+class JsonlSinkTests(unittest.TestCase):
+    def read(self, tmp_dir):
+        with open(os.path.join(tmp_dir, JsonlSink.file_name)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_writes_records(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sink = JsonlSink(tmp_dir)
+            sink.log({"loss": torch.tensor(0.5), "accuracy": np.float32(0.25)}, 3)
+            sink.log_table("interpolate points", ["Ratio", "Text"], [[0.0, "a"], [1.0, "b"]], 3)
+            sink.log_image("image interpolation", np.ones((2, 4)), 4)
+            sink.flush()
+            records = self.read(tmp_dir)
+            self.assertEqual([record["step"] for record in records], [3, 3, 4])
+            self.assertEqual((records[0]["loss"], records[0]["accuracy"]), (0.5, 0.25))
+            self.assertEqual(records[1]["rows"], [[0.0, "a"], [1.0, "b"]])
+            self.assertTrue(np.array_equal(np.load(os.path.join(tmp_dir, records[2]["path"])), np.ones((2, 4))))
+
+            sink.log({"loss": 1.0}, 5)
+            sink.close()
+            self.assertEqual(self.read(tmp_dir)[-1]["loss"], 1.0)
+            self.assertFalse(sink._thread.is_alive())
+
+    def test_skips_unwritable_records(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sink = JsonlSink(tmp_dir)
+            with self.assertLogs("transformer_vae.sinks", "ERROR"):
+                sink.log({"loss": 0.5}, 1)
+                sink.log({"x": object()}, 2)
+                # can't be saved, like a full disk
+                sink.log_image("missing/image", np.ones((2, 4)), 3)
+                sink.flush()
+            sink.log({"loss": 1.0}, 4)
+            sink.close()
+            self.assertEqual([(record["step"], record["loss"]) for record in self.read(tmp_dir)], [(1, 0.5), (4, 1.0)])
+
+    def test_callback_adds_model_logs(self):
+        model = Funnel_T5_VAE_Model(tiny_config(use_extra_logs=True)).train()
+        model.global_step = 0
+        input_ids = torch.randint(1, 50, (3, 8))
+        model(input_ids=input_ids, labels=input_ids)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sink = JsonlSink(tmp_dir)
+            callback = MetricsSinkCallback(sink)
+            state = TrainerState(global_step=2)
+            callback.on_log(None, state, None, model=model, logs={"loss": 1.5})
+            callback.on_train_end(None, state, None)
+            record = self.read(tmp_dir)[0]
+            sink.close()
+        self.assertEqual(record["step"], 2)
+        self.assertEqual(record["loss"], 1.5)
+        self.assertIn("decoder_ce", record)
@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+
+from transformer_vae.sklearn import CLASSIFIERS, Dataset, TorchLinearProbe, train_classifier, train_test_split, un_batch
+
+
+class ClassifierTests(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        # 3 well separated classes
+        self.class_label = np.random.randint(0, 3, 300)
+        self.latent = np.random.randn(300, 8).astype(np.float32) * 0.3
+        self.latent[np.arange(300), self.class_label] += 3
+
+    def test_classifiers(self):
+        dataset = Dataset(self.latent, self.class_label)
+        for name in CLASSIFIERS:
+            log = train_classifier(dataset, name)
+            self.assertGreater(log[f"{name}_classification_test_accuracy"], 0.95, name)
+            self.assertGreaterEqual(log[f"{name}_classification_fit_time"], 0)
+            self.assertGreaterEqual(log[f"{name}_classification_predict_time"], 0)
+            self.assertIn("random_classification_test_accuracy", log)
+
+    def test_torch_probe_keeps_class_labels(self):
+        class_label = np.array([5, 7, 9])[self.class_label]
+        predicted = TorchLinearProbe().fit(self.latent, class_label).predict(self.latent)
+        self.assertEqual(set(predicted.tolist()), {5, 7, 9})
+        self.assertGreater((predicted == class_label).mean(), 0.95)
+
+    def test_split(self):
+        batches = [(self.latent[i:i + 64], self.class_label[i:i + 64]) for i in range(0, 300, 64)]
+        dataset = un_batch(batches)
+        np.testing.assert_array_equal(dataset.latent, self.latent)
+        np.testing.assert_array_equal(dataset.class_label, self.class_label)
+        train, test = train_test_split(dataset, 0.3)
+        self.assertEqual((len(train.latent), len(test.latent)), (210, 90))
+        self.assertEqual((len(train.class_label), len(test.class_label)), (210, 90))
@@ -0,0 +1,63 @@
+import unittest
+import torch
+
+from transformer_vae.stash import SampleStash
+
+
+class SampleStashTests(unittest.TestCase):
+    def test_allocates_on_first_add(self):
+        stash = SampleStash(4, row_shapes={"hidden": (5, 2)})
+        self.assertEqual(stash.nbytes(), 0)
+        stash.add(latent=torch.randn(2, 3, 4), hidden=torch.randn(2, 5, 2))
+        self.assertEqual(stash.buffers["latent"].shape, (4, 3, 4))
+        self.assertEqual(stash.nbytes(), 4 * 4 * (12 + 10))
+
+    def test_fills_by_samples_not_steps(self):
+        stash = SampleStash(6)
+        values = torch.arange(10.0).view(10, 1)
+        # uneven batches, e.g. the last batch of an epoch
+        self.assertEqual([stash.add(x=batch) for batch in values.split([4, 1, 3, 2])], [False, False, True, False])
+        # rows wrap around, overwriting the oldest ones
+        self.assertEqual(stash.get("cpu")["x"].view(-1).tolist(), [6, 7, 8, 9, 4, 5])
+        self.assertEqual(stash.index, 4)
+        with self.assertRaises(ValueError):
+            stash.add(x=torch.zeros(7, 1))
+
+    def test_pads_shorter_batches(self):
+        stash = SampleStash(2, row_shapes={"input_ids": (4,), "hidden": (4, 2)}, pad_values={"input_ids": 9})
+        stash.add(input_ids=torch.ones(2, 3, dtype=torch.long), hidden=torch.ones(2, 3, 2))
+        stashed = stash.get("cpu")
+        self.assertEqual(stashed["input_ids"].tolist(), [[1, 1, 1, 9]] * 2)
+        self.assertEqual(stashed["hidden"][:, 3].abs().sum(), 0)
+        with self.assertRaises(ValueError):
+            stash.add(input_ids=torch.ones(2, 5, dtype=torch.long), hidden=torch.ones(2, 4, 2))
+
+    def test_empties_for_new_row_shape(self):
+        stash = SampleStash(4, row_shapes={"input_ids": (4,)})
+        stash.add(latent=torch.ones(2, 3, 4), input_ids=torch.ones(2, 3, dtype=torch.long))
+        # e.g. a batch pooled to a different number of latent tokens
+        with self.assertLogs("transformer_vae.stash", "WARNING"):
+            self.assertFalse(stash.add(latent=torch.zeros(2, 2, 4), input_ids=torch.ones(2, 4, dtype=torch.long)))
+        self.assertEqual(stash.buffers["latent"].shape, (4, 2, 4))
+        self.assertEqual(stash.index, 2)
+        self.assertTrue(stash.add(latent=torch.zeros(2, 2, 4), input_ids=torch.ones(2, 2, dtype=torch.long)))
+        self.assertEqual(stash.get("cpu")["latent"].abs().sum(), 0)
+
+    def test_low_precision_storage(self):
+        for dtype in [torch.float16, torch.bfloat16]:
+            stash = SampleStash(2, dtype, offload=True)
+            latent = torch.randn(2, 3, requires_grad=True)
+            stash.add(latent=latent, input_ids=torch.ones(2, 3, dtype=torch.long))
+            self.assertEqual(stash.buffers["latent"].dtype, dtype)
+            self.assertEqual(stash.buffers["input_ids"].dtype, torch.long)
+            stashed = stash.get("cpu")
+            self.assertEqual(stashed["latent"].dtype, torch.float)
+            torch.testing.assert_close(stashed["latent"], latent.detach(), rtol=1e-2, atol=1e-2)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "Needs CUDA.")
+    def test_offload(self):
+        stash = SampleStash(2, device="cuda", offload=True)
+        latent = torch.randn(2, 3, device="cuda")
+        stash.add(latent=latent)
+        self.assertTrue(stash.buffers["latent"].is_pinned())
+        torch.testing.assert_close(stash.get("cuda")["latent"], latent)
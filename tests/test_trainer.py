@@ -0,0 +1,197 @@
+import contextlib
+import tempfile
+import unittest
+import numpy as np
+import torch
+from transformers import default_data_collator, FunnelConfig
+
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.sinks import RecordingSink
+from transformer_vae.train import VAE_TrainingArguments
+from transformer_vae.trainer import VAE_Trainer
+from transformer_vae.utils import slerp
+from tests.test_model import tiny_config
+
+CRITIC = FunnelConfig(vocab_size=50, block_sizes=[1], d_model=16, n_head=2, d_head=8, d_inner=32).to_dict()
+
+
+class IdTokenizer:
+    '''
+        Decodes token ids as space separated numbers.
+    '''
+    pad_token_id = 0
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        return " ".join(str(i) for i in ids.tolist() if not skip_special_tokens or i != self.pad_token_id)
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.decode(ids, **kwargs) for ids in sequences]
+
+
+class TrainerTests(unittest.TestCase):
+    def trainer(self, tmp_dir, config=None, **kwargs):
+        torch.manual_seed(0)
+        args = VAE_TrainingArguments(
+            output_dir=tmp_dir, no_cuda=True, report_to=[], sample_from_latent=True, generate_max_len=5, **kwargs
+        )
+        dataset = [{"input_ids": ids, "labels": ids} for ids in torch.randint(1, 50, (6, 8)).tolist()]
+        return VAE_Trainer(
+            Funnel_T5_VAE_Model(config or tiny_config()), args, metrics_sink=RecordingSink(), eval_dataset=dataset,
+            tokenizer=IdTokenizer(), data_collator=default_data_collator,
+        )
+
+    def test_async_eval_logs_at_original_step(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir, async_latent_eval=True)
+            trainer.state.global_step = 3
+            trainer.evaluate()
+            trainer.state.global_step = 7
+            trainer.finish_async_evals()
+        tables = [record for record in trainer.metrics_sink.records if record[0] == "log_table"]
+        self.assertEqual(len(tables), 1)
+        _, name, columns, rows, step = tables[0]
+        self.assertEqual((name, step, len(rows)), ("interpolate points", 3, 13))
+        timings = [record[1] for record in trainer.metrics_sink.records if record[0] == "log"]
+        self.assertTrue(any("eval_async_latent_samples_time" in log for log in timings))
+
+    def test_sync_eval(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir, interpolation_pairs=3, interpolation_batch_size=4, seq_check="python")
+            trainer.evaluate()
+        self.assertEqual([record[1] for record in trainer.metrics_sink.records if record[0] == "log_table"], ["interpolate points"])
+        logs = {k: v for record in trainer.metrics_sink.records if record[0] == "log" for k, v in record[1].items()}
+        self.assertGreater(logs["eval_interpolation_seconds_per_point"], 0)
+        self.assertIn("interpolation samples passing seq check", logs)
+        for ratio in ["0.0", "0.5", "1.0"]:
+            self.assertTrue(0 <= logs[f"interpolation pass rate {ratio}"] <= 1)
+
+    def test_latent_with_class(self):
+        # 7 samples in batches of 3, the last batch is smaller
+        dataset = [
+            {"input_ids": ids, "labels": ids, "class_label": i % 2}
+            for i, ids in enumerate(torch.randint(1, 50, (7, 8)).tolist())
+        ]
+        input_ids = torch.tensor([row["input_ids"] for row in dataset])
+        for drop_last, n_rows in [(False, 7), (True, 6)]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                trainer = self.trainer(tmp_dir, per_device_eval_batch_size=3, dataloader_drop_last=drop_last)
+                # as run by `evaluate`
+                with torch.no_grad():
+                    trainer.model.eval()
+                    latents, class_labels = trainer._latent_with_class(dataset)
+            with torch.no_grad():
+                expected = trainer.model(input_ids=input_ids[:n_rows]).latent.reshape(n_rows, -1)
+            self.assertEqual(latents.dtype, np.float32)
+            torch.testing.assert_close(torch.from_numpy(latents), expected)
+            self.assertEqual(class_labels.tolist(), [i % 2 for i in range(n_rows)])
+        logs = [record[1] for record in trainer.metrics_sink.records if record[0] == "log"]
+        self.assertTrue(any("eval_latent_encode_time" in log for log in logs))
+
+    def test_random_interpolation_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir)
+        latent = torch.randn(4, 3, 8)
+        interpolated, ratios = trainer.random_interpolation_inputs(latent)
+        self.assertEqual(interpolated.shape, latent.shape)
+        self.assertTrue(((ratios >= 0) & (ratios <= 0.5)).all())
+        torch.testing.assert_close(interpolated[0], slerp(ratios[0].expand(3), latent[0], latent[3]))
+
+    def test_interpolation_decoding(self):
+        input_ids = torch.randint(1, 50, (4, 8))
+        input_ids[0, 6:] = 0
+        for decoding in ["generate", "nearest", "refine"]:
+            for kwargs, config in [({"cycle_loss": True}, tiny_config()), ({}, tiny_config(critic_name="tiny", critic=CRITIC))]:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    trainer = self.trainer(
+                        tmp_dir, config, interpolation_decoding=decoding, per_device_train_batch_size=4, min_critic_steps=0, **kwargs
+                    )
+                model = trainer.model.train()
+                model.config.use_extra_logs = True
+                for step in range(2):
+                    trainer.state.global_step = model.global_step = step
+                    trainer.training_step(model, {"input_ids": input_ids, "labels": input_ids})
+                logs = model.get_latest_logs()
+                self.assertIn("cycle_loss" if kwargs else "critic_loss", logs)
+                stashed = trainer.sample_stash.get("cpu")
+                decoder_input_ids = trainer._interpolation_decoder_input_ids(stashed["latent"], stashed["input_ids"], model)
+                self.assertEqual(decoder_input_ids.shape, input_ids.shape)
+                if decoding == "nearest":
+                    self.assertTrue(decoder_input_ids.equal(model._shift_right(input_ids)))
+                elif decoding == "refine":
+                    # refinements keep the nearest sample's padding
+                    self.assertTrue(decoder_input_ids[0, 7:].eq(0).all())
+
+    def test_stash_empties_for_fewer_latent_tokens(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(
+                tmp_dir, tiny_config(set_seq_size=16, n_latent_tokens=4), cycle_loss=True, per_device_train_batch_size=2,
+                interpolate_training_step_rate=2
+            )
+        model = trainer.model.train()
+        # the short batch is pooled to 2 latent tokens
+        for step, seq_len in enumerate([16, 4]):
+            input_ids = torch.randint(1, 50, (2, seq_len))
+            trainer.state.global_step = model.global_step = step
+            with self.assertLogs("transformer_vae.stash", "WARNING") if step else contextlib.nullcontext():
+                trainer.training_step(model, {"input_ids": input_ids, "labels": input_ids})
+        # only holds the short batch, so it isn't full yet
+        self.assertEqual(trainer.sample_stash.buffers["latent"].shape, (4, 2, 4))
+        self.assertEqual(trainer.sample_stash.index, 2)
+
+    def test_sortish_sampler_rejects_interpolation_losses(self):
+        critic_config = tiny_config(critic_name="tiny", critic=CRITIC)
+        for kwargs, config in [({"cycle_loss": True}, None), ({"vae_cycle_loss": True}, None), ({}, critic_config)]:
+            with tempfile.TemporaryDirectory() as tmp_dir, self.assertRaises(ValueError):
+                self.trainer(tmp_dir, config, sortish_sampler=True, **kwargs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.trainer(tmp_dir, sortish_sampler=True)
+
+    def test_no_stash_without_interpolation_losses(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir)
+        input_ids = torch.randint(1, 50, (4, 8))
+        trainer.training_step(trainer.model, {"input_ids": input_ids, "labels": input_ids})
+        self.assertIsNone(trainer.sample_stash)
+
+    def test_batched_critic_matches_separate_calls(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir, tiny_config(critic_name="tiny", critic=CRITIC), min_critic_steps=0)
+        model = trainer.model.eval()
+        model.global_step, trainer.state.global_step = 1, 1
+        decoder = torch.nn.Linear(16, 16)
+        real, inputs, ratios = torch.randn(4, 8, 16), torch.randn(4, 8, 16), torch.rand(4) / 2
+
+        def gradients():
+            grads = [p.grad.clone() for p in list(model.critic.parameters()) + list(decoder.parameters()) if p.grad is not None]
+            model.zero_grad()
+            decoder.zero_grad()
+            return grads
+
+        # previous separate critic calls
+        interpolated = decoder(inputs)
+        critic_loss_on_model = model.critic(interpolated).mean() / 4
+        interpolated.backward(torch.autograd.grad(critic_loss_on_model, interpolated, retain_graph=True))
+        critic_loss = model.critic(real, torch.zeros(4, 1)) + model.critic(interpolated.detach(), ratios.view(-1, 1))
+        (critic_loss / 8).backward()
+        expected = gradients()
+
+        trainer._critic_step(real, decoder(inputs), ratios, model)
+        grads = gradients()
+        self.assertEqual(len(grads), len(expected))
+        for grad, expected_grad in zip(grads, expected):
+            torch.testing.assert_close(grad, expected_grad)
+        self.assertEqual(model.get_latest_logs().keys(), {"critic_loss_on_model", "critic_loss"})
+
+    def test_critic_time_share(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trainer = self.trainer(tmp_dir, tiny_config(critic_name="tiny", critic=CRITIC, critic_num_layers=1), per_device_train_batch_size=4)
+            input_ids = torch.randint(1, 50, (4, 8))
+            trainer.state.global_step = 1
+            trainer.training_step(trainer.model, {"input_ids": input_ids, "labels": input_ids})
+            trainer.log({"loss": 1.0})
+        self.assertEqual(trainer.model.config.critic.block_sizes, [1])
+        mask = trainer.model.critic._attention_mask
+        self.assertEqual(mask.shape, (8, 8))
+        self.assertIs(trainer.model.critic.attention_mask(torch.zeros(8, 8, 16)), mask)
+        logs = [record[1] for record in trainer.metrics_sink.records if record[0] == "log"]
+        self.assertTrue(0 < logs[-1]["train_critic_time_share"] < 1)
@@ -0,0 +1,81 @@
+import math
+import unittest
+import torch
+
+from transformer_vae.utils import slerp, slerp_endpoints, slerp_from_endpoints, tensors_to_floats
+
+
+class SlerpTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.start, self.end = torch.randn(11, 16), torch.randn(11, 16)
+        self.ratios = torch.linspace(0, 1, 11)
+
+    @unittest.skipUnless(hasattr(torch, "autocast"), "Needs torch.autocast.")
+    def test_bf16_autocast_runs_in_fp32(self):
+        expected = slerp(self.ratios, self.start, self.end)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            outputs = slerp(self.ratios, self.start, self.end)
+            bf16_outputs = slerp(self.ratios, self.start.bfloat16(), self.end.bfloat16())
+        self.assertEqual(outputs.dtype, torch.float32)
+        torch.testing.assert_close(outputs, expected)
+        self.assertEqual(bf16_outputs.dtype, torch.bfloat16)
+        torch.testing.assert_close(bf16_outputs.float(), expected, rtol=2e-2, atol=2e-2)
+
+
+    def reference_slerp(self, ratio, t1, t2):
+        omega = math.acos(float(torch.dot(t1 / t1.norm(), t2 / t2.norm())))
+        return (math.sin((1 - ratio) * omega) * t1 + math.sin(ratio * omega) * t2) / math.sin(omega)
+
+    def test_matches_formula(self):
+        outputs = slerp(self.ratios, self.start, self.end)
+        for i, ratio in enumerate(self.ratios.tolist()):
+            torch.testing.assert_close(outputs[i], self.reference_slerp(ratio, self.start[i], self.end[i]))
+
+    def test_end_points(self):
+        for seed in range(10):
+            torch.manual_seed(seed)
+            start, end = torch.randn(4, 8) * 3, torch.randn(4, 8) * 3
+            torch.testing.assert_close(slerp(0.0, start, end), start)
+            torch.testing.assert_close(slerp(1.0, start, end), end)
+
+    def test_unit_vectors_stay_on_the_sphere(self):
+        for seed in range(10):
+            torch.manual_seed(seed)
+            start = torch.nn.functional.normalize(torch.randn(32, 16), dim=-1)
+            end = torch.nn.functional.normalize(torch.randn(32, 16), dim=-1)
+            norms = slerp(torch.rand(32), start, end).norm(dim=-1)
+            torch.testing.assert_close(norms, torch.ones(32))
+
+    def test_parallel_vectors_use_lerp(self):
+        start = torch.randn(3, 16)
+        for end in [start.clone(), start * 2, -start, start + 1e-6]:
+            start_, end_ = start.clone().requires_grad_(), end.clone().requires_grad_()
+            outputs = slerp(self.ratios[:3], start_, end_)
+            self.assertTrue(torch.isfinite(outputs).all())
+            lerp = start + self.ratios[:3, None] * (end - start)
+            torch.testing.assert_close(outputs, lerp, rtol=1e-3, atol=1e-3)
+            outputs.sum().backward()
+            self.assertTrue(torch.isfinite(start_.grad).all() and torch.isfinite(end_.grad).all())
+        zeros = slerp(self.ratios, torch.zeros(11, 16), self.end)
+        self.assertTrue(torch.isfinite(zeros).all())
+
+    def test_broadcast_ratios_over_pairs(self):
+        endpoints = slerp_endpoints(self.start, self.end)
+        grid = slerp_from_endpoints(self.ratios.view(-1, 1), endpoints)
+        self.assertEqual(grid.shape, (11, 11, 16))
+        for i, ratio in enumerate(self.ratios):
+            torch.testing.assert_close(grid[i], slerp(ratio, self.start, self.end))
+        # per token ratios
+        start, end = torch.randn(5, 3, 16), torch.randn(5, 3, 16)
+        ratios = torch.rand(5)
+        outputs = slerp(ratios.view(5, 1), start, end)
+        for i in range(5):
+            torch.testing.assert_close(outputs[i], slerp(ratios[i].expand(3), start[i], end[i]))
+
+
+class TensorsToFloatsTests(unittest.TestCase):
+    def test_mixed_values(self):
+        values = {"a": torch.tensor(1.5), "b": 2, "c": torch.tensor([0.25]), "d": torch.tensor(3, dtype=torch.long)}
+        self.assertEqual(tensors_to_floats(values), {"a": 1.5, "b": 2.0, "c": 0.25, "d": 3.0})
+        self.assertEqual(list(tensors_to_floats(values)), ["a", "b", "c", "d"])
@@ -4,6 +4,7 @@ from torch import nn
 from transformers.models.t5.modeling_t5 import T5LayerFF
 
 from transformer_vae.model_outputs import BaseVAE_Output
+from transformer_vae.utils import autocast_disabled
 
 logger = logging.get_logger()
 
@@ -77,19 +78,35 @@ VAE_DECODER_MODELS = {
 }
 
 
+MMD_KERNELS = ["", "matmul"]
+
+
 class EncoderDecoderVAE(nn.Module):
     """
     An MMD-VAE used with encoder-decoder models.
     Encodes all token encodings into a single latent & spits them back out.
+
+    `mmd_kernel` picks how the MMD kernel is computed:
+    - "" tiles both inputs into a (x_size, y_size, dim) tensor.
+    - "matmul" gets squared distances with `|x|^2 + |y|^2 - 2xy`, never holding more than (x_size, y_size) values.
+        Set `mmd_chunk_size` to also split the rows of `x` into blocks of that size.
+
+    `mmd_estimator` picks how MMD is estimated from the kernel, see `MMD_ESTIMATORS`.
     """
 
     batch_size = None
 
-    def __init__(self, encoder, decoder, use_reg_loss=True):
+    def __init__(
+        self, encoder, decoder, use_reg_loss=True, mmd_kernel="", mmd_chunk_size=0, mmd_estimator="", mmd_rff_features=512
+    ):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
         self.use_reg_loss = use_reg_loss
+        self.mmd_kernel = mmd_kernel
+        self.mmd_chunk_size = mmd_chunk_size
+        self.mmd_estimator = mmd_estimator
+        self.mmd_rff_features = mmd_rff_features
 
     def _model_forward(self, encoding, latent=None):
         if latent is None:
@@ -125,12 +142,70 @@ class EncoderDecoderVAE(nn.Module):
 
         return torch.exp(-torch.mean((tiled_x - tiled_y) ** 2, dim=2) / dim * 1.0)
 
+    @staticmethod
+    def _compute_matmul_kernel(x, y):
+        '''
+            Same kernel as `_compute_kernel` but only allocates (x_size, y_size) tensors.
+        '''
+        dim = x.shape[1]
+        squared_dist = (x ** 2).sum(1, keepdim=True) + (y ** 2).sum(1) - 2 * x @ y.T
+        # rounding errors can give tiny negative distances
+        return torch.exp(-squared_dist.clamp(min=0) / dim ** 2)
+
+    def _kernel_mean(self, x, y):
+        if self.mmd_kernel == "":
+            return torch.mean(self._compute_kernel(x, y))
+        if not self.mmd_chunk_size:
+            return torch.mean(self._compute_matmul_kernel(x, y))
+        kernel_sum = sum(self._compute_matmul_kernel(x_chunk, y).sum() for x_chunk in x.split(self.mmd_chunk_size))
+        return kernel_sum / (x.shape[0] * y.shape[0])
+
     def _compute_mmd(self, x, y):
-        x_kernel = self._compute_kernel(x, x)
-        y_kernel = self._compute_kernel(y, y)
-        xy_kernel = self._compute_kernel(x, y)
-        return torch.mean(x_kernel) + torch.mean(y_kernel) - 2 * torch.mean(xy_kernel)
+        x_kernel = self._kernel_mean(x, x)
+        y_kernel = self._kernel_mean(y, y)
+        xy_kernel = self._kernel_mean(x, y)
+        return x_kernel + y_kernel - 2 * xy_kernel
+
+    def _compute_rff_mmd(self, x, y):
+        '''
+            Approximates `_compute_mmd` with random Fourier features of the same Gaussian kernel.
+            Kernel means become dot products of mean features so cost is linear in the number of latent codes.
+        '''
+        dim = x.shape[1]
+        # kernel is exp(-|x - y|^2 / dim^2) so frequencies have std sqrt(2) / dim
+        frequencies = torch.randn(dim, self.mmd_rff_features, device=x.device, dtype=x.dtype) * (2 ** 0.5 / dim)
+
+        def mean_features(z):
+            projected = z @ frequencies
+            return torch.cat([torch.cos(projected), torch.sin(projected)], 1).mean(0)
+
+        return ((mean_features(x) - mean_features(y)) ** 2).sum() / self.mmd_rff_features
+
+    @staticmethod
+    def _compute_linear_mmd(x, y):
+        '''
+            Unbiased linear-time MMD estimate (Gretton et al. 2012) using disjoint pairs of samples.
+        '''
+        dim = x.shape[1]
+        n_pairs = min(x.shape[0], y.shape[0]) // 2
+        x1, x2 = x[:2 * n_pairs:2], x[1:2 * n_pairs:2]
+        y1, y2 = y[:2 * n_pairs:2], y[1:2 * n_pairs:2]
+
+        def kernel(a, b):
+            return torch.exp(-((a - b) ** 2).sum(1) / dim ** 2)
+
+        return torch.mean(kernel(x1, x2) + kernel(y1, y2) - kernel(x1, y2) - kernel(x2, y1))
 
     def _regularliser_loss(self, latent):
-        true_samples = torch.randn(latent.size(), device=latent.device)
-        return self._compute_mmd(true_samples, latent)
+        # the kernel exponent & `|x|^2 + |y|^2 - 2xy` distances lose too much precision in bf16
+        with autocast_disabled(latent.device.type):
+            latent = latent.float()
+            true_samples = torch.randn(latent.size(), device=latent.device)
+            return MMD_ESTIMATORS[self.mmd_estimator](self, true_samples, latent)
+
+
+MMD_ESTIMATORS = {
+    "": EncoderDecoderVAE._compute_mmd,
+    "rff": EncoderDecoderVAE._compute_rff_mmd,
+    "linear": lambda vae, x, y: EncoderDecoderVAE._compute_linear_mmd(x, y),
+}
@@ -1,9 +1,14 @@
+import inspect
 import torch
+import torch.utils.checkpoint
 from torch.utils.checkpoint import (
     check_backward_validity, get_device_states, set_device_states, detach_variable
 )
 
 
+NON_REENTRANT_AVAILABLE = "use_reentrant" in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+
 class CheckpointFunction(torch.autograd.Function):
 
     @staticmethod
@@ -71,10 +76,22 @@ class CheckpointFunction(torch.autograd.Function):
 
 
 def checkpoint(function, *args, **kwargs):
+    '''
+        Recompute `function(*args)` in the backward pass instead of storing its activations.
+
+        With `use_reentrant=False` uses PyTorch's non-reentrant checkpointing which also tracks gradients for
+        tensors `function` captures in its closure & supports `torch.autograd.grad`.
+    '''
     preserve = kwargs.pop('preserve_rng_state', True)
+    use_reentrant = kwargs.pop('use_reentrant', True)
     if kwargs:
         raise ValueError("Unexpected keyword arguments: " + ",".join(arg for arg in kwargs))
 
+    if not use_reentrant:
+        if not NON_REENTRANT_AVAILABLE:
+            raise ValueError("Non-reentrant checkpointing needs PyTorch >= 1.11.")
+        return tuple(torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False, preserve_rng_state=preserve))
+
     outputs = CheckpointFunction.apply(function, preserve, *args)
 
     #
@@ -0,0 +1,250 @@
+'''
+    Choose which funnel encoder layers & T5 decoder layers to checkpoint so training activations fit a memory budget.
+
+    One profiling forward pass on a slice of the batch measures the activations each layer saves for the backward pass &
+    how long it takes to run, scaled up to the full batch size.
+    Layers that free the most memory per second of recomputation are checkpointed first until the estimate fits the budget.
+'''
+import time
+import collections
+import torch
+from transformers.utils import logging
+from transformers.models.funnel.modeling_funnel import FunnelLayer
+
+from transformer_vae.checkpoint import checkpoint
+
+
+logger = logging.get_logger(__name__)
+
+MB = 2 ** 20
+
+CheckpointUnit = collections.namedtuple('CheckpointUnit', ['name', 'module', 'activation_bytes', 'input_bytes', 'seconds'])
+
+
+class CheckpointedFunnelLayer(FunnelLayer):
+    '''
+        Funnel layer that recomputes its activations in the backward pass when `use_checkpoint` is set.
+        Swaps the class of an existing layer so parameter names & weights are unchanged.
+    '''
+    use_checkpoint = False
+    use_reentrant = True
+
+    @classmethod
+    def from_layer(cls, layer):
+        layer.__class__ = cls
+        return layer
+
+    def forward(self, query, key, value, attention_inputs, output_attentions=False):
+        if not (self.use_checkpoint and self.training and torch.is_grad_enabled()) or output_attentions:
+            return super().forward(query, key, value, attention_inputs, output_attentions=output_attentions)
+
+        def custom_forward(query, key, value):
+            return FunnelLayer.forward(self, query, key, value, attention_inputs)
+
+        return checkpoint(custom_forward, query, key, value, use_reentrant=self.use_reentrant)
+
+
+class CheckpointPlan:
+    '''
+        The layers chosen for checkpointing with the estimated activation memory & recompute time.
+    '''
+    def __init__(self, units, checkpointed, forward_seconds, memory_budget):
+        self.units = units
+        self.checkpointed = checkpointed
+        self.forward_seconds = forward_seconds
+        self.memory_budget = memory_budget
+
+    @property
+    def activation_bytes(self):
+        return sum(unit.activation_bytes for unit in self.units)
+
+    @property
+    def peak_activation_bytes(self):
+        '''
+            Checkpointed layers keep their inputs, one of them at a time has its activations recomputed in the backward pass.
+        '''
+        kept = sum(unit.input_bytes if unit.name in self.checkpointed else unit.activation_bytes for unit in self.units)
+        recomputed = [unit.activation_bytes for unit in self.units if unit.name in self.checkpointed]
+        return kept + max(recomputed + [0])
+
+    @property
+    def recompute_seconds(self):
+        return sum(unit.seconds for unit in self.units if unit.name in self.checkpointed)
+
+    def logs(self):
+        return {
+            "checkpoint_layers": len(self.checkpointed),
+            "checkpoint_activation_mb": self.activation_bytes / MB,
+            "checkpoint_peak_activation_mb": self.peak_activation_bytes / MB,
+            "checkpoint_recompute_overhead": self.recompute_seconds / max(self.forward_seconds, 1e-9),
+        }
+
+    def summary(self):
+        return (
+            f"Checkpointing {len(self.checkpointed)}/{len(self.units)} layers for a {self.memory_budget}MB budget: "
+            f"estimated layer activations {self.activation_bytes / MB:.1f}MB -> {self.peak_activation_bytes / MB:.1f}MB, "
+            f"recomputing adds {self.recompute_seconds * 1000:.1f}ms "
+            f"({100 * self.recompute_seconds / max(self.forward_seconds, 1e-9):.0f}% of the forward pass). "
+            f"Checkpointed: {', '.join(unit.name for unit in self.units if unit.name in self.checkpointed) or 'none'}."
+        )
+
+
+def checkpoint_units(model):
+    '''
+        Named layers the policy can checkpoint, each funnel encoder layer & each T5 decoder layer.
+    '''
+    units = []
+    for block_index, block in enumerate(model.encoder.blocks):
+        for layer_index, layer in enumerate(block):
+            units.append((f"encoder.blocks.{block_index}.{layer_index}", layer))
+    for layer_index, layer in enumerate(model.decoder.block):
+        units.append((f"decoder.block.{layer_index}", layer))
+    return units
+
+
+def _storage(tensor):
+    '''
+        Storage pointer & size so views of the same activation are only counted once.
+    '''
+    if hasattr(tensor, "untyped_storage"):
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    storage = tensor.storage()
+    return storage.data_ptr(), storage.size() * tensor.element_size()
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _batch_slice(inputs, profile_batch_size):
+    batch_size = next(value for value in inputs.values() if torch.is_tensor(value)).size(0)
+    n_rows = min(batch_size, profile_batch_size)
+    return {
+        name: value[:n_rows] if torch.is_tensor(value) and value.dim() and value.size(0) == batch_size else value
+        for name, value in inputs.items()
+    }, batch_size / n_rows
+
+
+def profile_checkpoint_units(model, inputs, profile_batch_size=1):
+    '''
+        Run one training forward pass (without checkpointing) recording the bytes each layer saves for the backward pass,
+        the size of its input hidden states & its run time.
+        Only the first `profile_batch_size` rows of `inputs` are run so profiling can't run out of memory when the
+        full batch only fits with checkpointing, the results are scaled up to the full batch size.
+    '''
+    if not hasattr(torch.autograd.graph, "saved_tensors_hooks"):
+        raise ValueError("Checkpointing with a memory budget needs PyTorch >= 1.10.")
+    inputs, scale = _batch_slice(inputs, profile_batch_size)
+    device = next(model.parameters()).device
+    parameter_storage = set(_storage(param)[0] for param in model.parameters())
+    units = checkpoint_units(model)
+    stats = {name: {"storage": set(), "activation_bytes": 0, "input_bytes": 0, "seconds": 0.0} for name, _ in units}
+    current = []
+
+    def pack_hook(tensor):
+        if current:
+            ptr, nbytes = _storage(tensor)
+            unit = stats[current[-1]]
+            if ptr not in parameter_storage and ptr not in unit["storage"]:
+                unit["storage"].add(ptr)
+                unit["activation_bytes"] += nbytes
+        return tensor
+
+    def pre_hook(name):
+        def hook(module, args):
+            _synchronize(device)
+            stats[name]["input_bytes"] = max(stats[name]["input_bytes"], args[0].numel() * args[0].element_size())
+            current.append(name)
+            stats[name]["start"] = time.perf_counter()
+        return hook
+
+    def post_hook(name):
+        def hook(module, args, outputs):
+            _synchronize(device)
+            stats[name]["seconds"] += time.perf_counter() - stats[name]["start"]
+            current.pop()
+        return hook
+
+    handles = []
+    for name, module in units:
+        handles.append(module.register_forward_pre_hook(pre_hook(name)))
+        handles.append(module.register_forward_hook(post_hook(name)))
+
+    apply_checkpoint_plan(model, set())
+    use_extra_logs, model.config.use_extra_logs = model.config.use_extra_logs, False
+    was_training = model.training
+    model.train()
+    rng_devices = [device] if device.type == "cuda" else []
+    try:
+        with torch.random.fork_rng(devices=rng_devices), torch.enable_grad():
+            with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+                _synchronize(device)
+                start = time.perf_counter()
+                model(**inputs)
+                _synchronize(device)
+                forward_seconds = time.perf_counter() - start
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.config.use_extra_logs = use_extra_logs
+        model.train(was_training)
+
+    units = [
+        CheckpointUnit(
+            name, module, int(stats[name]["activation_bytes"] * scale), int(stats[name]["input_bytes"] * scale),
+            stats[name]["seconds"] * scale
+        )
+        for name, module in units
+    ]
+    return units, forward_seconds * scale
+
+
+def choose_checkpointed_units(units, forward_seconds, memory_budget):
+    '''
+        Greedily checkpoint the layers freeing the most memory per second of recompute until the estimate fits `memory_budget` (in MB).
+    '''
+    plan = CheckpointPlan(units, set(), forward_seconds, memory_budget)
+    by_value = sorted(
+        units, key=lambda unit: (unit.activation_bytes - unit.input_bytes) / max(unit.seconds, 1e-9), reverse=True
+    )
+    for unit in by_value:
+        if plan.peak_activation_bytes <= memory_budget * MB:
+            break
+        plan.checkpointed.add(unit.name)
+    if plan.peak_activation_bytes > memory_budget * MB:
+        logger.warning(
+            f"Checkpointing every layer still needs an estimated {plan.peak_activation_bytes / MB:.1f}MB of activations, "
+            f"more than the {memory_budget}MB budget."
+        )
+    return plan
+
+
+def apply_checkpoint_plan(model, checkpointed, use_reentrant=True):
+    '''
+        Checkpoint the named layers from `checkpoint_units` in subsequent training forward passes.
+    '''
+    decoder_layers = set()
+    for name, module in checkpoint_units(model):
+        if name.startswith("encoder."):
+            layer = CheckpointedFunnelLayer.from_layer(module)
+            layer.use_checkpoint = name in checkpointed
+            layer.use_reentrant = use_reentrant
+        elif name in checkpointed:
+            decoder_layers.add(int(name.split(".")[-1]))
+    model.decoder.checkpoint_layers = decoder_layers
+    model.decoder.checkpoint_use_reentrant = use_reentrant
+
+
+def plan_checkpointing(model, inputs, memory_budget=None, profile_batch_size=1):
+    '''
+        Profile a slice of a training batch, choose the layers to checkpoint for `memory_budget`
+        (defaults to `config.checkpoint_memory_budget`) & apply the plan to the model.
+    '''
+    memory_budget = memory_budget if memory_budget is not None else model.config.checkpoint_memory_budget
+    units, forward_seconds = profile_checkpoint_units(model, inputs, profile_batch_size)
+    plan = choose_checkpointed_units(units, forward_seconds, memory_budget)
+    apply_checkpoint_plan(model, plan.checkpointed, use_reentrant=not model.config.checkpoint_non_reentrant)
+    logger.info(plan.summary())
+    return plan
@@ -4,7 +4,8 @@ from transformers.utils import logging
 from transformers.configuration_utils import PretrainedConfig
 from transformers import AutoConfig, T5Config, FunnelConfig
 
-from transformer_vae.autoencoders import VAE_ENCODER_MODELS, VAE_DECODER_MODELS
+from transformer_vae.autoencoders import VAE_ENCODER_MODELS, VAE_DECODER_MODELS, MMD_KERNELS, MMD_ESTIMATORS
+from transformer_vae.custom_t5 import ATTENTION_BACKENDS
 from transformer_vae.utils import assertEqual, assertIn
 
 logger = logging.get_logger(__name__)
@@ -22,6 +23,22 @@ def _test_overlap(s, w, o):
     return w - end
 
 
+def shrink_critic_config(config, num_layers):
+    '''
+        Keep the first `num_layers` layers of a Funnel or T5 critic.
+    '''
+    if config.model_type == "funnel":
+        block_sizes = []
+        for block_size in config.block_sizes:
+            if sum(block_sizes) == num_layers:
+                break
+            block_sizes.append(min(block_size, num_layers - sum(block_sizes)))
+        config.block_repeats = config.block_repeats[:len(block_sizes)]
+        config.block_sizes = block_sizes
+    else:
+        config.num_layers = num_layers
+
+
 class Funnel_T5_VAE_Config(PretrainedConfig):
     r"""
     This is the configuration class to store the configuration of :class:`~transformer_vae.T5_VAE_Model`.
@@ -48,19 +65,44 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
             Name of the Transformer model to use as a decoder.
         transformer_critic_name (:obj:`str`, `optional`, defaults to None):
             Name of the Transformer model to use as an advisery on interpolations.
+        critic_num_layers (:obj:`int`, `optional`, defaults to 0):
+            Use a smaller critic with only its first N layers, defaults to all of them.
         *** Training Args ***
         reg_schedule_k (:obj:`float`, `optional`, defaults to 0.0025):
             Multiplied by global_step in a sigmoid, more gradually increase regulariser loss weight.
         reg_schedule_b (:obj:`float`, `optional`, defaults to 6.25):
             Added to global step in sigmoid, further delays increase in regulariser loss weight.
+        mmd_kernel (:obj:`str`, `optional`, defaults to ''):
+            How to compute the MMD kernel, use "matmul" to avoid tiling latent codes into a (N, N, latent_size) tensor.
+        mmd_chunk_size (:obj:`int`, `optional`, defaults to 0):
+            With `mmd_kernel=matmul` compute the kernel in blocks of this many rows, 0 computes it all at once.
+        mmd_estimator (:obj:`str`, `optional`, defaults to ''):
+            How to estimate the MMD regulariser. Defaults to the exact (quadratic) estimate,
+            "rff" uses random Fourier features & "linear" uses the linear-time block estimate.
+        mmd_rff_features (:obj:`int`, `optional`, defaults to 512):
+            Number of random Fourier features used with `mmd_estimator=rff`.
         use_extra_logs (:obj:`bool`, `optional`, defaults to False):
             Store extra logs during each training inference.
-        gradient_checkpoint (:obj:`bool`, `optional`, defaults to False):
-            Checkpoint gradients in the model.
-            Currently just checkpoints after the encoder + VAE
+        gradient_checkpoint_encoder (:obj:`bool`, `optional`, defaults to False):
+            Checkpoint the whole Funnel encoder as one unit.
+        decoder_grad_chk_pnt_rate (:obj:`int`, `optional`, defaults to 0):
+            Checkpoint every T5 decoder layer where `layer_index % decoder_grad_chk_pnt_rate != 0`.
+        checkpoint_memory_budget (:obj:`int`, `optional`, defaults to 0):
+            Activation memory budget in MB for the encoder & decoder layers, a row of the first training batch is profiled
+            to choose which layers to checkpoint. Replaces `gradient_checkpoint_encoder` & `decoder_grad_chk_pnt_rate`.
+        checkpoint_non_reentrant (:obj:`bool`, `optional`, defaults to False):
+            Use PyTorch's non-reentrant checkpointing (needs PyTorch >= 1.11).
         funnel_block_sizes (:obj:`str`, `optional`, defaults to ''):
             Size of each Funnel Encoder block, sequence is halved between each block.
             Example specification: 1_1_1
+        attention_window_size (:obj:`int`, `optional`, defaults to 0):
+            Use banded local self-attention in the decoder, each block of this many tokens only attends to itself &
+            the `attention_window_overlap` tokens before it. Memory scales with `set_seq_size * window` instead of `set_seq_size ** 2`.
+        attention_window_overlap (:obj:`int`, `optional`, defaults to -1):
+            Number of earlier tokens each attention window also attends to, defaults to half the window size.
+        attention_backend (:obj:`str`, `optional`, defaults to ''):
+            How the T5 decoder computes attention, "sdpa" uses `torch.nn.functional.scaled_dot_product_attention`
+            with the relative position bias as an additive mask.
         *** End ***
 
         TODO: Add extra models to condition on the latent
@@ -77,11 +119,16 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
         vae_decoder_model='',
         critic_type='',
         critic_name='',
+        critic_num_layers=0,
         set_seq_size=60,
         decoder_start_token_id=0,
         dont_use_reg_loss=False,
         reg_schedule_k=0.0025,
         reg_schedule_b=6.25,
+        mmd_kernel='',
+        mmd_chunk_size=0,
+        mmd_estimator='',
+        mmd_rff_features=512,
         use_extra_logs=False,
         cache_dir=None,
         n_latent_tokens=5,  # set to -1 for full sequence
@@ -89,14 +136,20 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
         num_decoder_layers=0,
         num_decoder_heads=0,
         attention_window_size=0,
-        attention_window_overlap=0,
+        attention_window_overlap=-1,
         gradient_checkpoint_encoder=False,
         decoder_grad_chk_pnt_rate=0,
+        checkpoint_memory_budget=0,
+        checkpoint_non_reentrant=False,
         skip_upsample=False,
+        attention_backend='',
         **kwargs,
     ):
         assertIn(vae_encoder_model, VAE_ENCODER_MODELS.keys(), "Unexpected VAE encoder.")
         assertIn(vae_decoder_model, VAE_DECODER_MODELS.keys(), "Unexpected VAE decoder.")
+        assertIn(mmd_kernel, MMD_KERNELS, "Unexpected MMD kernel.")
+        assertIn(mmd_estimator, MMD_ESTIMATORS.keys(), "Unexpected MMD estimator.")
+        assertIn(attention_backend, ATTENTION_BACKENDS, "Unexpected attention backend.")
 
         super().__init__(**kwargs)
 
@@ -139,12 +192,16 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
             self.t5 = T5Config(**kwargs.pop('t5'))
         assertEqual(self.funnel.d_model, self.t5.d_model, "Funnel & T5 transformers have different dimensions.")
         self.decoder_grad_chk_pnt_rate = decoder_grad_chk_pnt_rate
+        assert(not checkpoint_memory_budget or not (gradient_checkpoint_encoder or decoder_grad_chk_pnt_rate)), \
+            'Use either `checkpoint_memory_budget` or `gradient_checkpoint_encoder` & `decoder_grad_chk_pnt_rate`.'
+        self.checkpoint_memory_budget = checkpoint_memory_budget
+        self.checkpoint_non_reentrant = checkpoint_non_reentrant
         assert(attention_window_size < set_seq_size), 'Attention window must be smallar than set sequence size.'
         self.attention_window_size = attention_window_size
+        if attention_window_overlap < 0:
+            attention_window_overlap = attention_window_size // 2
         self.attention_window_overlap = attention_window_overlap
-        if attention_window_size:
-            assert(set_seq_size % attention_window_size != 0), 'When doing an alternating attention pattern the sequence size cannot be divisable by the window size as no alternations will be possible.'
-            self.attention_window_overlap = set_seq_size % attention_window_size
+        self.attention_backend = attention_backend
 
         # extra training losses
         self.use_reg_loss = not dont_use_reg_loss
@@ -152,6 +209,10 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
             logger.warning("Regularisation loss is turned off, you are training an Autoencoder (not a VAE).")
         self.reg_schedule_k = reg_schedule_k
         self.reg_schedule_b = reg_schedule_b
+        self.mmd_kernel = mmd_kernel
+        self.mmd_chunk_size = mmd_chunk_size
+        self.mmd_estimator = mmd_estimator
+        self.mmd_rff_features = mmd_rff_features
         self.use_extra_logs = use_extra_logs
 
         # critic model
@@ -162,6 +223,9 @@ class Funnel_T5_VAE_Config(PretrainedConfig):
                 self.critic = AutoConfig.from_pretrained(critic_name, cache_dir=cache_dir)
             else:
                 self.critic = FunnelConfig(**kwargs.pop('critic'))
+            self.critic_num_layers = critic_num_layers
+            if critic_num_layers:
+                shrink_critic_config(self.critic, critic_num_layers)
             assertEqual(self.t5.d_model, self.critic.d_model, "Funnel & T5 transformers have different dimensions.")
 
         # misc
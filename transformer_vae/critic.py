@@ -22,13 +22,22 @@ class Critic(nn.Module):
         self.fc = nn.Linear(config.d_model, 1)
         self.activation = nn.Sigmoid()
         self.loss = nn.MSELoss()
+        self._attention_mask = None
+
+    def attention_mask(self, hidden_state):
+        '''
+            All ones attention mask, reused while the batch shape stays the same.
+        '''
+        mask = self._attention_mask
+        if mask is None or mask.shape != hidden_state.shape[:-1] or mask.device != hidden_state.device:
+            mask = self._attention_mask = torch.ones(hidden_state.shape[:-1], device=hidden_state.device)
+        return mask
 
     def forward(self, hidden_state, targets=None):
-        attention_mask = torch.ones(hidden_state.size()[:-1], device=hidden_state.device)
-        final_hidden = self.critic(hidden_state, attention_mask=attention_mask).last_hidden_state
+        final_hidden = self.critic(hidden_state, attention_mask=self.attention_mask(hidden_state)).last_hidden_state
         score = 0.5 * self.activation(self.fc(final_hidden[:, 0]))
         if targets is not None:
-            return self.loss(score, targets)
+            return self.loss(score.float(), targets)
         return score
 
 
@@ -37,11 +46,10 @@ class CriticMean(Critic):
     Takes the mean of each tokens score instead of encouraging a seq level score.
     """
     def forward(self, hidden_state, targets=None):
-        attention_mask = torch.ones(hidden_state.size()[:-1], device=hidden_state.device)
-        final_hidden = self.critic(hidden_state, attention_mask=attention_mask).last_hidden_state
+        final_hidden = self.critic(hidden_state, attention_mask=self.attention_mask(hidden_state)).last_hidden_state
         score = 0.5 * self.activation(self.fc(final_hidden)).mean(dim=1)
         if targets is not None:
-            return self.loss(score, targets)
+            return self.loss(score.float(), targets)
         return score
 
 
@@ -50,11 +58,10 @@ class CriticMeanNoAct(Critic):
     Takes the mean of each tokens score & doesn't use an activation function.
     """
     def forward(self, hidden_state, targets=None):
-        attention_mask = torch.ones(hidden_state.size()[:-1], device=hidden_state.device)
-        final_hidden = self.critic(hidden_state, attention_mask=attention_mask).last_hidden_state
+        final_hidden = self.critic(hidden_state, attention_mask=self.attention_mask(hidden_state)).last_hidden_state
         score = self.fc(final_hidden).mean(dim=1)
         if targets is not None:
-            return self.loss(score, targets)
+            return self.loss(score.float(), targets)
         return score
 
 
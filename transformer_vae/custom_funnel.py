@@ -0,0 +1,65 @@
+import torch
+from transformers.models.funnel.modeling_funnel import FunnelAttentionStructure
+
+
+class VAE_FunnelAttentionStructure(FunnelAttentionStructure):
+    '''
+        Computes relative positions with Python ints rather than tensor scalars.
+        The positions only depend on the sequence length so this avoids host syncs & graph breaks under `torch.compile`.
+    '''
+    def get_position_embeds(self, seq_len, dtype, device):
+        if self.config.attention_type == "factorized":
+            return super().get_position_embeds(seq_len, dtype, device)
+        d_model = self.config.d_model
+        freq_seq = torch.arange(0, d_model // 2, 1.0, dtype=dtype, device=device)
+        inv_freq = 1 / (10000 ** (freq_seq / (d_model // 2)))
+        # Maximum relative positions for the first input
+        rel_pos_id = torch.arange(-seq_len * 2, seq_len * 2, 1.0, dtype=dtype, device=device)
+        zero_offset = seq_len * 2
+        sinusoid = rel_pos_id[:, None] * inv_freq[None]
+        sin_embed = self.sin_dropout(torch.sin(sinusoid))
+        cos_embed = self.cos_dropout(torch.cos(sinusoid))
+        pos_embed = torch.cat([sin_embed, cos_embed], dim=-1)
+
+        def gather(rel_pos):
+            rel_pos = rel_pos[:, None] + zero_offset
+            return torch.gather(pos_embed, 0, rel_pos.expand(rel_pos.size(0), d_model))
+
+        pos = list(range(seq_len))
+        pooled_pos = pos
+        position_embeds_list = []
+        for block_index in range(0, self.config.num_blocks):
+            position_embeds_pooling = None
+            if block_index > 0:
+                pooled_pos = self.stride_pool_pos_ids(pos, block_index)
+                stride = 2 ** (block_index - 1)
+                position_embeds_pooling = gather(self.relative_pos_ids(pos, stride, device, pooled_pos, shift=2))
+            pos = pooled_pos
+            position_embeds_no_pooling = gather(self.relative_pos_ids(pos, 2 ** block_index, device))
+            position_embeds_list.append([position_embeds_no_pooling, position_embeds_pooling])
+        return position_embeds_list
+
+    def stride_pool_pos_ids(self, pos_ids, block_index):
+        '''
+            `stride_pool_pos` for a list of positions.
+        '''
+        if self.config.separate_cls:
+            pooled_pos_ids = pos_ids[1:-1] if self.config.truncate_seq else pos_ids[1:]
+            return [-(2 ** block_index) + 1] + pooled_pos_ids[::2]
+        return pos_ids[::2]
+
+    def relative_pos_ids(self, pos_ids, stride, device, pooled_pos_ids=None, shift=1):
+        '''
+            `relative_pos` for lists of positions.
+        '''
+        if pooled_pos_ids is None:
+            pooled_pos_ids = pos_ids
+        ref_point = pooled_pos_ids[0] - pos_ids[0]
+        max_dist = ref_point + shift * len(pooled_pos_ids) * stride
+        min_dist = pooled_pos_ids[0] - pos_ids[-1]
+        return torch.arange(max_dist, min_dist - 1, -stride, dtype=torch.long, device=device)
+
+
+def modify_funnel_encoder(encoder):
+    encoder.attention_structure.__class__ = VAE_FunnelAttentionStructure
+    return encoder
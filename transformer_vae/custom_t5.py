@@ -1,26 +1,316 @@
 import torch
+from torch import nn
+from torch.nn import functional as F
 from transformers.utils import logging
 from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
+from transformers.models.t5.modeling_t5 import T5Attention, T5Block, T5Stack
 
 from transformer_vae.checkpoint import checkpoint
+from transformer_vae.utils import tensor_version, autocast_state, assertIn
 
 
 logger = logging.get_logger(__name__)
 
 
-def t5_block_alt(self, config, layer_id):
+class CachedProjection(nn.Linear):
     '''
-        Change methods in existing T5Block instance.
-        Helps getting around init issues.
+        Linear layer that reuses its last output when given the same input tensor while gradients are off.
+
+        Used for the cross-attention keys & values which only change with the upsampled latent encoding.
+        Generating with `past_key_values` already reuses them between steps, this also covers generating without them
+        & repeated teacher-forced passes over the same latents (e.g. `interpolation_decoding refine`).
+        The model clears it after `generate` & on `train()`/`eval()` so it doesn't keep activations alive.
+    '''
+    cache_enabled = True
+    _cache = None
+
+    @classmethod
+    def from_linear(cls, linear):
+        projection = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        projection.weight = linear.weight
+        projection.bias = linear.bias
+        return projection
+
+    def forward(self, input):
+        if not self.cache_enabled or torch.is_grad_enabled():
+            self._cache = None
+            return super().forward(input)
+        # versions change on in-place edits so catch optimizer steps & edited inputs
+        versions = (tensor_version(input), tensor_version(self.weight), autocast_state())
+        if self._cache is None or self._cache[0] is not input or self._cache[1] != versions:
+            self._cache = (input, versions, super().forward(input))
+        return self._cache[2]
+
+
+def cache_cross_attention_projections(stack):
+    for block in stack.block:
+        cross_attention = block.layer[1].EncDecAttention
+        cross_attention.k = CachedProjection.from_linear(cross_attention.k)
+        cross_attention.v = CachedProjection.from_linear(cross_attention.v)
+
+
+def set_cross_attention_cache(stack, enabled):
+    '''
+        Turn caching cross-attention keys & values on/off, also clears the cache.
+    '''
+    for module in stack.modules():
+        if isinstance(module, CachedProjection):
+            module.cache_enabled = enabled
+            module._cache = None
+
+
+ATTENTION_BACKENDS = ["", "sdpa"]
+
+
+class SDPA_T5Attention(T5Attention):
+    '''
+        T5 attention using `torch.nn.functional.scaled_dot_product_attention` with the relative position bias (& attention mask)
+        given as an additive mask, so fused kernels can be used.
+
+        Falls back to the stock T5 attention when attention weights or head masks are needed.
+    '''
+    @classmethod
+    def from_attention(cls, attention):
+        # keeps the existing weights & parameter names
+        attention.__class__ = cls
+        return attention
+
+    def forward(
+        self,
+        hidden_states,
+        mask=None,
+        key_value_states=None,
+        position_bias=None,
+        past_key_value=None,
+        layer_head_mask=None,
+        query_length=None,
+        use_cache=False,
+        output_attentions=False,
+    ):
+        if output_attentions or layer_head_mask is not None:
+            return super().forward(
+                hidden_states, mask, key_value_states, position_bias, past_key_value, layer_head_mask, query_length, use_cache, output_attentions
+            )
+        batch_size, seq_length = hidden_states.shape[:2]
+
+        real_seq_length = seq_length
+        if past_key_value is not None:
+            real_seq_length += past_key_value[0].shape[2] if query_length is None else query_length
+        key_length = real_seq_length if key_value_states is None else key_value_states.shape[1]
+
+        def shape(states):
+            return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+
+        def project(proj_layer, past_state):
+            if key_value_states is None:
+                # self-attn
+                states = shape(proj_layer(hidden_states))
+                return states if past_state is None else torch.cat([past_state, states], dim=2)
+            # cross-attn
+            return shape(proj_layer(key_value_states)) if past_state is None else past_state
+
+        # T5 doesn't scale attention scores, undo the scaling in `scaled_dot_product_attention`
+        query_states = shape(self.q(hidden_states)) * self.key_value_proj_dim ** 0.5
+        key_states = project(self.k, past_key_value[0] if past_key_value is not None else None)
+        value_states = project(self.v, past_key_value[1] if past_key_value is not None else None)
+
+        if position_bias is None:
+            if not self.has_relative_attention_bias:
+                position_bias = torch.zeros(
+                    (1, self.n_heads, real_seq_length, key_length), device=query_states.device, dtype=query_states.dtype
+                )
+            else:
+                position_bias = self.compute_bias(real_seq_length, key_length)
+            if past_key_value is not None:
+                position_bias = position_bias[:, :, -seq_length:, :]
+            if mask is not None:
+                position_bias = position_bias + mask
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=position_bias.to(query_states.dtype),
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        attn_output = self.o(attn_output.transpose(1, 2).reshape(batch_size, -1, self.inner_dim))
+
+        present_key_value_state = (key_states, value_states) if (self.is_decoder and use_cache) else None
+        return (attn_output, present_key_value_state, position_bias)
+
+
+def use_attention_backend(stack, backend):
+    assertIn(backend, ATTENTION_BACKENDS, "Unexpected attention backend.")
+    if backend == "sdpa":
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ValueError("The sdpa attention backend needs PyTorch >= 2.0.")
+        for block in stack.block:
+            SDPA_T5Attention.from_attention(block.layer[0].SelfAttention)
+            if len(block.layer) > 2:
+                SDPA_T5Attention.from_attention(block.layer[1].EncDecAttention)
+    return stack
+
+
+class LocalT5Attention(SDPA_T5Attention):
+    '''
+        Banded local self-attention for the T5 decoder.
+
+        Queries are split into blocks of `window_size` tokens, each block attends to itself & the `window_overlap` tokens before it
+        (causally) so information passes between blocks while memory scales with `seq_len * (window_size + window_overlap)`.
+
+        The relative position bias is the same for every block so it is computed once for a block & shared between layers.
+        Expects a key padding mask of shape (batch_size, 1, 1, key_length) rather than a full (query_length, key_length) mask.
+    '''
+    window_size = None
+    window_overlap = None
+    use_sdpa = False
+
+    @classmethod
+    def from_attention(cls, attention, window_size, window_overlap):
+        assert attention.is_decoder, "Local attention is causal, only use it in the decoder."
+        use_sdpa = isinstance(attention, SDPA_T5Attention)
+        attention = super().from_attention(attention)
+        attention.window_size, attention.window_overlap, attention.use_sdpa = window_size, window_overlap, use_sdpa
+        return attention
+
+    def _relative_bias(self, relative_position, dtype, device):
+        if not self.has_relative_attention_bias:
+            return torch.zeros((1, self.n_heads) + relative_position.shape, dtype=dtype, device=device)
+        buckets = self._relative_position_bucket(
+            relative_position, bidirectional=(not self.is_decoder), num_buckets=self.relative_attention_num_buckets
+        )
+        values = self.relative_attention_bias(buckets.to(self.relative_attention_bias.weight.device))
+        return values.permute([2, 0, 1]).unsqueeze(0).to(dtype)
+
+    def _block_position_bias(self, n_blocks, dtype, device):
+        '''
+            Position bias & band mask for every block, shape (1, n_heads, n_blocks, window_size, window_size + window_overlap).
+        '''
+        context_position = torch.arange(self.window_size, dtype=torch.long, device=device)[:, None] + self.window_overlap
+        memory_position = torch.arange(self.window_size + self.window_overlap, dtype=torch.long, device=device)[None, :]
+        bias = self._relative_bias(memory_position - context_position, dtype, device).unsqueeze(2)
+        # causal & don't attend to the padding before the first block
+        block_start = torch.arange(n_blocks, device=device)[:, None, None] * self.window_size - self.window_overlap
+        allowed = (memory_position <= context_position) & (block_start + memory_position >= 0)
+        return bias + (~allowed).to(dtype) * -10000.0
+
+    def _dense_position_bias(self, query_start, key_length, dtype, device):
+        '''
+            Position bias & band mask for queries from `query_start`, used when decoding with past keys & values.
+        '''
+        context_position = torch.arange(query_start, key_length, dtype=torch.long, device=device)[:, None]
+        memory_position = torch.arange(key_length, dtype=torch.long, device=device)[None, :]
+        bias = self._relative_bias(memory_position - context_position, dtype, device)
+        window_start = (context_position // self.window_size) * self.window_size - self.window_overlap
+        allowed = (memory_position <= context_position) & (memory_position >= window_start)
+        return bias + (~allowed).to(dtype) * -10000.0
+
+    def _blocks(self, states, n_blocks, pad_value=0.0):
+        '''
+            (..., seq_len, d) -> (..., n_blocks, window_size + window_overlap, d) sliding blocks of keys or values.
+        '''
+        pad_end = n_blocks * self.window_size - states.size(-2)
+        states = F.pad(states, (0, 0, self.window_overlap, pad_end), value=pad_value)
+        return states.unfold(-2, self.window_size + self.window_overlap, self.window_size).transpose(-1, -2)
+
+    def forward(
+        self,
+        hidden_states,
+        mask=None,
+        key_value_states=None,
+        position_bias=None,
+        past_key_value=None,
+        layer_head_mask=None,
+        query_length=None,
+        use_cache=False,
+        output_attentions=False,
+    ):
+        assert key_value_states is None, "Local attention is only for self-attention."
+        attention = SDPA_T5Attention if self.use_sdpa else T5Attention
+        batch_size, seq_length = hidden_states.shape[:2]
+        if past_key_value is not None:
+            # decoding a few new tokens, attend to their windows in the past keys
+            if position_bias is None:
+                key_length = past_key_value[0].shape[2] + seq_length
+                position_bias = self._dense_position_bias(
+                    key_length - seq_length, key_length, hidden_states.dtype, hidden_states.device
+                )
+                if mask is not None:
+                    position_bias = position_bias + mask
+            return attention.forward(
+                self, hidden_states, None, None, position_bias, past_key_value, layer_head_mask, query_length, use_cache, output_attentions
+            )
+
+        n_blocks = -(-seq_length // self.window_size)
+        padded_length = n_blocks * self.window_size
+
+        def shape(states):
+            return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+
+        query_states, key_states, value_states = shape(self.q(hidden_states)), shape(self.k(hidden_states)), shape(self.v(hidden_states))
+        # (batch_size, n_heads, n_blocks, window_size, dim_per_head)
+        query_blocks = F.pad(query_states, (0, 0, 0, padded_length - seq_length)).view(
+            batch_size, self.n_heads, n_blocks, self.window_size, self.key_value_proj_dim
+        )
+        # (batch_size, n_heads, n_blocks, window_size + window_overlap, dim_per_head)
+        key_blocks, value_blocks = self._blocks(key_states, n_blocks), self._blocks(value_states, n_blocks)
+
+        if position_bias is None:
+            position_bias = self._block_position_bias(n_blocks, query_states.dtype, query_states.device)
+            if mask is not None:
+                assert mask.size(2) == 1, "Local attention expects a key padding mask."
+                # (batch_size, 1, n_blocks, 1, window_size + window_overlap)
+                position_bias = position_bias + self._blocks(mask[:, :, 0].unsqueeze(-1), n_blocks).transpose(-1, -2)
+
+        if self.use_sdpa and not output_attentions and layer_head_mask is None:
+            # T5 doesn't scale attention scores, undo the scaling in `scaled_dot_product_attention`
+            attn_output = F.scaled_dot_product_attention(
+                query_blocks * self.key_value_proj_dim ** 0.5,
+                key_blocks,
+                value_blocks,
+                attn_mask=position_bias.to(query_blocks.dtype),
+                dropout_p=self.dropout if self.training else 0.0,
+            )
+            attn_weights = None
+        else:
+            scores = torch.matmul(query_blocks, key_blocks.transpose(-1, -2)) + position_bias
+            attn_weights = F.softmax(scores.float(), dim=-1).type_as(scores)
+            attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
+            if layer_head_mask is not None:
+                attn_weights = attn_weights * layer_head_mask.view(1, -1, 1, 1, 1)
+            attn_output = torch.matmul(attn_weights, value_blocks)
+
+        attn_output = attn_output.reshape(batch_size, self.n_heads, padded_length, self.key_value_proj_dim)[:, :, :seq_length]
+        attn_output = self.o(attn_output.transpose(1, 2).reshape(batch_size, seq_length, self.inner_dim))
+
+        present_key_value_state = (key_states, value_states) if use_cache else None
+        outputs = (attn_output, present_key_value_state, position_bias)
+        if output_attentions:
+            # attention weights are per block, (batch_size, n_heads, n_blocks, window_size, window_size + window_overlap)
+            outputs = outputs + (attn_weights,)
+        return outputs
+
+
+def use_local_attention(stack, window_size, window_overlap):
+    for block in stack.block:
+        LocalT5Attention.from_attention(block.layer[0].SelfAttention, window_size, window_overlap)
+    return stack
+
+
+def clamp_fp16(hidden_states):
+    # clamp inf values to enable fp16 training, checks the dtype rather than the values to avoid a host sync
+    if hidden_states.dtype == torch.float16:
+        clamp_value = torch.finfo(hidden_states.dtype).max - 1000
+        hidden_states = torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+    return hidden_states
+
+
+class VAE_T5Block(T5Block):
+    '''
+        `T5Block` without data-dependent branches so it runs without host syncs & compiles into a single graph.
     '''
-    self.layer_id = layer_id
-    self.d_model = config.t5.d_model
-    self.window_size = config.attention_window_size
-    self.window_overlap = config.attention_window_overlap
-    self.odd_layer = layer_id % 1 == 1
-    self.true_forward = self.forward
-
-    def alt_forward(
+    def forward(
+        self,
         hidden_states,
         attention_mask=None,
         position_bias=None,
@@ -34,64 +324,55 @@ def t5_block_alt(self, config, layer_id):
         output_attentions=False,
         return_dict=True,
     ):
-        if self.window_size:
-            # split inputs into windows and run as a larger batch
-            # hidden_states (batch_size, seq_len, d_model) -> (batch_size * ?, window_len, d_model)
-            seq_len = hidden_states.size(1)
-            if self.odd_layer:
-                if seq_len < self.window_overlap:
-                    # skip if not yet in Odd window range
-                    return (hidden_states,)
-                using_hidden_states, leftover_hidden_states = hidden_states[:, self.window_overlap:], hidden_states[:, :self.window_overlap]
-            else:
-                if seq_len < self.window_overlap:
-                    using_hidden_states = hidden_states, leftover_hidden_states = None
-                else:
-                    using_hidden_states, leftover_hidden_states = hidden_states[:, :-self.window_overlap], hidden_states[:, -self.window_overlap:]
-            # convert to larger batches of shorter sequences
-            using_hidden_states = using_hidden_states.reshape(-1, min(self.window_size, seq_len), self.d_model)
-
-        outputs = self.true_forward(
-            using_hidden_states,
-            attention_mask,
-            position_bias,
-            encoder_hidden_states,
-            encoder_attention_mask,
-            encoder_decoder_position_bias,
-            layer_head_mask,
-            encoder_layer_head_mask,
-            past_key_value,
-            use_cache,
-            output_attentions,
-            return_dict,
+        if past_key_value is not None:
+            self_attn_past_key_value, cross_attn_past_key_value = past_key_value[:2], past_key_value[2:]
+        else:
+            self_attn_past_key_value, cross_attn_past_key_value = None, None
+
+        self_attention_outputs = self.layer[0](
+            hidden_states,
+            attention_mask=attention_mask,
+            position_bias=position_bias,
+            layer_head_mask=layer_head_mask,
+            past_key_value=self_attn_past_key_value,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
         )
+        hidden_states, present_key_value_state = self_attention_outputs[:2]
+        hidden_states = clamp_fp16(hidden_states)
+        # Keep self-attention outputs and relative position weights
+        attention_outputs = self_attention_outputs[2:]
+
+        if self.is_decoder and encoder_hidden_states is not None:
+            # the actual query length is unknown for cross attention if using past key value states
+            query_length = present_key_value_state[0].shape[2] if present_key_value_state is not None else None
+            cross_attention_outputs = self.layer[1](
+                hidden_states,
+                key_value_states=encoder_hidden_states,
+                attention_mask=encoder_attention_mask,
+                position_bias=encoder_decoder_position_bias,
+                layer_head_mask=encoder_layer_head_mask,
+                past_key_value=cross_attn_past_key_value,
+                query_length=query_length,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+            )
+            hidden_states = clamp_fp16(cross_attention_outputs[0])
+            if present_key_value_state is not None:
+                present_key_value_state = present_key_value_state + cross_attention_outputs[1]
+            attention_outputs = attention_outputs + cross_attention_outputs[2:]
 
-        if self.window_size:
-            # concat leftover hidden state
-            batch_size = hidden_states.size(0)
-            new_hidden_states = outputs[0].reshape(batch_size, -1, self.d_model)
-            if leftover_hidden_states is not None:
-                paired_states = (leftover_hidden_states, new_hidden_states) if self.odd_layer else (new_hidden_states, leftover_hidden_states)
-                new_hidden_states = torch.cat(paired_states, 1)
-            return (new_hidden_states,) + outputs[1:]
-
-        return outputs
-
-    self.forward = alt_forward
-    return self
+        hidden_states = clamp_fp16(self.layer[-1](hidden_states))
+        return (hidden_states, present_key_value_state) + attention_outputs
 
 
-def modify_t5_stack(self, config):
-    self.window_mode = False
-    if config.attention_window_size:
-        self.window_mode = True
-        self.window_size = config.attention_window_size
-        self.window_overlap = config.attention_window_overlap
-        self.windows_per_sample = self.set_seq_size // self.window_size
-        for i, v in enumerate(self.block):
-            self.block[i] = t5_block_alt(v, config, i)
-
-    def alt_forward(
+class VAE_T5Stack(T5Stack):
+    '''
+        T5 decoder stack that can checkpoint a chosen set of layers & use banded local self-attention.
+        `modify_t5_stack` converts a `T5Stack` into this class so its parameters are unchanged.
+    '''
+    def forward(
+        self,
         input_ids=None,
         attention_mask=None,
         encoder_hidden_states=None,
@@ -111,8 +392,14 @@ def modify_t5_stack(self, config):
             torch.cuda.set_device(self.first_device)
             self.embed_tokens = self.embed_tokens.to(self.first_device)
         use_cache = use_cache if use_cache is not None else self.config.use_cache
+        checkpoint_layers = self.checkpoint_layers
+        if grad_chk_pnt_rate:
+            checkpoint_layers = set(i for i in range(len(self.block)) if i % grad_chk_pnt_rate != 0)
+        # checkpointing is skipped when not tracking gradients (e.g. generating during training)
+        if not (self.training and torch.is_grad_enabled()):
+            checkpoint_layers = set()
         if self.training and use_cache:
-            assert(grad_chk_pnt_rate is None), "Can't use grad checkpoint and cache."
+            assert(not checkpoint_layers), "Can't use grad checkpoint and cache."
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -137,21 +424,6 @@ def modify_t5_stack(self, config):
             assert self.embed_tokens is not None, "You have to initialize the model with valid token embeddings"
             inputs_embeds = self.embed_tokens(input_ids)
 
-        ### CHANGE BELOW
-
-        if self.window_mode:
-            # set input shape to window size to format attention masks correctly
-            batch_size, seq_length = input_shape
-            new_batch_size = batch_size * self.windows_per_sample
-            input_shape = (new_batch_size, min(seq_length, self.window_size))
-            if encoder_hidden_states is not None:
-                # match window batches
-                # Get duplicated encodings together with indices [1,1, 2,2, 3,3, etc]
-                encoding_index = torch.arange(batch_size).repeat(self.windows_per_sample, 1).T.reshape(-1)
-                encoder_hidden_states = encoder_hidden_states[encoding_index]
-
-        ### CHANGE ABOVE
-
         batch_size, seq_length = input_shape
 
         # required mask seq length can be calculated via length of past
@@ -175,7 +447,13 @@ def modify_t5_stack(self, config):
             past_key_values = [None] * len(self.block)
 
         # ourselves in which case we just need to make it broadcastable to all heads.
-        extended_attention_mask = self.get_extended_attention_mask(attention_mask, input_shape, inputs_embeds.device)
+        ### CHANGE BELOW
+        if self.window_mode:
+            # local attention handles the causal mask, only give it the padding mask so it never holds (seq_len, seq_len) values
+            extended_attention_mask = self.invert_attention_mask(attention_mask)
+        else:
+            extended_attention_mask = self.get_extended_attention_mask(attention_mask, input_shape, inputs_embeds.device)
+        ### CHANGE ABOVE
 
         if self.is_decoder and encoder_attention_mask is not None:
             encoder_extended_attention_mask = self.invert_attention_mask(encoder_attention_mask)
@@ -220,10 +498,10 @@ def modify_t5_stack(self, config):
 
             ### CHANGE BELOW
 
-            if grad_chk_pnt_rate and self.training and i % grad_chk_pnt_rate != 0:
+            if i in checkpoint_layers:
                 if use_cache:
                     logger.warn(
-                        "`use_cache=True` is incompatible with `grad_chk_pnt_rate=True`. Setting "
+                        "`use_cache=True` is incompatible with gradient checkpointing. Setting "
                         "`use_cache=False`..."
                     )
                     use_cache = False
@@ -246,6 +524,7 @@ def modify_t5_stack(self, config):
                     encoder_hidden_states,
                     encoder_extended_attention_mask,
                     encoder_decoder_position_bias,
+                    use_reentrant=self.checkpoint_use_reentrant,
                 )
             else:
                 # std way of calculating gradients
@@ -317,5 +596,18 @@ def modify_t5_stack(self, config):
             cross_attentions=all_cross_attentions,
         )
 
-    self.forward = alt_forward
-    return self
+
+def modify_t5_stack(stack, config):
+    stack.__class__ = VAE_T5Stack
+    for layer in stack.block:
+        layer.__class__ = VAE_T5Block
+    cache_cross_attention_projections(stack)
+    use_attention_backend(stack, config.attention_backend)
+    # indices of layers to checkpoint, set by `transformer_vae.checkpoint_policy`
+    stack.checkpoint_layers = set()
+    stack.checkpoint_use_reentrant = not config.checkpoint_non_reentrant
+    stack.window_mode = False
+    if config.attention_window_size:
+        stack.window_mode = True
+        use_local_attention(stack, config.attention_window_size, config.attention_window_overlap)
+    return stack
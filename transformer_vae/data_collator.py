@@ -23,6 +23,17 @@ class NonPaddingDataCollatorForLanguageModeling(DataCollatorForLanguageModeling)
     """
 
     padding: Union[bool, str, PaddingStrategy] = False
+    pad_to_multiple_of: Optional[int] = None
+    min_length: int = 0
+
+    def _batch_length(self, examples):
+        '''
+            Pad to the longest sequence (at least `min_length`) rounded up to a multiple of `pad_to_multiple_of`.
+            Never pads beyond `tokenizer.model_max_length`.
+        '''
+        length = max([len(example["input_ids"]) for example in examples] + [self.min_length])
+        length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        return min(length, self.tokenizer.model_max_length)
 
     def __call__(
         self, examples: List[Union[List[int], torch.Tensor, Dict[str, torch.Tensor]]]
@@ -30,7 +41,12 @@ class NonPaddingDataCollatorForLanguageModeling(DataCollatorForLanguageModeling)
         # Handle dict or lists with proper padding and conversion to tensor.
         if isinstance(examples[0], (dict, BatchEncoding)):
             # CHANGES START
-            batch = self.tokenizer.pad(examples, padding=self.padding, return_attention_mask=False, return_tensors="pt")
+            if self.pad_to_multiple_of:
+                batch = self.tokenizer.pad(
+                    examples, padding="max_length", max_length=self._batch_length(examples), return_attention_mask=False, return_tensors="pt"
+                )
+            else:
+                batch = self.tokenizer.pad(examples, padding=self.padding, return_attention_mask=False, return_tensors="pt")
             # CHANGES END
         else:
             batch = {"input_ids": _collate_batch(examples, self.tokenizer)}
@@ -54,6 +70,18 @@ class DataCollatorForLanguageAutoencoding(NonPaddingDataCollatorForLanguageModel
     """
     Same as MLM except we calculate a loss on non-masked tokens.
     """
+    _special_token_ids = None
+
+    def _special_tokens_mask(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Same as `tokenizer.get_special_tokens_mask(already_has_special_tokens=True)` on each row but vectorised.
+        """
+        if self._special_token_ids is None:
+            self._special_token_ids = torch.tensor(self.tokenizer.all_special_ids, dtype=inputs.dtype)
+        if hasattr(torch, "isin"):
+            return torch.isin(inputs, self._special_token_ids)
+        # older PyTorch
+        return (inputs.unsqueeze(-1) == self._special_token_ids).any(-1)
 
     def mask_tokens(
         self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None
@@ -62,13 +90,14 @@ class DataCollatorForLanguageAutoencoding(NonPaddingDataCollatorForLanguageModel
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
         labels = inputs.clone()
+        if not self.mlm_probability:
+            # nothing to mask
+            labels[labels == self.tokenizer.pad_token_id] = -100
+            return inputs, labels
         # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
         probability_matrix = torch.full(labels.shape, self.mlm_probability)
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
+            special_tokens_mask = self._special_tokens_mask(labels)
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
@@ -0,0 +1,186 @@
+"""
+    Run a trained Transformer-VAE outside of the Trainer.
+"""
+from typing import List, Optional, Union
+import torch
+from transformers import AutoTokenizer
+from transformers.utils import logging
+
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.quantize import quantize_model, load_quantized, is_quantized_checkpoint
+from transformer_vae.utils import slerp, autocast_bf16
+
+logger = logging.get_logger(__name__)
+
+
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+class VAE_Inference:
+    '''
+        Encode text into latent codes, decode latent codes into text & interpolate between them.
+
+        Texts are encoded in batches of similar token lengths, each padded to a multiple of the Funnel pooling stride
+        (as with `sortish_sampler`) & filled up to `max_batch_size` sequences & `max_batch_tokens` padded tokens.
+        Models with window attention or full sequence latents (`n_latent_tokens=-1`) need texts padded to
+        `set_seq_size`.
+        Latent codes are decoded in order in chunks sized for `generate_max_len` tokens,
+        so memory use stays bounded however many inputs are given.
+        Latent codes are returned on the CPU.
+
+        Args:
+            model: Trained `Funnel_T5_VAE_Model`.
+            tokenizer: Tokenizer used to train the model.
+            device: Device to run the model on, defaults to the models device.
+            max_batch_size: Max sequences per batch.
+            max_batch_tokens: Max padded tokens per batch, defaults to no limit.
+            generate_max_len: Max length of decoded sequences, defaults to `set_seq_size`.
+            dtype: Use "bf16" to run with bfloat16 autocast (CPU or CUDA).
+            quantize: Use dynamic int8 quantization, CPU only. See `transformer_vae.quantize`.
+    '''
+    def __init__(
+        self,
+        model: Funnel_T5_VAE_Model,
+        tokenizer,
+        device=None,
+        max_batch_size: int = 64,
+        max_batch_tokens: Optional[int] = None,
+        generate_max_len: Optional[int] = None,
+        clean_up_tokenization_spaces: bool = True,
+        dtype: str = "",
+        quantize: bool = False,
+    ):
+        self.device = torch.device(device) if device is not None else model.device
+        model = model.to(self.device).eval()
+        if quantize:
+            if self.device.type != "cpu":
+                raise ValueError("Quantized inference only runs on CPU.")
+            model = quantize_model(model)
+        if dtype not in ["", "bf16"]:
+            raise ValueError(f'Unexpected dtype: "{dtype}" Expected one of: ["", "bf16"]')
+        if dtype and not hasattr(torch, "autocast"):
+            raise ValueError("bf16 inference needs `torch.autocast`, please update PyTorch.")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.dtype = dtype
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.seq_size = model.config.set_seq_size
+        self.generate_max_len = generate_max_len or self.seq_size
+        self.clean_up_tokenization_spaces = clean_up_tokenization_spaces
+
+    @classmethod
+    def from_pretrained(cls, model_path, tokenizer_name=None, **kwargs):
+        '''
+            Load a model saved by `VAE_Trainer.save_model` or `transformer_vae.quantize`, both also save the tokenizer.
+        '''
+        if is_quantized_checkpoint(model_path):
+            model = load_quantized(model_path)
+        else:
+            model = Funnel_T5_VAE_Model.from_pretrained(model_path)
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name or model_path)
+        return cls(model, tokenizer, **kwargs)
+
+    def _autocast(self):
+        return autocast_bf16(self.device.type, enabled=self.dtype == "bf16")
+
+    def _batch_size(self, seq_len):
+        if self.max_batch_tokens is None:
+            return self.max_batch_size
+        return max(1, min(self.max_batch_size, self.max_batch_tokens // seq_len))
+
+    def _batches(self, n_items, seq_len):
+        batch_size = self._batch_size(seq_len)
+        for start in range(0, n_items, batch_size):
+            yield start, min(start + batch_size, n_items)
+
+    def _padded_length(self, length):
+        config = self.model.config
+        if config.attention_window_size or config.n_latent_tokens < 1:
+            return self.seq_size
+        # long enough to pool into `n_latent_tokens`, like the training data collator
+        stride = 2 ** (len(config.funnel.block_sizes) - 1)
+        length = max(length, stride * config.n_latent_tokens)
+        return min(-(-length // stride) * stride, self.seq_size)
+
+    def _length_batches(self, lengths):
+        '''
+            Group the indices of sequences into batches of similar lengths.
+            Longest first so running out of memory happens early.
+            Returns (padded length, indices) for each batch.
+        '''
+        batches = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            if batches and len(batches[-1][1]) < self._batch_size(batches[-1][0]):
+                batches[-1][1].append(i)
+            else:
+                batches.append((self._padded_length(lengths[i]), [i]))
+        return batches
+
+    def encode(self, texts: List[str]) -> torch.Tensor:
+        '''
+            Returns latent codes of shape (len(texts), n_latent_tokens, latent_size).
+        '''
+        if not texts:
+            return self.encode([""])[:0]
+        pad_token_id = self.model.config.t5.pad_token_id
+        token_ids = self.tokenizer(texts, truncation=True, max_length=self.seq_size)["input_ids"]
+        latents = None
+        for padded_length, indices in self._length_batches([len(ids) for ids in token_ids]):
+            input_ids = torch.full((len(indices), padded_length), pad_token_id, dtype=torch.long)
+            for row, i in enumerate(indices):
+                input_ids[row, :len(token_ids[i])] = torch.as_tensor(token_ids[i])
+            input_ids = input_ids.to(self.device)
+            with inference_mode(), self._autocast():
+                attention_mask = input_ids.ne(pad_token_id).long()
+                encoding = self.model._get_encoder_outputs(input_ids=input_ids, attention_mask=attention_mask)
+                latent = self.model.vae.encoder(encoding.last_hidden_state).float().cpu()
+            if latents is None:
+                latents = torch.empty((len(texts),) + latent.shape[1:], dtype=latent.dtype)
+            # back in the order of `texts`
+            latents[indices] = latent
+        return latents
+
+    def decode(self, latents: torch.Tensor) -> List[str]:
+        texts: List[str] = []
+        for start, end in self._batches(latents.size(0), self.generate_max_len):
+            latent = latents[start:end].to(self.device)
+            with inference_mode(), self._autocast():
+                tokens = self.model.generate(
+                    input_ids=self.model.decoder_start_token_id * torch.ones(
+                        (latent.size(0), 1), dtype=torch.long, device=self.device
+                    ),
+                    latent=latent,
+                    bos_token_id=self.model.decoder_start_token_id,
+                    max_length=self.generate_max_len,
+                )
+            texts += self.tokenizer.batch_decode(
+                tokens, skip_special_tokens=True, clean_up_tokenization_spaces=self.clean_up_tokenization_spaces
+            )
+        return texts
+
+    def interpolate_latents(self, start: torch.Tensor, end: torch.Tensor, n: int, all_at_once=False) -> torch.Tensor:
+        '''
+            Slerp between 2 latent codes of shape (n_latent_tokens, latent_size) giving `n` evenly spaced points.
+            Each latent token is interpolated seperately unless `all_at_once`.
+        '''
+        ratios = torch.linspace(0, 1, n)
+        latent_shape = start.shape
+        if all_at_once:
+            start, end = start.reshape(1, -1), end.reshape(1, -1)
+        else:
+            ratios = ratios.repeat_interleave(start.size(0))
+        interpolations = slerp(ratios, start.repeat(n, 1), end.repeat(n, 1))
+        return interpolations.view((n,) + latent_shape)
+
+    def interpolate(
+        self, start: Union[str, torch.Tensor], end: Union[str, torch.Tensor], n: int = 11, all_at_once=False
+    ) -> List[str]:
+        '''
+            Decode `n` evenly spaced points between 2 texts or latent codes.
+        '''
+        if isinstance(start, str):
+            start = self.encode([start])[0]
+        if isinstance(end, str):
+            end = self.encode([end])[0]
+        return self.decode(self.interpolate_latents(start, end, n, all_at_once))
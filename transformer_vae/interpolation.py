@@ -0,0 +1,55 @@
+'''
+    Batched latent interpolations, many pairs of samples are encoded, interpolated & decoded together.
+'''
+from typing import Callable, List
+import torch
+
+from transformer_vae.utils import slerp_endpoints, slerp_from_endpoints
+
+# how training interpolation losses get decoder inputs for interpolated latent codes
+INTERPOLATION_DECODING = ["generate", "nearest", "refine"]
+
+
+def interpolation_ratios(n_points=11, device=None):
+    return torch.linspace(0, 1, n_points, device=device)
+
+
+def interpolation_grid(latent_start, latent_end, ratios, interpolate_all_at_once=False):
+    '''
+        Slerp between K pairs of latent codes at R ratios, gives a (K, R, *latent_shape) grid.
+
+        Each latent token is interpolated separately unless `interpolate_all_at_once`.
+    '''
+    n_pairs, n_ratios, latent_shape = latent_start.size(0), ratios.size(0), latent_start.shape[1:]
+    vector_size = latent_start[0].numel() if interpolate_all_at_once else latent_shape[-1]
+    endpoints = slerp_endpoints(latent_start.reshape(n_pairs, 1, -1, vector_size), latent_end.reshape(n_pairs, 1, -1, vector_size))
+    return slerp_from_endpoints(ratios.view(1, n_ratios, 1), endpoints).view(n_pairs, n_ratios, *latent_shape)
+
+
+def decode_in_batches(decode: Callable[[torch.Tensor], List[str]], latents, batch_size) -> List[str]:
+    '''
+        Decode latent codes in batches of at most `batch_size` to bound generation memory.
+    '''
+    texts: List[str] = []
+    for batch in latents.split(batch_size):
+        texts += decode(batch)
+    return texts
+
+
+def batched_interpolations(
+    model, inputs, ratios, decode: Callable[[torch.Tensor], List[str]], batch_size=64, interpolate_all_at_once=False
+):
+    '''
+        Interpolate between pairs of consecutive samples in `inputs`.
+        All samples are encoded in one forward pass & every interpolation is decoded in batches of at most `batch_size`.
+
+        Returns the (K, R, *latent_shape) latent grid & the decoded texts as K lists of R texts.
+    '''
+    latent = model(**inputs).latent
+    n_pairs = latent.size(0) // 2
+    latent_start, latent_end = latent[:2 * n_pairs].view(n_pairs, 2, *latent.shape[1:]).unbind(1)
+    grid = interpolation_grid(latent_start, latent_end, ratios, interpolate_all_at_once)
+    texts = decode_in_batches(decode, grid.flatten(0, 1), batch_size)
+    n_ratios = ratios.size(0)
+    return grid, [texts[i:i + n_ratios] for i in range(0, len(texts), n_ratios)]
+
@@ -0,0 +1,287 @@
+"""
+    Store latent codes for a whole dataset on disk & look up nearest neighbours without loading them all into memory.
+"""
+import os
+import json
+import hashlib
+from typing import List, Optional, Tuple
+import numpy as np
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+METRICS = ["cosine", "l2"]
+
+
+def shard_fingerprint(model_id: str, texts: List[str]) -> str:
+    '''
+        Changes when either the model or the shards texts do, used to skip re-encoding unchanged shards.
+    '''
+    sha = hashlib.sha1(model_id.encode("utf8"))
+    for text in texts:
+        sha.update(text.encode("utf8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class LatentStore:
+    '''
+        Latent codes saved as memory-mapped `.npy` shards with metadata.
+
+        Each row is a flattened latent code (n_latent_tokens * latent_size) stored as float16 or float32.
+        Each shard also saves which dataset index & class label its rows came from (-1 for no label).
+
+        Layout:
+            store.json                   dim, dtype & shard info.
+            shard_<id>.npy               (rows, dim) latent codes.
+            shard_<id>_index.npy         (rows,) dataset indices.
+            shard_<id>_class_label.npy   (rows,) class labels.
+            shard_<id>_ivf.npy           (rows,) IVF list of each row, only after `build_ivf`.
+            ivf_centroids.npy            (n_lists, dim) IVF centroids, only after `build_ivf`.
+    '''
+    def __init__(self, path: str, dim: Optional[int] = None, dtype: str = "float16"):
+        if dtype not in ["float16", "float32"]:
+            raise ValueError(f'Unexpected dtype: "{dtype}" Expected one of: ["float16", "float32"]')
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = {"dim": dim, "dtype": dtype, "shards": {}, "ivf": None}
+        if os.path.exists(self._file("store.json")):
+            with open(self._file("store.json")) as f:
+                self.meta = json.load(f)
+            if dim is not None and dim != self.meta["dim"]:
+                raise ValueError(f'Store at {path} has dim {self.meta["dim"]} not {dim}.')
+        self._centroids = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        tmp_path = self._file("store.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._file("store.json"))
+
+    @property
+    def shard_ids(self) -> List[str]:
+        return sorted(self.meta["shards"].keys())
+
+    def __len__(self):
+        return sum(shard["rows"] for shard in self.meta["shards"].values())
+
+    def needs_update(self, shard_id, fingerprint: str) -> bool:
+        shard = self.meta["shards"].get(str(shard_id))
+        return shard is None or shard["fingerprint"] != fingerprint
+
+    def write_shard(self, shard_id, latents: np.ndarray, dataset_index: np.ndarray, class_label=None, fingerprint=""):
+        '''
+            Write (or overwrite) a shard, latents of shape (rows, ...) are flattened to (rows, dim).
+        '''
+        shard_id = str(shard_id)
+        latents = np.asarray(latents).reshape(len(latents), -1)
+        if self.meta["dim"] is None:
+            self.meta["dim"] = latents.shape[1]
+        if latents.shape[1] != self.meta["dim"]:
+            raise ValueError(f'Latent dim {latents.shape[1]} does not match store dim {self.meta["dim"]}.')
+        if class_label is None:
+            class_label = np.full(len(latents), -1)
+
+        array = np.lib.format.open_memmap(
+            self._file(f"shard_{shard_id}.npy"), mode="w+", dtype=self.meta["dtype"], shape=latents.shape
+        )
+        array[:] = latents
+        array.flush()
+        del array
+        np.save(self._file(f"shard_{shard_id}_index.npy"), np.asarray(dataset_index, dtype=np.int64))
+        np.save(self._file(f"shard_{shard_id}_class_label.npy"), np.asarray(class_label, dtype=np.int64))
+        if self.meta["ivf"] is not None:
+            np.save(self._file(f"shard_{shard_id}_ivf.npy"), self._assign_lists(latents))
+        self.meta["shards"][shard_id] = {"rows": len(latents), "fingerprint": fingerprint}
+        self._save_meta()
+
+    def delete_shard(self, shard_id):
+        shard_id = str(shard_id)
+        del self.meta["shards"][shard_id]
+        self._save_meta()
+        for suffix in ["", "_index", "_class_label", "_ivf"]:
+            path = self._file(f"shard_{shard_id}{suffix}.npy")
+            if os.path.exists(path):
+                os.remove(path)
+
+    def shard(self, shard_id) -> np.memmap:
+        return np.load(self._file(f"shard_{shard_id}.npy"), mmap_mode="r")
+
+    def shard_metadata(self, shard_id) -> Tuple[np.ndarray, np.ndarray]:
+        return (
+            np.load(self._file(f"shard_{shard_id}_index.npy")),
+            np.load(self._file(f"shard_{shard_id}_class_label.npy")),
+        )
+
+    @staticmethod
+    def _scores(queries, block, metric):
+        if metric == "cosine":
+            return queries @ (block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-8)).T
+        # negative squared l2 distance, higher is closer
+        return 2 * queries @ block.T - (block ** 2).sum(1) - (queries ** 2).sum(1, keepdims=True)
+
+    @staticmethod
+    def _merge_top_k(best_scores, best_ids, scores, ids, k):
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(ids, (scores.shape[0], ids.shape[0]))], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores, ids = np.take_along_axis(scores, top, 1), np.take_along_axis(ids, top, 1)
+        return scores, ids
+
+    def nearest(self, queries: np.ndarray, k: int = 5, metric: str = "cosine", block_size: int = 65_536, n_probe=None):
+        '''
+            Find the `k` closest stored latent codes to each query.
+            Scans each shard in blocks of `block_size` rows so memory use doesn't grow with the store.
+            After `build_ivf` pass `n_probe` to only scan rows in the `n_probe` closest IVF lists.
+
+            Returns:
+                scores (n_queries, k), dataset indices (n_queries, k), class labels (n_queries, k)
+                ordered closest first, cosine similarity or negative squared l2 distance.
+                When fewer than `k` rows are searched the missing results have score NaN & dataset index -1.
+        '''
+        if metric not in METRICS:
+            raise ValueError(f'Unexpected metric: "{metric}" Expected one of: {METRICS}')
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+        if metric == "cosine":
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-8)
+        probe_lists = None
+        if n_probe is not None:
+            if self.meta["ivf"] is None:
+                raise ValueError("Need to run `build_ivf` before searching with `n_probe`.")
+            probe_lists = np.argsort(-self._scores(queries, self.centroids, metric), axis=1)[:, :n_probe]
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        # rows numbered across all shards so metadata can be looked up after
+        row_offset, offsets = 0, {}
+        for shard_id in self.shard_ids:
+            offsets[shard_id] = row_offset
+            array = self.shard(shard_id)
+            rows = np.arange(array.shape[0])
+            if probe_lists is not None:
+                # only read rows from lists some query is probing
+                ivf_lists = np.load(self._file(f"shard_{shard_id}_ivf.npy"))
+                rows = np.nonzero(np.isin(ivf_lists, probe_lists))[0]
+            for start in range(0, len(rows), block_size):
+                block_rows = rows[start:start + block_size]
+                if probe_lists is None:
+                    block = np.asarray(array[block_rows[0]:block_rows[-1] + 1], dtype=np.float32)
+                else:
+                    block = np.asarray(array[block_rows], dtype=np.float32)
+                scores = self._scores(queries, block, metric)
+                if probe_lists is not None:
+                    in_probe = (ivf_lists[block_rows][None, :, None] == probe_lists[:, None, :]).any(2)
+                    scores = np.where(in_probe, scores, -np.inf)
+                best_scores, best_rows = self._merge_top_k(best_scores, best_rows, scores, row_offset + block_rows, k)
+            row_offset += self.meta["shards"][shard_id]["rows"]
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores, best_rows = np.take_along_axis(best_scores, order, 1), np.take_along_axis(best_rows, order, 1)
+        # rows outside the probed lists (or missing when the store has fewer than `k` rows)
+        missing = np.pad(~np.isfinite(best_scores), [(0, 0), (0, k - best_scores.shape[1])], constant_values=True)
+        best_scores = np.where(missing, np.nan, np.pad(best_scores, [(0, 0), (0, k - best_scores.shape[1])]))
+        best_rows = np.where(missing, -1, np.pad(best_rows, [(0, 0), (0, k - best_rows.shape[1])]))
+        dataset_index, class_label = self._row_metadata(best_rows, offsets)
+        return best_scores, dataset_index, class_label
+
+    def _row_metadata(self, rows, offsets):
+        dataset_index, class_label = np.full(rows.shape, -1), np.full(rows.shape, -1)
+        for shard_id, offset in offsets.items():
+            n_rows = self.meta["shards"][shard_id]["rows"]
+            in_shard = (rows >= offset) & (rows < offset + n_rows)
+            if in_shard.any():
+                shard_index, shard_class_label = self.shard_metadata(shard_id)
+                dataset_index[in_shard] = shard_index[rows[in_shard] - offset]
+                class_label[in_shard] = shard_class_label[rows[in_shard] - offset]
+        return dataset_index, class_label
+
+    @property
+    def centroids(self):
+        if self._centroids is None:
+            self._centroids = np.load(self._file("ivf_centroids.npy"))
+        return self._centroids
+
+    def _assign_lists(self, latents, block_size=65_536):
+        lists = np.empty(len(latents), dtype=np.int32)
+        for start in range(0, len(latents), block_size):
+            block = np.asarray(latents[start:start + block_size], dtype=np.float32)
+            lists[start:start + len(block)] = self._scores(block, self.centroids, self.meta["ivf"]["metric"]).argmax(1)
+        return lists
+
+    def build_ivf(self, n_lists: int = 256, metric: str = "cosine", n_iter: int = 10, sample_size: int = 100_000):
+        '''
+            Cluster a sample of the stored latents with k-means & assign every row to its closest centroid.
+        '''
+        if metric not in METRICS:
+            raise ValueError(f'Unexpected metric: "{metric}" Expected one of: {METRICS}')
+        total_rows = len(self)
+        sample_rows = np.sort(np.random.choice(total_rows, min(sample_size, total_rows), replace=False))
+        sample, row_offset = [], 0
+        for shard_id in self.shard_ids:
+            n_rows = self.meta["shards"][shard_id]["rows"]
+            in_shard = sample_rows[(sample_rows >= row_offset) & (sample_rows < row_offset + n_rows)] - row_offset
+            sample.append(np.asarray(self.shard(shard_id)[in_shard], dtype=np.float32))
+            row_offset += n_rows
+        sample = np.concatenate(sample)
+        if metric == "cosine":
+            sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-8)
+
+        centroids = sample[np.random.choice(len(sample), min(n_lists, len(sample)), replace=False)]
+        for _ in range(n_iter):
+            assignment = self._scores(sample, centroids, metric).argmax(1)
+            for i in range(len(centroids)):
+                members = sample[assignment == i]
+                if len(members):
+                    centroids[i] = members.mean(0)
+            if metric == "cosine":
+                centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-8)
+
+        np.save(self._file("ivf_centroids.npy"), centroids)
+        self._centroids = centroids
+        self.meta["ivf"] = {"n_lists": len(centroids), "metric": metric}
+        for shard_id in self.shard_ids:
+            np.save(self._file(f"shard_{shard_id}_ivf.npy"), self._assign_lists(self.shard(shard_id)))
+        self._save_meta()
+
+
+def encode_dataset(
+    store: LatentStore, inference, texts: List[str], model_id: str, shard_size: int = 10_000, class_labels=None
+) -> List[str]:
+    '''
+        Encode `texts` into `store` using a `VAE_Inference` in shards of `shard_size` rows.
+
+        Shards that were already encoded by the same `model_id` with the same texts are skipped,
+        so re-running after adding data or changing checkpoints only encodes what changed.
+        Shards past the end of `texts` are deleted.
+
+        Returns:
+            The ids of shards that were (re-)encoded.
+    '''
+    updated, shard_ids = [], []
+    for shard_start in range(0, len(texts), shard_size):
+        shard_id = f"{shard_start // shard_size:06d}"
+        shard_ids.append(shard_id)
+        shard_texts = texts[shard_start:shard_start + shard_size]
+        fingerprint = shard_fingerprint(model_id, shard_texts)
+        if not store.needs_update(shard_id, fingerprint):
+            continue
+        logger.info(f"Encoding latent store shard {shard_id} ({len(shard_texts)} rows).")
+        latents = inference.encode(shard_texts).numpy()
+        store.write_shard(
+            shard_id,
+            latents,
+            np.arange(shard_start, shard_start + len(shard_texts)),
+            class_label=None if class_labels is None else class_labels[shard_start:shard_start + shard_size],
+            fingerprint=fingerprint,
+        )
+        updated.append(shard_id)
+    # shards past the end of a dataset that shrank
+    for shard_id in set(store.shard_ids) - set(shard_ids):
+        logger.info(f"Deleting stale latent store shard {shard_id}.")
+        store.delete_shard(shard_id)
+    return updated
@@ -0,0 +1,78 @@
+'''
+    Training metrics summed between logs, averaged over every process at log time.
+'''
+import threading
+from typing import Any, Dict, List, Optional
+import torch
+import torch.distributed as dist
+
+from transformer_vae.utils import assertIn, tensors_to_floats
+
+
+class MetricsAccumulator:
+    '''
+        Per-instance sums & counts of named metrics.
+
+        Values are kept as detached tensors so adding them doesn't wait on the device.
+        `DataParallel` replicas share their model's accumulator so adds are locked & sums are kept per device,
+        they're combined in `compute`.
+        With `torch.distributed` the sums & counts of every process are all-reduced in `compute`, so every process must call it.
+    '''
+    def __init__(self, names: List[str]):
+        self.names = list(names)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        # metric name -> device (None for numbers) -> sum
+        self._sums: Dict[str, Dict[Optional[torch.device], Any]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def add(self, **metrics):
+        with self._lock:
+            for name, value in metrics.items():
+                assertIn(name, self.names, "Unexpected metric.")
+                device = None
+                if isinstance(value, torch.Tensor):
+                    device, value = value.device, value.detach()
+                device_sums = self._sums.setdefault(name, {})
+                device_sums[device] = device_sums.get(device, 0) + value
+                self._counts[name] = self._counts.get(name, 0) + 1
+
+    def compute(self, reset=True) -> Dict[str, float]:
+        '''
+            Mean of each metric since the last reset, metrics without values are left out.
+        '''
+        with self._lock:
+            sums, counts = self._sums, self._counts
+            if reset:
+                self.reset()
+        floats = tensors_to_floats({
+            (name, device): value for name, device_sums in sums.items() for device, value in device_sums.items()
+        })
+        sums = {name: sum(floats[(name, device)] for device in device_sums) for name, device_sums in sums.items()}
+        if dist.is_available() and dist.is_initialized():
+            sums, counts = self._all_reduce(sums, counts)
+        return {name: sums[name] / counts[name] for name in self.names if counts.get(name)}
+
+    def _all_reduce(self, sums, counts):
+        # every process reduces all the metric names in the same order, including ones it has no values for
+        device = torch.device("cpu")
+        if dist.get_backend() == "nccl":
+            device = torch.device("cuda", torch.cuda.current_device())
+        totals = torch.tensor(
+            [[sums.get(name, 0) for name in self.names], [counts.get(name, 0) for name in self.names]],
+            dtype=torch.double, device=device,
+        )
+        dist.all_reduce(totals)
+        sums, counts = totals.tolist()
+        return dict(zip(self.names, sums)), dict(zip(self.names, counts))
@@ -11,14 +11,22 @@ from transformers.models.funnel.modeling_funnel import upsample
 from transformers import AutoModelForSeq2SeqLM, AutoModelForMaskedLM
 
 from transformer_vae.custom_t5 import modify_t5_stack
+from transformer_vae.custom_funnel import modify_funnel_encoder
+from transformer_vae.checkpoint import checkpoint
 from transformer_vae.autoencoders import VAE_ENCODER_MODELS, VAE_DECODER_MODELS, EncoderDecoderVAE
 from transformer_vae.critic import CRITIC
-from transformer_vae.model_outputs import BaseTransformerVAE_Output
+from transformer_vae.model_outputs import BaseVAE_Output, BaseTransformerVAE_Output
 from transformer_vae.config import Funnel_T5_VAE_Config
+from transformer_vae.metrics import MetricsAccumulator
+from transformer_vae.utils import tensor_version, autocast_state, autocast_disabled, assert_async
 
 
 logger = logging.get_logger(__name__)
 
+TRAINING_METRICS = [
+    "decoder_ce", "seq_accuracy", "token_accuracy", "reg_loss_w", "reg_loss", "cycle_loss", "critic_loss_on_model", "critic_loss"
+]
+
 
 class Funnel_T5_VAE_Model(PreTrainedModel):
     r"""
@@ -32,8 +40,8 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
 
     NOTE: To work nicely with `huggingface.Trainer` this model handles some of its training logic here.
     - Must be trained with the `transformer_vae.TellModelGlobalStep` for MMD regularising loss scheduling & log normalizing.
-    - Must use `transformer_vae.WandbCallbackUseModelLogs` for logging as it stores some of its own logs internally, using
-      `get_latest_logs` to get the normalised logs and refresh the internal logs.
+    - Must use `transformer_vae.WandbCallbackUseModelLogs` for logging as it accumulates some of its own logs in `metrics`,
+      using `get_latest_logs` to get the averaged logs and reset them.
 
     NOTE: Its generation works differently. Instead of taking input_ids and sampling form the decoder it takes a `latent`
     and uses `input_ids` as `decoder_input_ids`.
@@ -54,25 +62,14 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
     """
     config_class = Funnel_T5_VAE_Config
     base_model_prefix = "transformer"
-    global_step = None
-    _calls_since_last_log = 0
-    latest_logs = {
-        "decoder_ce": 0,
-        "seq_accuracy": 0,
-        "token_accuracy": 0,
-        "reg_loss_w": 0,
-        "reg_loss": 0,
-        'critic_loss_on_model': 0,
-        'critic_loss': 0,
-    }
-    _last_logs: Dict[str, float] = {}
+    _global_step = None
 
     def __init__(self, config: Funnel_T5_VAE_Config):
         super().__init__(config=config)
         funnel_transformer = AutoModelForMaskedLM.from_config(config.funnel)
         t5_transformer = AutoModelForSeq2SeqLM.from_config(config.t5)
 
-        self.encoder = funnel_transformer.funnel.encoder
+        self.encoder = modify_funnel_encoder(funnel_transformer.funnel.encoder)
         self.decoder = modify_t5_stack(t5_transformer.decoder, config)
         self.lm_head = t5_transformer.lm_head
         self.shared_embedding = t5_transformer.shared
@@ -85,12 +82,52 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
             VAE_ENCODER_MODELS[config.vae_encoder_model](self.config),
             VAE_DECODER_MODELS[config.vae_decoder_model](self.config),
             self.config.use_reg_loss,
+            self.config.mmd_kernel,
+            self.config.mmd_chunk_size,
+            self.config.mmd_estimator,
+            self.config.mmd_rff_features,
         )
 
         self.critic = None
         if config.critic:
             self.critic = CRITIC[config.critic_type](config.critic)
 
+        self._latent_cache = None
+        self.metrics = MetricsAccumulator(TRAINING_METRICS)
+        # a buffer so `torch.compile` reads the step as an input rather than specialising on (& recompiling for) each one
+        self.register_buffer("_global_step_tensor", torch.zeros((), dtype=torch.long), persistent=False)
+
+    @property
+    def global_step(self):
+        return self._global_step
+
+    @global_step.setter
+    def global_step(self, step):
+        self._global_step = step
+        if step is not None:
+            self._global_step_tensor.fill_(step)
+
+    def clear_decoding_caches(self):
+        '''
+            Drop the cached latent outputs & cross-attention keys/values so they don't keep activations alive.
+        '''
+        self._latent_cache = None
+        for module in self.modules():
+            # `CachedProjection` & its quantized version
+            if getattr(module, "cache_enabled", False):
+                module._cache = None
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.clear_decoding_caches()
+        return self
+
+    def generate(self, *args, **kwargs):
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            self.clear_decoding_caches()
+
     def get_input_embeddings(self):
         return self.shared_embedding
 
@@ -104,46 +141,48 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         if self.global_step is None or not self.config.use_reg_loss:
             return 0
         # edit using https://www.desmos.com/calculator/mqzxhecfxz
-        return torch.sigmoid(
-            torch.tensor(self.global_step * self.config.reg_schedule_k - self.config.reg_schedule_b)
-        ).item()
-
-    def _update_logs(self, **logs):
-        self._calls_since_last_log += 1
-        for k, v in logs.items():
-            self.latest_logs[k] = self.latest_logs.get(k, 0) + v
+        return torch.sigmoid(self._global_step_tensor * self.config.reg_schedule_k - self.config.reg_schedule_b)
 
     def get_latest_logs(self):
         """
-        Gets latest logs and refreshes the log values.
-
-        Logs are normalised by the number of training inferences since the last log.
+        Gets the mean of each training metric since the last log & resets them.
         """
-        assert self.config.use_extra_logs
-        if self._calls_since_last_log < 1:
-            return {}
-
-        result = dict(self.latest_logs)
-        for k, v in result.items():
-            value_increase = v - self._last_logs.get(k, 0)
-            result[k] = value_increase / self._calls_since_last_log
+        return self.metrics.compute()
 
-        self._last_logs = dict(self.latest_logs)
-        self._calls_since_last_log = 0
-
-        return result
-
-    def prepare_inputs_for_generation(self, input_ids: torch.LongTensor, latent=None, **kwargs) -> Dict[str, Any]:
+    def prepare_inputs_for_generation(
+        self, input_ids: torch.LongTensor, latent=None, past=None, upsampled_encoding=None, use_cache=None, **kwargs
+    ) -> Dict[str, Any]:
         """
         Should only be generating text from latent codes.
+
+        Reuses the decoders `past_key_values` & the upsampled latent encoding between steps so only the newest token is decoded.
         """
         assert (
             latent is not None
         ), "Generation with Transformer-VAE's expects to be given a latent code to generate from."
-        for rm_key in ["past", "attention_mask"]:
-            if rm_key in kwargs:
-                del kwargs[rm_key]
-        return {"decoder_input_ids": input_ids, "latent": latent, **kwargs}
+        if "attention_mask" in kwargs:
+            del kwargs["attention_mask"]
+        if use_cache is None:
+            use_cache = True
+        if past is not None and use_cache:
+            input_ids = input_ids[:, -1:]
+        else:
+            past = None
+        return {
+            "decoder_input_ids": input_ids,
+            "latent": latent,
+            "past_key_values": past,
+            "upsampled_encoding": upsampled_encoding,
+            "use_cache": use_cache,
+            **kwargs,
+        }
+
+    @staticmethod
+    def _update_model_kwargs_for_generation(outputs, model_kwargs: Dict[str, Any], is_encoder_decoder: bool = False):
+        model_kwargs = PreTrainedModel._update_model_kwargs_for_generation(outputs, model_kwargs, is_encoder_decoder)
+        # the latent doesn't change while generating so keep its decoder cross-attention inputs
+        model_kwargs["upsampled_encoding"] = outputs.upsampled_encoding
+        return model_kwargs
 
     def _get_encoder_outputs(
         self,
@@ -175,19 +214,21 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.shared_embedding(input_ids)
 
-        if self.config.gradient_checkpoint_encoder:
+        if self.config.gradient_checkpoint_encoder and self.training and torch.is_grad_enabled():
 
             def create_custom_forward(encoder):
                 def custom_forward(*inputs):
                     return encoder(*inputs, False, False, False)
                 return custom_forward
 
-            return torch.utils.checkpoint.checkpoint(
+            # checkpointing returns the encoder's output tuple
+            return BaseModelOutput(last_hidden_state=checkpoint(
                 create_custom_forward(self.encoder),
                 inputs_embeds,
                 attention_mask,
                 token_type_ids,
-            )
+                use_reentrant=not self.config.checkpoint_non_reentrant,
+            )[0])
 
         return self.encoder(
             inputs_embeds,
@@ -197,6 +238,33 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
             return_dict=True,
         )
 
+    def _upsample(self, reconstructed_encoding):
+        if self.config.skip_upsample:
+            return reconstructed_encoding
+        return upsample(
+            reconstructed_encoding,
+            stride=2 ** (len(self.config.funnel.block_sizes) - 1),
+            target_len=self.config.t5.n_positions,
+            separate_cls=self.config.funnel.separate_cls,
+            truncate_seq=self.config.funnel.truncate_seq,
+        )
+
+    def _latent_cache_versions(self, latent):
+        # autocast changes the dtype of the outputs
+        return (tensor_version(latent), autocast_state()) + tuple(tensor_version(p) for p in self.vae.parameters())
+
+    def _cached_latent_outputs(self, latent):
+        '''
+            Reuse the VAE outputs & upsampled encoding from the last `forward(latent=...)` call with this latent.
+            Means repeated decoding of the same latents (e.g. interpolations) also reuse the cached cross-attention keys & values.
+        '''
+        if latent is None or self._latent_cache is None or torch.is_grad_enabled():
+            return None, None
+        cached_latent, versions, vae_outputs, upsampled_encoding = self._latent_cache
+        if cached_latent is not latent or versions != self._latent_cache_versions(latent):
+            return None, None
+        return vae_outputs, upsampled_encoding
+
     def _shift_right(self, input_ids):
         decoder_start_token_id = self.config.t5.decoder_start_token_id
         pad_token_id = self.config.t5.pad_token_id
@@ -210,7 +278,7 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         # replace possible -100 values in labels by `pad_token_id`
         shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
 
-        assert torch.all(shifted_input_ids >= 0).item(), "Verify that `shifted_input_ids` has only positive values"
+        assert_async(torch.all(shifted_input_ids >= 0), "Verify that `shifted_input_ids` has only positive values")
 
         return shifted_input_ids
 
@@ -223,6 +291,8 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         encoder_outputs=None,
         decoder_input_ids=None,
         latent=None,
+        upsampled_encoding=None,
+        past_key_values=None,
         use_cache=None,
         output_hidden_states=None,
         return_dict=True,
@@ -255,20 +325,19 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        vae_outputs = self.vae(
-            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs and isinstance(encoder_outputs, BaseModelOutput) else None, latent=latent
-        )
-
-        if self.config.skip_upsample:
-            upsampled_encoding = vae_outputs.reconstructed_encoding
-        else:
-            upsampled_encoding = upsample(
-                vae_outputs.reconstructed_encoding,
-                stride=2 ** (len(self.config.funnel.block_sizes) - 1),
-                target_len=self.config.t5.n_positions,
-                separate_cls=self.config.funnel.separate_cls,
-                truncate_seq=self.config.funnel.truncate_seq,
+        vae_outputs = None
+        if upsampled_encoding is not None and latent is not None:
+            # reusing decoder inputs for this latent (e.g. during generation)
+            vae_outputs = BaseVAE_Output(latent=latent, reg_loss=torch.tensor(0.0, device=latent.device))
+        elif encoder_outputs is None:
+            vae_outputs, upsampled_encoding = self._cached_latent_outputs(latent)
+        if vae_outputs is None:
+            vae_outputs = self.vae(
+                input_encoding=encoder_outputs.last_hidden_state if encoder_outputs and isinstance(encoder_outputs, BaseModelOutput) else None, latent=latent
             )
+            upsampled_encoding = self._upsample(vae_outputs.reconstructed_encoding)
+            if encoder_outputs is None and not torch.is_grad_enabled():
+                self._latent_cache = (latent, self._latent_cache_versions(latent), vae_outputs, upsampled_encoding)
 
         # Now using T5 decoder
 
@@ -283,7 +352,7 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         lm_logits = None
         if decoder_input_ids is not None:
             decoder_outputs = self.decoder(
-                input_ids=decoder_input_ids, encoder_hidden_states=upsampled_encoding, use_cache=use_cache, output_hidden_states=output_hidden_states, return_dict=True, grad_chk_pnt_rate=self.config.decoder_grad_chk_pnt_rate
+                input_ids=decoder_input_ids, encoder_hidden_states=upsampled_encoding, past_key_values=past_key_values, use_cache=use_cache, output_hidden_states=output_hidden_states, return_dict=True, grad_chk_pnt_rate=self.config.decoder_grad_chk_pnt_rate
             )
 
             sequence_output = decoder_outputs.last_hidden_state
@@ -294,7 +363,9 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
 
             if labels is not None:
                 loss_fct = nn.CrossEntropyLoss(ignore_index=-100)
-                decoder_ce = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), labels.view(-1))
+                # keep the loss in fp32 when running with bf16 autocast
+                with autocast_disabled(lm_logits.device.type):
+                    decoder_ce = loss_fct(lm_logits.float().view(-1, lm_logits.size(-1)), labels.view(-1))
                 chosen_tokens = torch.argmax(lm_logits, 2)
                 pad_tokens = (labels == -100).int()
                 correct_tokens = (chosen_tokens == labels).int() + pad_tokens
@@ -306,8 +377,8 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
         loss = decoder_ce + vae_outputs.reg_loss * reg_loss_w
 
         if self.training and self.config.use_extra_logs:
-            self._update_logs(
-                decoder_ce=decoder_ce.item(), seq_accuracy=seq_accuracy, token_accuracy=token_accuracy, reg_loss=vae_outputs.reg_loss.item(), reg_loss_w=reg_loss_w
+            self.metrics.add(
+                decoder_ce=decoder_ce.detach(), seq_accuracy=seq_accuracy, token_accuracy=token_accuracy, reg_loss=vae_outputs.reg_loss.detach(), reg_loss_w=reg_loss_w
             )
 
         return BaseTransformerVAE_Output(
@@ -319,6 +390,7 @@ class Funnel_T5_VAE_Model(PreTrainedModel):
             decoder_attentions=decoder_outputs.attentions if decoder_outputs else None,
             cross_attentions=decoder_outputs.cross_attentions if decoder_outputs else None,
             reconstructed_encoding=vae_outputs.reconstructed_encoding,
+            upsampled_encoding=upsampled_encoding,
             encoder_last_hidden_state=encoder_outputs.last_hidden_state if encoder_outputs else None,
             encoder_hidden_states=encoder_outputs.hidden_states if encoder_outputs else None,
             encoder_attentions=encoder_outputs.attentions if encoder_outputs else None,
@@ -38,6 +38,8 @@ class BaseTransformerVAE_Output(ModelOutput):
             Reconstructed hidden states originally from the last layer of the encoder.
         latent (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, latent_size)`):
             Latent codes representing encoded sequences.
+        upsampled_encoding (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, n_positions, hidden_size)`):
+            Reconstructed encoding after upsampling, what the decoder cross-attends to.
         reg_loss (:obj:`torch.FloatTensor` of shape :obj:`(batch_size)`):
             MMD-VAE regularisation loss for this step.
         reg_loss (:obj:`torch.FloatTensor` of shape :obj:`(batch_size)`):
@@ -57,6 +59,7 @@ class BaseTransformerVAE_Output(ModelOutput):
 
     latent: torch.FloatTensor = None
     reconstructed_encoding: Optional[torch.FloatTensor] = None
+    upsampled_encoding: Optional[torch.FloatTensor] = None
     reg_loss: Optional[torch.FloatTensor] = None
     decoder_ce: Optional[torch.FloatTensor] = None
     seq_accuracy: Optional[torch.FloatTensor] = None
@@ -0,0 +1,260 @@
+'''
+    Dynamic int8 quantization of a trained Transformer-VAE for CPU inference.
+
+    Quantizes the Linear layers of the Funnel encoder, T5 decoder, `lm_head` & the VAE's latent projections,
+    embeddings stay in fp32. Quantized models are saved with their int8 weights so loading doesn't need the fp32 model.
+
+    python -m transformer_vae.quantize --model_path output --validation_file held_out.txt --output_dir output_int8
+'''
+import os
+import json
+import time
+import copy
+from dataclasses import dataclass, field
+from typing import List, Optional
+import torch
+from torch import nn
+try:
+    from torch.ao.nn.quantized import dynamic as nnqd
+    from torch.ao.quantization import default_dynamic_qconfig
+except ImportError:
+    # PyTorch < 1.13
+    from torch.nn.quantized import dynamic as nnqd
+    from torch.quantization import default_dynamic_qconfig
+from transformers import AutoTokenizer, HfArgumentParser
+from transformers.utils import logging
+
+from transformer_vae.config import Funnel_T5_VAE_Config
+from transformer_vae.model import Funnel_T5_VAE_Model
+from transformer_vae.custom_t5 import CachedProjection
+from transformer_vae.streaming import read_text_file
+from transformer_vae.utils import tensor_version, autocast_state
+
+logger = logging.get_logger(__name__)
+
+
+QUANTIZED_MODULES = ["encoder", "decoder", "lm_head", "vae.encoder", "vae.decoder"]
+QUANTIZED_WEIGHTS_NAME = "quantized_model.bin"
+
+
+class QuantizedCachedProjection(nnqd.Linear):
+    '''
+        Quantized `CachedProjection`, reuses its last output when given the same input tensor.
+        Quantized weights are never updated in place so only the input is checked.
+    '''
+    cache_enabled = True
+    _cache = None
+
+    def forward(self, x):
+        if not self.cache_enabled or torch.is_grad_enabled():
+            self._cache = None
+            return super().forward(x)
+        version = (tensor_version(x), autocast_state())
+        if self._cache is None or self._cache[0] is not x or self._cache[1] != version:
+            self._cache = (x, version, super().forward(x))
+        return self._cache[2]
+
+
+def _quantized_linear(linear):
+    # `from_float` only accepts `nn.Linear` itself so copy subclasses like `CachedProjection` into one
+    float_linear = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+    float_linear.weight, float_linear.bias = linear.weight, linear.bias
+    float_linear.qconfig = default_dynamic_qconfig
+    return nnqd.Linear.from_float(float_linear)
+
+
+def _empty_quantized_linear(linear):
+    return nnqd.Linear(linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+
+
+def _is_quantized_module(name):
+    return any(name == prefix or name.startswith(prefix + ".") for prefix in QUANTIZED_MODULES)
+
+
+def _swap_linears(model, make_quantized):
+    for parent_name, parent in list(model.named_modules()):
+        for name, child in list(parent.named_children()):
+            full_name = f"{parent_name}.{name}" if parent_name else name
+            if isinstance(child, nn.Linear) and _is_quantized_module(full_name):
+                quantized = make_quantized(child)
+                if isinstance(child, CachedProjection):
+                    quantized.__class__ = QuantizedCachedProjection
+                    quantized.cache_enabled = child.cache_enabled
+                setattr(parent, name, quantized)
+    model.is_quantized = True
+    return model.eval()
+
+
+def quantize_model(model: Funnel_T5_VAE_Model, inplace=False) -> Funnel_T5_VAE_Model:
+    '''
+        Dynamic int8 quantization of the encoder, decoder, `lm_head` & latent projections, CPU only.
+    '''
+    if not inplace:
+        model = copy.deepcopy(model)
+    return _swap_linears(model.cpu().eval(), _quantized_linear)
+
+
+def save_quantized(model: Funnel_T5_VAE_Model, output_dir: str, tokenizer=None):
+    '''
+        Save a quantized model's config & int8 weights, load it with `load_quantized`.
+    '''
+    assert getattr(model, "is_quantized", False), "Quantize the model with `quantize_model` first."
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+    if tokenizer is not None:
+        tokenizer.save_pretrained(output_dir)
+
+
+def is_quantized_checkpoint(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_quantized(path: str) -> Funnel_T5_VAE_Model:
+    '''
+        Load a model saved by `save_quantized`, builds empty int8 layers & loads the saved weights into them.
+    '''
+    model = Funnel_T5_VAE_Model(Funnel_T5_VAE_Config.from_pretrained(path))
+    _swap_linears(model, _empty_quantized_linear)
+    model.load_state_dict(torch.load(os.path.join(path, QUANTIZED_WEIGHTS_NAME), map_location="cpu"))
+    return model
+
+
+def state_dict_bytes(model) -> int:
+    '''
+        Size of a model's weights, tied weights are counted once.
+    '''
+    tensors = {}
+    for value in model.state_dict().values():
+        # packed quantized Linear params are stored as (weight, bias)
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                tensors[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+    return sum(tensors.values())
+
+
+def _mean_seconds(timings):
+    return sum(timings) / max(len(timings), 1)
+
+
+def _evaluate(model, batches, generate_max_len):
+    correct_tokens = n_tokens = correct_seqs = n_seqs = 0
+    latents, encode_time, forward_time, generate_time = [], [], [], []
+    with torch.no_grad():
+        for input_ids in batches:
+            labels = input_ids.masked_fill(input_ids == model.config.t5.pad_token_id, -100)
+            attention_mask = input_ids.ne(model.config.t5.pad_token_id).long()
+
+            start = time.perf_counter()
+            encoding = model._get_encoder_outputs(input_ids=input_ids, attention_mask=attention_mask)
+            latent = model.vae.encoder(encoding.last_hidden_state)
+            encode_time.append(time.perf_counter() - start)
+            latents.append(latent)
+
+            start = time.perf_counter()
+            logits = model(input_ids=input_ids, labels=labels).logits
+            forward_time.append(time.perf_counter() - start)
+            mask = labels.ne(-100)
+            correct = logits.argmax(-1).eq(labels) & mask
+            correct_tokens += int(correct.sum())
+            n_tokens += int(mask.sum())
+            correct_seqs += int((correct | ~mask).all(1).sum())
+            n_seqs += input_ids.size(0)
+
+            start = time.perf_counter()
+            model.generate(
+                input_ids=model.decoder_start_token_id * torch.ones((latent.size(0), 1), dtype=torch.long),
+                latent=latent, bos_token_id=model.decoder_start_token_id, max_length=generate_max_len,
+            )
+            generate_time.append(time.perf_counter() - start)
+    metrics = {
+        "token_accuracy": correct_tokens / max(n_tokens, 1),
+        "seq_accuracy": correct_seqs / max(n_seqs, 1),
+        "encode_ms_per_batch": _mean_seconds(encode_time) * 1000,
+        "reconstruct_ms_per_batch": _mean_seconds(forward_time) * 1000,
+        "generate_ms_per_batch": _mean_seconds(generate_time) * 1000,
+        "weights_mb": state_dict_bytes(model) / 2 ** 20,
+    }
+    return metrics, torch.cat(latents)
+
+
+def parity_report(
+    model: Funnel_T5_VAE_Model, quantized_model: Funnel_T5_VAE_Model, tokenizer, texts: List[str], batch_size=32,
+    generate_max_len: Optional[int] = None
+):
+    '''
+        Compare reconstruction accuracy, latent codes, latency & weight memory of the fp32 & quantized models
+        on `texts`.
+    '''
+    seq_size = model.config.set_seq_size
+    generate_max_len = generate_max_len or seq_size
+    batches = [
+        tokenizer(
+            texts[i:i + batch_size], padding="max_length", truncation=True, max_length=seq_size, return_tensors="pt"
+        )["input_ids"]
+        for i in range(0, len(texts), batch_size)
+    ]
+    fp32_metrics, fp32_latents = _evaluate(model.cpu().eval(), batches, generate_max_len)
+    int8_metrics, int8_latents = _evaluate(quantized_model, batches, generate_max_len)
+    cosine = nn.functional.cosine_similarity(
+        fp32_latents.reshape(-1, fp32_latents.size(-1)), int8_latents.reshape(-1, int8_latents.size(-1)), dim=-1
+    )
+    report = {
+        "n_texts": len(texts), "latent_cosine_mean": cosine.mean().item(), "latent_cosine_min": cosine.min().item()
+    }
+    for name, metrics in [("fp32", fp32_metrics), ("int8", int8_metrics)]:
+        report.update({f"{name}_{key}": value for key, value in metrics.items()})
+    return report
+
+
+@dataclass
+class QuantizeArguments:
+    model_path: str = field(
+        metadata={"help": "Trained model directory, saved with its tokenizer."}
+    )
+    output_dir: str = field(
+        metadata={"help": "Where to save the quantized model & parity report."}
+    )
+    tokenizer_name: Optional[str] = field(
+        default=None,
+        metadata={"help": "Tokenizer name or path, defaults to `model_path`."}
+    )
+    validation_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Held-out text file (txt, csv or json lines) for the parity report."}
+    )
+    text_column: Optional[str] = field(
+        default=None,
+        metadata={"help": "Column of the validation file with the texts, defaults to the first column."}
+    )
+    max_validation_size: int = field(
+        default=1_000,
+        metadata={"help": "Max number of texts used in the parity report."}
+    )
+    batch_size: int = field(
+        default=32,
+        metadata={"help": "Batch size for the parity report."}
+    )
+
+
+def main():
+    args = HfArgumentParser(QuantizeArguments).parse_args_into_dataclasses()[0]
+    model = Funnel_T5_VAE_Model.from_pretrained(args.model_path).eval()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name or args.model_path)
+    save_quantized(quantize_model(model), args.output_dir, tokenizer)
+    logger.info(f"Saved quantized model to {args.output_dir}")
+
+    if args.validation_file:
+        texts = []
+        for text in read_text_file(args.validation_file, args.text_column):
+            if len(texts) == args.max_validation_size:
+                break
+            texts.append(text)
+        report = parity_report(model, load_quantized(args.output_dir), tokenizer, texts, args.batch_size)
+        with open(os.path.join(args.output_dir, "quantization_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Quantization report: {json.dumps(report, indent=2)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+'''
+    Where evaluation samples, tables, images & timings are logged.
+
+    `wandb` logs to Weights & Biases, `jsonl` appends to `metrics.jsonl` in the output dir so runs work offline.
+'''
+import os
+import json
+import atexit
+import time
+import queue
+import threading
+from typing import Any, Dict, List
+import numpy as np
+import torch
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class MetricsSink:
+    '''
+        Logs nothing, used on processes other than the main one.
+    '''
+    def log(self, metrics: Dict[str, Any], step: int):
+        pass
+
+    def log_table(self, name: str, columns: List[str], rows: List[List[Any]], step: int):
+        pass
+
+    def log_image(self, name: str, array: np.ndarray, step: int):
+        pass
+
+    def last_step(self) -> int:
+        '''
+            Latest step already logged by a resumed run, logs for earlier steps may be dropped.
+        '''
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class RecordingSink(MetricsSink):
+    '''
+        Keeps logs to replay them to another sink, used to send logs back from a worker process.
+    '''
+    def __init__(self):
+        self.records: List[tuple] = []
+
+    def log(self, metrics, step):
+        self.records.append(("log", metrics, step))
+
+    def log_table(self, name, columns, rows, step):
+        self.records.append(("log_table", name, columns, rows, step))
+
+    def log_image(self, name, array, step):
+        self.records.append(("log_image", name, array, step))
+
+    def replay(self, sink: MetricsSink):
+        for method, *args in self.records:
+            getattr(sink, method)(*args)
+
+
+class WandbSink(MetricsSink):
+    def __init__(self, output_dir: str):
+        import wandb
+        self.wandb = wandb
+
+    def _log(self, data, step):
+        # W&B drops logs for steps before its latest one, log them now with their step as `eval_step`
+        if step < self.last_step():
+            data, step = {**data, "eval_step": step}, None
+        self.wandb.log(data, step=step)
+
+    def log(self, metrics, step):
+        self._log(metrics, step)
+
+    def log_table(self, name, columns, rows, step):
+        self._log({name: self.wandb.Table(columns=columns, data=rows)}, step)
+
+    def log_image(self, name, array, step):
+        self._log({name: [self.wandb.Image(array)]}, step)
+
+    def last_step(self):
+        return getattr(self.wandb.run, "step", 0) if self.wandb.run is not None else 0
+
+
+def _to_json(value):
+    if isinstance(value, torch.Tensor):
+        return value.tolist()
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Can't log {type(value)} as JSON.")
+
+
+class JsonlSink(MetricsSink):
+    '''
+        Appends a JSON record per log to `metrics.jsonl`, images are saved as `.npy` files next to it.
+
+        Records are written by a background thread so logging doesn't wait on disk, or on the device for tensor values.
+    '''
+    file_name = "metrics.jsonl"
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_records, daemon=True)
+        self._thread.start()
+        # the writer is a daemon thread so write what's left on exit
+        atexit.register(self.close)
+
+    def _put(self, step, **record):
+        self._queue.put({"step": step, "time": time.time(), **record})
+
+    def log(self, metrics, step):
+        self._put(step, **metrics)
+
+    def log_table(self, name, columns, rows, step):
+        self._put(step, table=name, columns=columns, rows=rows)
+
+    def log_image(self, name, array, step):
+        self._put(step, image=name, array=array)
+
+    def _save_image(self, record):
+        os.makedirs(os.path.join(self.output_dir, "images"), exist_ok=True)
+        path = os.path.join("images", f'{record["image"]}_{record["step"]}.npy'.replace(" ", "_"))
+        np.save(os.path.join(self.output_dir, path), record.pop("array"))
+        record["path"] = path
+
+    def _write_records(self):
+        with open(os.path.join(self.output_dir, self.file_name), "a") as f:
+            while True:
+                # write everything queued since the last write together
+                records = [self._queue.get()]
+                while not self._queue.empty():
+                    records.append(self._queue.get_nowait())
+                closing = None in records
+                try:
+                    for record in filter(None, records):
+                        # skip records that can't be written so the thread keeps going & `flush` doesn't hang
+                        try:
+                            if "image" in record:
+                                self._save_image(record)
+                            f.write(json.dumps(record, default=_to_json) + "\n")
+                        except Exception:
+                            logger.exception(f'Skipping metrics record for step {record["step"]}.')
+                    f.flush()
+                finally:
+                    for _ in records:
+                        self._queue.task_done()
+                if closing:
+                    return
+
+    def flush(self):
+        '''
+            Wait until every record logged so far is written.
+        '''
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+METRICS_SINKS = {
+    "wandb": WandbSink,
+    "jsonl": JsonlSink,
+}
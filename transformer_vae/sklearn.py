@@ -1,17 +1,20 @@
+import time
 from collections import namedtuple
 from sklearn import svm
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 import numpy as np
+import torch
+from torch import nn
 
 
 Dataset = namedtuple("Dataset", ["latent", "class_label"])
 
 
 def un_batch(latents_with_class):
-    flat_latents, flat_classes = [], []
-    for latents, classes in latents_with_class:
-        flat_latents += latents
-        flat_classes += classes
-    return Dataset(np.array(flat_latents), np.array(flat_classes))
+    latents, classes = zip(*latents_with_class)
+    return Dataset(np.concatenate([np.asarray(l) for l in latents]), np.concatenate([np.asarray(c) for c in classes]))
 
 
 def train_test_split(dataset: list, test_ratio):
@@ -23,22 +26,74 @@ def train_test_split(dataset: list, test_ratio):
     ]
 
 
-def train_svm(latents_with_class):
-    latents_with_class = un_batch(latents_with_class)
-    train, test = train_test_split(latents_with_class, 0.3)
-    clf = svm.SVC()
+class TorchLinearProbe:
+    '''
+        Softmax regression on standardised features fit with L-BFGS, runs on CPU.
+    '''
+    def __init__(self, max_iter=100, weight_decay=1e-4):
+        self.max_iter = max_iter
+        self.weight_decay = weight_decay
+
+    def fit(self, x, y):
+        self.classes, targets = np.unique(y, return_inverse=True)
+        x = torch.as_tensor(x, dtype=torch.float)
+        self.mean, self.std = x.mean(0), x.std(0).clamp(min=1e-6)
+        x = (x - self.mean) / self.std
+        targets = torch.as_tensor(targets)
+        self.linear = nn.Linear(x.size(1), len(self.classes))
+        optimizer = torch.optim.LBFGS(self.linear.parameters(), max_iter=self.max_iter, line_search_fn="strong_wolfe")
+
+        def closure():
+            optimizer.zero_grad()
+            loss = nn.functional.cross_entropy(self.linear(x), targets)
+            loss = loss + self.weight_decay * (self.linear.weight ** 2).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        return self
+
+    def predict(self, x):
+        x = (torch.as_tensor(x, dtype=torch.float) - self.mean) / self.std
+        with torch.no_grad():
+            return self.classes[self.linear(x).argmax(1).numpy()]
+
+
+CLASSIFIERS = {
+    "svm": svm.SVC,
+    "linear_svm": lambda: make_pipeline(StandardScaler(), svm.LinearSVC()),
+    "logistic": lambda: make_pipeline(StandardScaler(), LogisticRegression(max_iter=1_000)),
+    "torch_probe": TorchLinearProbe,
+}
+
+
+def train_classifier(dataset: Dataset, classifier="svm"):
+    '''
+        Fit a classifier on latent codes, `dataset` holds arrays of latent codes & their class labels.
+    '''
+    train, test = train_test_split(dataset, 0.3)
+    start = time.time()
+    clf = CLASSIFIERS[classifier]()
     clf.fit(train.latent, train.class_label)
+    fit_time = time.time() - start
     predicted_classes = clf.predict(test.latent)
     random_predictions = np.random.randint(
         train.class_label.min(), train.class_label.max(), size=predicted_classes.shape
     )
     return {
-        "svm_classification_test_accuracy": (predicted_classes == test.class_label).sum() / test.class_label.shape[0],
+        f"{classifier}_classification_test_accuracy": (predicted_classes == test.class_label).sum()
+        / test.class_label.shape[0],
         "random_classification_test_accuracy": (random_predictions == test.class_label).sum()
         / test.class_label.shape[0],
+        f"{classifier}_classification_fit_time": fit_time,
+        f"{classifier}_classification_predict_time": time.time() - start - fit_time,
     }
 
 
+def train_svm(latents_with_class):
+    return train_classifier(un_batch(latents_with_class), "svm")
+
+
 def t_sne(self, latents_with_class):
     # TODO get t-sne plot of latent codes then return points for W&B
     # for i, perplexity in enumerate([5, 30, 50, 100]):
@@ -0,0 +1,90 @@
+'''
+    Ring buffer of recent training samples, interpolated between for the critic & cycle losses.
+'''
+from typing import Dict, Optional, Tuple
+import torch
+import torch.nn.functional as F
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+STASH_DTYPES = {
+    "float32": torch.float,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+class SampleStash:
+    '''
+        Fixed number of rows of named per-sample tensors (latent codes, decoder hidden states, input ids...).
+
+        Buffers are allocated on the first `add` from the added tensors' shapes.
+        Names in `row_shapes` are padded along dim 1 with their `pad_values` (default 0) so batches may be shorter.
+        Other names take their row shape from the first batch, a batch with a different shape empties the stash.
+        Floating point values are stored as `dtype` & returned as fp32.
+        With `offload` rows are kept in CPU memory (pinned when using CUDA) & copied without blocking.
+
+        Keeps its own write index so it fills up after `size` samples, however they are split into steps.
+    '''
+    def __init__(
+        self, size: int, dtype=torch.float, device="cpu", offload=False,
+        row_shapes: Optional[Dict[str, Tuple[int, ...]]] = None, pad_values: Optional[Dict[str, int]] = None
+    ):
+        self.size, self.dtype = size, dtype
+        self.device = torch.device("cpu") if offload else torch.device(device)
+        self.pin_memory = offload and torch.cuda.is_available()
+        self.row_shapes, self.pad_values = row_shapes or {}, pad_values or {}
+        self.buffers: Optional[Dict[str, torch.Tensor]] = None
+        self.index = 0
+
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values()) if self.buffers else 0
+
+    def _allocate(self, values):
+        self.buffers = {}
+        for name, value in values.items():
+            dtype = self.dtype if value.is_floating_point() else value.dtype
+            shape = (self.size,) + tuple(self.row_shapes.get(name, value.shape[1:]))
+            self.buffers[name] = torch.empty(shape, dtype=dtype, device=self.device, pin_memory=self.pin_memory)
+
+    def _pad(self, name, value):
+        buffer = self.buffers[name]
+        if value.shape[1:] == buffer.shape[1:]:
+            return value
+        if value.shape[2:] != buffer.shape[2:] or value.size(1) > buffer.size(1):
+            raise ValueError(f'Can\'t stash "{name}" of shape {tuple(value.shape)} in rows of shape {tuple(buffer.shape[1:])}.')
+        return F.pad(value, [0, 0] * (value.dim() - 2) + [0, buffer.size(1) - value.size(1)], value=self.pad_values.get(name, 0))
+
+    def add(self, **values: torch.Tensor) -> bool:
+        '''
+            Write a batch of rows, overwriting the oldest ones. Returns True when this fills the last row.
+        '''
+        if self.buffers is not None and any(
+            name not in self.row_shapes and value.shape[1:] != self.buffers[name].shape[1:] for name, value in values.items()
+        ):
+            shapes = {name: tuple(value.shape[1:]) for name, value in values.items() if name not in self.row_shapes}
+            logger.warning(f"Emptying the sample stash for rows of shape {shapes}, give `row_shapes` to pad them instead.")
+            self.buffers, self.index = None, 0
+        if self.buffers is None:
+            self._allocate(values)
+        n_rows = next(iter(values.values())).size(0)
+        if n_rows > self.size:
+            raise ValueError(f"Can't stash {n_rows} samples in {self.size} rows.")
+        # rows left before wrapping around
+        n_end = min(n_rows, self.size - self.index)
+        for name, value in values.items():
+            # pad & cast on the source device so offloading is a single copy
+            value = self._pad(name, value.detach()).to(self.buffers[name].dtype)
+            self.buffers[name][self.index:self.index + n_end].copy_(value[:n_end], non_blocking=True)
+            self.buffers[name][:n_rows - n_end].copy_(value[n_end:], non_blocking=True)
+        filled = self.index + n_rows >= self.size
+        self.index = (self.index + n_rows) % self.size
+        return filled
+
+    def get(self, device) -> Dict[str, torch.Tensor]:
+        return {
+            name: buffer.to(device, torch.float if buffer.is_floating_point() else buffer.dtype, non_blocking=True)
+            for name, buffer in self.buffers.items()
+        }
@@ -0,0 +1,85 @@
+"""
+    Read & tokenize training text lazily so the corpus never has to fit in memory or the Arrow cache.
+"""
+import csv
+import json
+import itertools
+from typing import Callable, Iterator, Optional
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def read_text_file(path: str, text_column: Optional[str] = None) -> Iterator[str]:
+    '''
+        Yield texts one at a time from a txt (1 per line), csv or json lines file.
+        Uses the `text` column (or the first column) unless given `text_column`.
+    '''
+    extension = path.split(".")[-1]
+    with open(path, encoding="utf8") as f:
+        if extension == "txt":
+            for line in f:
+                yield line.rstrip("\n")
+        elif extension == "csv":
+            reader = csv.DictReader(f)
+            column = text_column or ("text" if "text" in reader.fieldnames else reader.fieldnames[0])
+            for row in reader:
+                yield row[column]
+        elif extension == "json":
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row[text_column or ("text" if "text" in row else next(iter(row)))]
+        else:
+            raise ValueError(f'Unexpected extension: "{extension}" Expected one of: ["txt", "csv", "json"]')
+
+
+def read_dataset_texts(dataset, text_column: str, batch_size=1_000) -> Iterator[str]:
+    '''
+        Yield texts from a (memory mapped) `datasets.Dataset` a slice at a time.
+    '''
+    for start in range(0, len(dataset), batch_size):
+        yield from dataset[start:start + batch_size][text_column]
+
+
+class StreamingTextDataset(IterableDataset):
+    '''
+        Tokenizes texts as they are read, without padding (the data collator pads each batch).
+
+        Rows are split between dataloader workers & distributed processes so each reads a distinct part of the corpus.
+        Loops over the texts forever, training length is set with `max_steps`.
+
+        Args:
+            texts: Returns a fresh iterator over the corpus texts.
+            tokenizer: Tokenizer to use, truncates to `tokenizer.model_max_length`.
+            tokenize_batch_size: Texts tokenized at once.
+    '''
+    def __init__(self, texts: Callable[[], Iterator[str]], tokenizer, tokenize_batch_size=256):
+        self.texts = texts
+        self.tokenizer = tokenizer
+        self.tokenize_batch_size = tokenize_batch_size
+
+    def _shard_texts(self):
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker else (1, 0)
+        n_shards = world_size * num_workers
+        shard = rank * num_workers + worker_id
+        while True:
+            empty = True
+            for text in itertools.islice(self.texts(), shard, None, n_shards):
+                empty = False
+                yield text
+            if empty:
+                # fewer texts than shards
+                return
+
+    def __iter__(self):
+        texts = self._shard_texts()
+        while True:
+            batch = list(itertools.islice(texts, self.tokenize_batch_size))
+            if not batch:
+                return
+            for input_ids in self.tokenizer(batch, truncation=True)["input_ids"]:
+                yield {"input_ids": input_ids}
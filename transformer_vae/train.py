@@ -1,5 +1,5 @@
 """
-    Train Transformer-VAEs using the Huggingface Trainer with Weights and Biasis.
+    Train Transformer-VAEs using the Huggingface Trainer, logging to Weights and Biasis or a local `metrics_sink`.
 """
 import logging
 import inspect
@@ -8,7 +8,7 @@ import sys
 from dataclasses import dataclass, field, make_dataclass
 from typing import Optional, Any
 
-from datasets import load_dataset
+from datasets import load_dataset, DatasetDict
 import transformers
 from transformers import (
     AutoTokenizer,
@@ -24,7 +24,13 @@ from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
 from transformer_vae.trainer_callback import TellModelGlobalStep
 from transformer_vae.model import Funnel_T5_VAE_Model
 from transformer_vae.sequence_checks import SEQ_CHECKS
+from transformer_vae.sklearn import CLASSIFIERS
+from transformer_vae.sinks import METRICS_SINKS
+from transformer_vae.interpolation import INTERPOLATION_DECODING
+from transformer_vae.stash import STASH_DTYPES
+from transformer_vae.streaming import StreamingTextDataset, read_text_file, read_dataset_texts
 from transformer_vae.config import Funnel_T5_VAE_Config
+from transformer_vae.utils import assertIn
 
 
 logger = logging.getLogger(__name__)
@@ -60,6 +66,18 @@ class VAE_TrainingArguments(TrainingArguments):
         default=False,
         metadata={"help": "Test using latent codes for unsupervised classification."},
     )
+    classifier: str = field(
+        default="svm",
+        metadata={"help": f"Classifier to fit on latent codes when using `test_classification`. Options: {', '.join(CLASSIFIERS.keys())}"},
+    )
+    interpolation_pairs: int = field(
+        default=1,
+        metadata={"help": "Number of pairs of eval samples to interpolate between when using `sample_from_latent`, pass rates are averaged over all pairs."},
+    )
+    interpolation_batch_size: int = field(
+        default=64,
+        metadata={"help": "Max number of interpolation points decoded in one `generate` call."},
+    )
     cycle_loss: bool = field(
         default=False,
         metadata={"help": "Encourage the encoder & decoder to produce a bijective mapping. Feeds the final decoder hidden state to the encoder and compares the latent codes."},
@@ -78,12 +96,34 @@ class VAE_TrainingArguments(TrainingArguments):
     )
     interpolate_training_step_rate: int = field(
         default=1,
-        metadata={"help": "Run a batch of iterpolation losses every N steps."},
+        metadata={"help": "Run a batch of iterpolation losses every N batches, each gradient accumulation step counts as a batch."},
     )
     min_critic_steps: int = field(
         default=1_000,
         metadata={"help": "Start updating the model with the critic loss after N steps."},
     )
+    critic_bf16: bool = field(
+        default=False,
+        metadata={"help": "Run the critic with bfloat16 autocast, even when training the model in fp32."},
+    )
+    stash_dtype: str = field(
+        default="float32",
+        metadata={"help": f"Dtype to keep samples in between interpolation losses. Options: {', '.join(STASH_DTYPES.keys())}"},
+    )
+    stash_offload: bool = field(
+        default=False,
+        metadata={"help": "Keep samples in (pinned) CPU memory between interpolation losses, copying them without blocking."},
+    )
+    interpolation_decoding: str = field(
+        default="generate",
+        metadata={"help": f"""How the critic & cycle losses decode interpolated latent codes. Options: {', '.join(INTERPOLATION_DECODING)}
+                            `generate` decodes autoregressively, `nearest` teacher-forces the tokens of the nearest real sample in one pass,
+                            `refine` then replaces them with the decoder's predictions `interpolation_refine_steps` times in parallel passes."""},
+    )
+    interpolation_refine_steps: int = field(
+        default=2,
+        metadata={"help": "Number of parallel refinement passes with `interpolation_decoding refine`."},
+    )
     render_text_image: bool = field(
         default=False,
         metadata={"help": """Render sequence as an image and log it to Weights & Biasis during interpolations.
@@ -98,6 +138,32 @@ class VAE_TrainingArguments(TrainingArguments):
         default=False,
         metadata={"help": "Treat all latent tokens as one during slerp."},
     )
+    sortish_sampler: bool = field(
+        default=False,
+        metadata={"help": "Batch sequences of similar length together & pad each batch to a multiple of the Funnel pooling stride rather than to `set_seq_size`. Can't be used with window attention, the critic or cycle losses."},
+    )
+
+    async_latent_eval: bool = field(
+        default=False,
+        metadata={"help": "Run the `sample_from_latent` & `test_classification` evaluations on a snapshot of the model in a CPU worker process while training continues. Results are logged against the step they were taken at."},
+    )
+    metrics_sink: str = field(
+        default="wandb",
+        metadata={"help": f"Where to log evaluation samples, tables & timings. Options: {', '.join(METRICS_SINKS.keys())}"},
+    )
+    bf16: bool = field(
+        default=False,
+        metadata={"help": "Use bfloat16 autocast for training, evaluation & generation, works on CPU & CUDA. The MMD, slerp & loss stay in fp32."},
+    )
+
+    def __post_init__(self):
+        super().__post_init__()
+        assertIn(self.classifier, CLASSIFIERS.keys(), "Unexpected classifier.")
+        assertIn(self.metrics_sink, METRICS_SINKS.keys(), "Unexpected metrics sink.")
+        assertIn(self.interpolation_decoding, INTERPOLATION_DECODING, "Unexpected interpolation decoding.")
+        assertIn(self.stash_dtype, STASH_DTYPES.keys(), "Unexpected stash dtype.")
+        if self.bf16 and self.fp16:
+            raise ValueError("Use either `bf16` or `fp16`.")
 
 
 """
@@ -191,6 +257,14 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "How many classes in the data, found using a ClassLabel column if none given."},
     )
+    streaming: bool = field(
+        default=False,
+        metadata={"help": "Read & tokenize training texts as they are needed, padding each batch in the data collator. Needs `max_steps`."},
+    )
+    streaming_tokenize_batch_size: int = field(
+        default=256,
+        metadata={"help": "How many texts each dataloader worker tokenizes at once when streaming."},
+    )
 
     def __post_init__(self):
         if self.dataset_name is None and self.train_file is None and self.validation_file is None:
@@ -244,7 +318,7 @@ def setup_logs(training_args):
     # Log on each process the small summary:
     logger.warning(
         f"Process rank: {training_args.local_rank}, device: {training_args.device}, n_gpu: {training_args.n_gpu}"
-        + f", distributed training: {bool(training_args.local_rank != -1)}, 16-bits training: {training_args.fp16}"
+        + f", distributed training: {bool(training_args.local_rank != -1)}, 16-bits training: {training_args.fp16 or training_args.bf16}"
     )
     # Set the verbosity to info of the Transformers logger (on main process only):
     if is_main_process(training_args.local_rank):
@@ -266,11 +340,14 @@ def get_datasets(data_args):
         # Downloading and loading a dataset from the hub.
         return load_dataset(data_args.dataset_name, data_args.dataset_config_name) # , script_version=data_args.script_version
     data_files = {}
-    if data_args.train_file is not None:
+    if data_args.train_file is not None and not data_args.streaming:
         data_files["train"] = data_args.train_file
     if data_args.validation_file is not None:
         data_files[data_args.validation_name] = data_args.validation_file
-    extension = data_args.train_file.split(".")[-1]
+    if not data_files:
+        # streaming the training file without validation data
+        return DatasetDict()
+    extension = (data_args.train_file or data_args.validation_file).split(".")[-1]
     if extension == "txt":
         extension = "text"
     return load_dataset(extension, data_files=data_files)
@@ -325,7 +402,7 @@ def load_model_and_tokenizer(model_args):
     return model, tokenizer
 
 
-def preprocess_datasets(training_args, data_args, tokenizer, datasets):
+def preprocess_datasets(training_args, data_args, tokenizer, datasets, config=None):
     # Add class_label if needed
     if training_args.test_classification:
         if data_args.classification_column != "class_label":
@@ -341,10 +418,13 @@ def preprocess_datasets(training_args, data_args, tokenizer, datasets):
             datasets = datasets.map(add_class_column, remove_columns=[data_args.classification_column])
 
     # tokenize all the texts.
-    if training_args.do_train:
+    streaming_train_file = data_args.streaming and data_args.train_file is not None
+    if training_args.do_train and not streaming_train_file:
         column_names = datasets["train"].column_names
-    else:
+    elif data_args.validation_name in datasets:
         column_names = datasets[data_args.validation_name].column_names
+    else:
+        column_names = ["text"]
     if data_args.text_column is not None:
         text_column_name = data_args.text_column
     else:
@@ -353,7 +433,21 @@ def preprocess_datasets(training_args, data_args, tokenizer, datasets):
     if text_column_name != "text":
         logger.info(f'Using column "{text_column_name}" as text column.')
 
-    if tokenizer.pad_token_id is None:
+    streaming_train_dataset = None
+    if data_args.streaming:
+        if streaming_train_file:
+            def texts():
+                return read_text_file(data_args.train_file, data_args.text_column)
+        else:
+            train_dataset = datasets["train"]
+
+            def texts():
+                return read_dataset_texts(train_dataset, text_column_name)
+        streaming_train_dataset = StreamingTextDataset(texts, tokenizer, data_args.streaming_tokenize_batch_size)
+        datasets = DatasetDict({name: dataset for name, dataset in datasets.items() if name != "train"})
+
+    if tokenizer.pad_token_id is None or training_args.sortish_sampler:
+        # batches are padded by the data collator
         def tokenize_function(examples):
             return tokenizer(examples[text_column_name], truncation=True)
     else:
@@ -374,7 +468,23 @@ def preprocess_datasets(training_args, data_args, tokenizer, datasets):
             training_args.max_validation_size
         )["test"]
 
-    data_collator = DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=data_args.mlm_probability)
+    if streaming_train_dataset is not None:
+        tokenized_datasets["train"] = streaming_train_dataset
+
+    pad_to_multiple_of, min_length = None, 0
+    if training_args.sortish_sampler:
+        # pad to a multiple of the Funnel pooling stride, long enough to pool into `n_latent_tokens`
+        pad_to_multiple_of = 2 ** (len(config.funnel.block_sizes) - 1)
+        min_length = pad_to_multiple_of * max(config.n_latent_tokens, 1)
+
+    data_collator = DataCollatorForLanguageAutoencoding(
+        tokenizer=tokenizer,
+        mlm_probability=data_args.mlm_probability,
+        # streamed rows are unpadded, pad to `tokenizer.model_max_length`
+        padding="max_length" if data_args.streaming else False,
+        pad_to_multiple_of=pad_to_multiple_of,
+        min_length=min_length,
+    )
 
     return data_collator, tokenized_datasets
 
@@ -393,8 +503,11 @@ def main():
     datasets = get_datasets(data_args)
 
     model, tokenizer = load_model_and_tokenizer(model_args)
+    if training_args.metrics_sink != "wandb":
+        # local sinks log the model's extra training metrics too
+        model.config.use_extra_logs = True
 
-    data_collator, tokenized_datasets = preprocess_datasets(training_args, data_args, tokenizer, datasets)
+    data_collator, tokenized_datasets = preprocess_datasets(training_args, data_args, tokenizer, datasets, model.config)
 
     # Initialize our Trainer
     trainer = VAE_Trainer(
@@ -431,6 +544,8 @@ def main():
                     logger.info(f"  {key} = {value}")
                     writer.write(f"{key} = {value}\n")
 
+    trainer.finish_async_evals()
+    trainer.metrics_sink.close()
     return results
 
 
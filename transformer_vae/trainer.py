@@ -1,9 +1,13 @@
 import time
+import collections
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, Dict, List, Tuple, Union, Any
-import wandb
 import numpy as np
 import torch
+import torch.multiprocessing
 from torch import nn, autograd
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import RandomSampler
 from torch.utils.data.dataloader import DataLoader
@@ -12,9 +16,9 @@ from torch.cuda.amp import autocast
 from transformers import trainer as trainer_script
 from transformers.utils import logging
 from transformers.optimization import AdamW, get_scheduler
+from transformers.trainer_pt_utils import DistributedLengthGroupedSampler
 from transformers.integrations import (
     WandbCallback,
-    is_wandb_available,
     is_fairscale_available,
     TensorBoardCallback,
     CometCallback,
@@ -29,10 +33,14 @@ if is_fairscale_available():
     from fairscale.optim import OSS
 
 from transformer_vae.optimizers import FixedAdafactor
+from transformer_vae.checkpoint_policy import plan_checkpointing
 from transformer_vae.sequence_checks import SEQ_CHECKS
-from transformer_vae.trainer_callback import WandbCallbackUseModelLogs
-from transformer_vae.sklearn import train_svm
-from transformer_vae.utils import slerp
+from transformer_vae.interpolation import interpolation_ratios, interpolation_grid, batched_interpolations
+from transformer_vae.trainer_callback import WandbCallbackUseModelLogs, MetricsSinkCallback
+from transformer_vae.sinks import METRICS_SINKS, MetricsSink, RecordingSink, WandbSink
+from transformer_vae.stash import SampleStash, STASH_DTYPES
+from transformer_vae.sklearn import train_classifier, Dataset as ClassDataset
+from transformer_vae.utils import slerp, SortishSampler, SectionTimer, autocast_bf16
 
 logger = logging.get_logger(__name__)
 
@@ -44,28 +52,40 @@ for logger_integration in NOT_ALLOWED_LOGGERS:
     if logger_integration in trainer_script.DEFAULT_CALLBACKS:
         trainer_script.DEFAULT_CALLBACKS.remove(logger_integration)
         removed.append(logger_integration)
-    logger.info(f"Only supports W&B logging, removed loggers: {removed}")
+    logger.info(f"Only supports W&B or `metrics_sink` logging, removed loggers: {removed}")
 
 
 class VAE_Trainer(trainer_script.Trainer):
     text_to_array = None
 
-    def __init__(self, model=None, args=None, custom_methods={}, **kwargs):
-        self.latent_stack = torch.zeros(
-            args.interpolate_training_step_rate * args.train_batch_size, model.config.latent_size,
-            dtype=torch.float, device=args.device
-        )
-        self.final_decoder_hidden_state_stack = torch.zeros(
-            args.interpolate_training_step_rate * args.train_batch_size, model.config.t5.n_positions, model.config.t5.d_model,
-            dtype=torch.float, device=args.device
-        )
+    def __init__(self, model=None, args=None, custom_methods={}, metrics_sink=None, **kwargs):
+        # recent samples to interpolate between, only allocated when using the critic or cycle losses
+        self.sample_stash = None
+        self._critic_timer = SectionTimer(args.device)
         self.clean_tkn_spaces = not args.dont_clean_up_tokenization_spaces
+        if args.sortish_sampler and model.config.attention_window_size:
+            raise ValueError("Window attention needs sequences padded to `set_seq_size`, can't use `sortish_sampler`.")
+        if args.sortish_sampler and (model.critic or args.cycle_loss or args.vae_cycle_loss):
+            # stashed samples of different lengths can't be compared & padding would give the critic a cue
+            raise ValueError("The critic & cycle losses need sequences padded to `set_seq_size`, can't use `sortish_sampler`.")
+        self._tokens_since_log, self._padded_tokens_since_log = 0, 0
+        self._last_log_time, self._last_log_step = time.time(), 0
+        self.checkpoint_plan, self._checkpoint_logs = None, {}
+        self.custom_methods = custom_methods
         if args.render_text_image:
             assert 'custom_text_to_array' in custom_methods
             self.text_to_array = custom_methods['custom_text_to_array']
+        self._async_eval_executor, self._async_evals = None, []
         super().__init__(model, args, **kwargs)
+        if metrics_sink is None:
+            # only the main process logs evaluation samples
+            metrics_sink = METRICS_SINKS[args.metrics_sink](args.output_dir) if self.is_world_process_zero() else MetricsSink()
+        self.metrics_sink = metrics_sink
         self.remove_callback(WandbCallback)
-        self.add_callback(WandbCallbackUseModelLogs)
+        if isinstance(metrics_sink, WandbSink):
+            self.add_callback(WandbCallbackUseModelLogs)
+        else:
+            self.add_callback(MetricsSinkCallback(metrics_sink))
 
     def create_optimizer_and_scheduler(self, num_training_steps: int):
         """
@@ -114,8 +134,27 @@ class VAE_Trainer(trainer_script.Trainer):
                 num_training_steps=num_training_steps,
             )
 
+    def _get_train_sampler(self) -> Optional[torch.utils.data.sampler.Sampler]:
+        '''
+            Use `SortishSampler` to batch sequences of similar lengths when using `sortish_sampler`.
+        '''
+        if not self.args.sortish_sampler or not isinstance(self.train_dataset, collections.abc.Sized):
+            return super()._get_train_sampler()
+        lengths = [len(input_ids) for input_ids in self.train_dataset["input_ids"]]
+        if self.args.local_rank != -1:
+            return DistributedLengthGroupedSampler(
+                self.train_dataset, self.args.train_batch_size, seed=self.args.seed, lengths=lengths
+            )
+        return SortishSampler(lengths, bs=self.args.train_batch_size)
+
+    def _autocast(self):
+        '''
+            bfloat16 autocast when training with `bf16`.
+        '''
+        return autocast_bf16(self.args.device.type, enabled=self.args.bf16)
+
     def _tokens_from_latent(self, latent):
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             old = self.model.config.use_extra_logs
             self.model.config.use_extra_logs = False
             result = self.model.generate(
@@ -131,93 +170,101 @@ class VAE_Trainer(trainer_script.Trainer):
 
     def _log_image(self, texts):
         '''
-            Parse texts as images and log a single, long image to Weights and Biasis.
+            Parse texts as images and log a single, long image to the metrics sink.
         '''
         single_image_array = np.concatenate([self.text_to_array(txt) * 255 for txt in texts], axis=1)
-        wandb.log({"image_interpolation": [wandb.Image(single_image_array)]}, step=self.state.global_step)
+        self.metrics_sink.log_image("image_interpolation", single_image_array, self.state.global_step)
 
     def _interpolate_samples(self, eval_dataset):
         '''
-            Interpolates between 2 latent encodings of real points.
-            Results are logged to Weights and Biasis.
+            Interpolates between the latent encodings of `interpolation_pairs` pairs of real points.
+            Logs a table for the first pair, per-ratio seq check pass rates over all pairs & the time per interpolation point.
         '''
-        mini_eval_dataloader_iter = iter(
+        samples = next(iter(
             DataLoader(
                 eval_dataset,
                 sampler=RandomSampler(eval_dataset),
-                batch_size=2,
+                batch_size=2 * self.args.interpolation_pairs,
                 collate_fn=self.data_collator,
             )
+        ))
+        samples = self._prepare_inputs(samples)
+        ratios = interpolation_ratios(device=self.args.device)
+        start = time.time()
+        _, texts = batched_interpolations(
+            self.model, samples, ratios, self._text_from_latent, self.args.interpolation_batch_size, self.args.interpolate_all_at_once
         )
-        samples = self._prepare_inputs(next(mini_eval_dataloader_iter))
-        latents = self.model(**samples).latent
-        interp_latent, interp_ratio = self.gradual_interpolation_inputs(latents[0], latents[1], self.args.device, self.args.interpolate_all_at_once)
+        seq_check = SEQ_CHECKS[self.args.seq_check]
+        valid = np.array([[seq_check(text, self.text_to_array) for text in pair_texts] for pair_texts in texts])
+        seconds_per_point = (time.time() - start) / valid.size
+
         start_txt = self.tokenizer.decode(samples["input_ids"][0], clean_up_tokenization_spaces=self.clean_tkn_spaces)
         end_txt = self.tokenizer.decode(samples["input_ids"][1], clean_up_tokenization_spaces=self.clean_tkn_spaces)
-        texts = self._text_from_latent(interp_latent)
-
         if self.args.render_text_image:
-            self._log_image([start_txt] + texts + [end_txt])
+            self._log_image([start_txt] + texts[0] + [end_txt])
 
-        seq_check_results = 0
-        seq_check = SEQ_CHECKS[self.args.seq_check]
-        table = wandb.Table(columns=["Interpolation Ratio", "Text", "Valid"])
-        table.add_data(-10, start_txt, True)
+        rows = [[-10, start_txt, True]]
+        for ratio, text, pair_valid in zip(ratios.tolist(), texts[0], valid[0].tolist()):
+            rows.append([ratio, text, pair_valid])
+        rows.append([10, end_txt, True])
+        self.metrics_sink.log_table("interpolate points", ["Interpolation Ratio", "Text", "Valid"], rows, self.state.global_step)
 
-        for i in range(11):
-            valid = seq_check(texts[i], self.text_to_array)
-            table.add_data(interp_ratio[i].item(), texts[i], valid)
-            if i > 0 and i < 10:
-                seq_check_results += int(valid)
-        table.add_data(10, end_txt, True)
-
-        wandb.log({"interpolate points": table}, step=self.state.global_step)
+        logs = {"eval_interpolation_seconds_per_point": seconds_per_point}
         if self.args.seq_check:
-            wandb.log(
-                {'interpolation samples passing seq check': seq_check_results / 9},
-                step=self.state.global_step
-            )
+            # the end points are reconstructions so only the inner ratios count
+            logs['interpolation samples passing seq check'] = valid[:, 1:-1].mean()
+            for ratio, pass_rate in zip(ratios.tolist(), valid.mean(axis=0).tolist()):
+                logs[f'interpolation pass rate {ratio:.1f}'] = pass_rate
+        self.metrics_sink.log(logs, self.state.global_step)
 
     def _random_samples(self):
         raise NotImplementedError('Not sampling from true prioir here.')
         # TODO This should be random samples from the models prior but in an MMD-VAE the prior doesn't actually match a gaussian so this needs to change.
-        table = wandb.Table(columns=["Text", "Valid"])
+        rows = []
         seq_check_results = 0
         seq_check = SEQ_CHECKS[self.args.seq_check]
         latent_points = torch.randn(25, self.model.config.latent_size, device=self.model.device)
         texts = self._text_from_latent(latent_points)
         for txt in texts:
             valid = seq_check(txt)
-            table.add_data(txt, valid)
+            rows.append([txt, valid])
             seq_check_results += int(valid)
 
-        wandb.log({"random points": table}, step=self.state.global_step)
+        self.metrics_sink.log_table("random points", ["Text", "Valid"], rows, self.state.global_step)
         if self.args.seq_check:
-            wandb.log(
-                {'random samples passing seq check': seq_check_results / latent_points.size(0)},
-                step=self.state.global_step
+            self.metrics_sink.log(
+                {'random samples passing seq check': seq_check_results / latent_points.size(0)}, self.state.global_step
             )
 
     def _latent_with_class(self, eval_dataset):
+        '''
+            Get latent codes & class labels for the eval dataset as preallocated arrays.
+            Only runs the encoder & VAE since the decoder isn't needed for latent codes.
+        '''
+        start = time.time()
         dataloader = self.get_eval_dataloader(eval_dataset)
-        latents_with_class = []
+        n_samples = len(dataloader.dataset)
+        latents, class_labels, pos = None, np.empty(n_samples, dtype=np.int64), 0
         for inputs in dataloader:
             class_label = inputs.pop("class_label")
+            inputs.pop("labels", None)
 
             inputs = self._prepare_inputs(inputs)
-            outputs = self.model(**inputs)
-
-            latent = outputs.get("latent")
+            latent = self.model(**inputs).get("latent")
             latent = latent.reshape(latent.size(0), -1)  # join all latents into one
-            row = [latent.tolist()]
-            row.append(class_label.tolist())  # type: ignore
+            if latents is None:
+                latents = np.empty((n_samples, latent.size(1)), dtype=np.float32)
 
-            latents_with_class.append(row)
-        return latents_with_class
+            batch_size = latent.size(0)
+            latents[pos:pos + batch_size] = latent.float().cpu().numpy()
+            class_labels[pos:pos + batch_size] = class_label.numpy()
+            pos += batch_size
+        self.metrics_sink.log({"eval_latent_encode_time": time.time() - start}, self.state.global_step)
+        return ClassDataset(latents[:pos], class_labels[:pos])
 
     def _svm_classification(self, latents_with_class):
-        accuracy_log = train_svm(latents_with_class)
-        wandb.log(accuracy_log, step=self.state.global_step)
+        accuracy_log = train_classifier(latents_with_class, self.args.classifier)
+        self.metrics_sink.log(accuracy_log, self.state.global_step)
 
     def _t_sne(self, latents_with_class):
         # TODO use wandb.plot
@@ -282,25 +329,36 @@ class VAE_Trainer(trainer_script.Trainer):
 
     @staticmethod
     def gradual_interpolation_inputs(latent_start, latent_end, device, interpolate_all_at_once):
-        ratios = torch.arange(0, 1.1, 0.1, device=device)
-        num_latent_tokens = latent_start.size(0)
-        latent_token_dim = latent_start.size(1)
-        if interpolate_all_at_once:
-            latent_start, latent_end = latent_start.view(1, -1), latent_end.view(1, -1)
-            interpolations = slerp(ratios, latent_start.repeat(11, 1), latent_end.repeat(11, 1))
-            return interpolations.view(11, num_latent_tokens, latent_token_dim), ratios
-        # get list of repeating ratios so [0.0, 0.0, 0.1, 0.1,,,] when num_latent_tokens=2
-        rep_ratios = ratios.repeat(num_latent_tokens, 1).T.reshape(-1)
-        interpolations = slerp(rep_ratios, latent_start.repeat(11, 1), latent_end.repeat(11, 1))
-        return interpolations.view(11, num_latent_tokens, latent_token_dim), ratios
+        ratios = interpolation_ratios(device=device)
+        return interpolation_grid(latent_start[None], latent_end[None], ratios, interpolate_all_at_once)[0], ratios
 
     def random_interpolation_inputs(self, latent):
         batch_size = latent.size(0)
-        interpolation_ratios = 0.5 - (torch.rand(batch_size, device=self.args.device) - 0.5).abs()
-        latent_interpolated = slerp(interpolation_ratios, latent, latent[::-1])
-        return latent_interpolated, interpolation_ratios
+        ratios = 0.5 - (torch.rand(batch_size, device=self.args.device) - 0.5).abs()
+        # one ratio per sample, broadcast over its latent tokens
+        latent_interpolated = slerp(ratios.view(-1, *([1] * (latent.dim() - 2))), latent, latent.flip(0))
+        return latent_interpolated, ratios
 
-    def prepare_interpolation_data(self, latent, model):
+    def _interpolation_decoder_input_ids(self, interp_latent, input_ids, model):
+        '''
+            Decoder inputs for interpolated latent codes, see `interpolation_decoding`.
+            Each interpolation has a ratio <= 0.5 from the sample at its index in `input_ids`, so that is its nearest real sample.
+        '''
+        pad_token_id = self.model.config.t5.pad_token_id
+        if self.args.interpolation_decoding == "generate":
+            tokens = self._tokens_from_latent(interp_latent)[:, :input_ids.size(1)]
+            # pad like the real samples so re-encoding them gives as many latent tokens
+            return F.pad(tokens, (0, input_ids.size(1) - tokens.size(1)), value=pad_token_id)
+        tokens = input_ids
+        refine_steps = self.args.interpolation_refine_steps if self.args.interpolation_decoding == "refine" else 0
+        with torch.no_grad():
+            for _ in range(refine_steps):
+                logits = model(decoder_input_ids=self.model._shift_right(tokens), latent=interp_latent).logits
+                # keep the nearest sample's length
+                tokens = logits.argmax(-1).masked_fill(input_ids.eq(pad_token_id), pad_token_id)
+        return self.model._shift_right(tokens)
+
+    def prepare_interpolation_data(self, latent, model, input_ids):
         '''
         For optimising model interpolations directly, find interpolated latent codes with their ratio.
         Produces 1 interpolation for every 2 samples.
@@ -308,72 +366,97 @@ class VAE_Trainer(trainer_script.Trainer):
         original_latent = latent.detach()
         original_latent.requires_grad = True
         interp_latent, interp_ratio = self.random_interpolation_inputs(original_latent)
-        tokens = self._tokens_from_latent(interp_latent)
         # don't log interpolation inference
         old = model.config.use_extra_logs
         model.config.use_extra_logs = False
+        tokens = self._interpolation_decoder_input_ids(interp_latent, input_ids, model)
         interp_outputs = model(decoder_input_ids=tokens, latent=interp_latent, output_hidden_states=True)
         model.config.use_extra_logs = old
 
         return interp_latent, interp_outputs.reconstructed_encoding, interp_outputs.hidden_states[-1], interp_ratio
 
-    def training_interpolation_step(self, final_decoder_hidden_states, latent, model):
+    def _critic_autocast(self):
+        return autocast_bf16(self.args.device.type, enabled=self.args.bf16 or self.args.critic_bf16)
+
+    def _critic_step(self, real_hidden_states, interpolated_hidden_states, interpolation_ratios, model):
+        '''
+            The critic learns to predict the interpolation ratio of decoder hidden states (0 for real samples).
+            After `min_critic_steps` the decoder also learns to make interpolations look real.
+
+            Real & interpolated samples go through the critic in one forward pass.
+        '''
+        n_samples = interpolated_hidden_states.size(0)
+        update_model = self.state.global_step > self.args.min_critic_steps
+        # a separate leaf so the critic loss doesn't reach the decoder
+        interpolated_d = interpolated_hidden_states.detach().requires_grad_(update_model)
+        with self._critic_autocast():
+            scores = model.critic(torch.cat([real_hidden_states.to(interpolated_d.dtype), interpolated_d])).float()
+        if update_model:
+            critic_loss_on_model = scores[n_samples:].mean() * self.args.advisery_weight / n_samples
+            # get gradients of the output only w.r.t the inputs and not model.critic
+            critic_loss_to_last_hidden = autograd.grad(outputs=critic_loss_on_model, inputs=interpolated_d, retain_graph=True)
+            # acumulate gradient in VAE model (will only be the VAE-decoder)
+            interpolated_hidden_states.backward(critic_loss_to_last_hidden, retain_graph=True)
+            model.metrics.add(critic_loss_on_model=critic_loss_on_model)
+
+        targets = torch.cat([torch.zeros(n_samples, 1, device=scores.device), interpolation_ratios.detach().view(-1, 1).float()])
+        # with as many real as interpolated samples this is the mean of their 2 losses, like before batching them
+        critic_loss = model.critic.loss(scores, targets) / n_samples
+        critic_loss.backward()  # accumulate gradient on critic
+        model.metrics.add(critic_loss=critic_loss)
+
+    def training_interpolation_step(self, final_decoder_hidden_states, latent, model, input_ids):
         '''
             Sample interpolations to add additional losses.
 
             None of these have substantially improved interpolation quality yet.
+            With `bf16` the forward passes use autocast while the losses & backward passes stay in fp32.
         '''
-        interpolated_latent, reconstructed_encoding, interpolated_last_hidden_state, target_a = self.prepare_interpolation_data(latent, model)
-        interpolated_last_hidden_state_d = interpolated_last_hidden_state.detach()
+        with self._autocast():
+            interpolated_latent, reconstructed_encoding, interpolated_last_hidden_state, target_a = self.prepare_interpolation_data(latent, model, input_ids)
 
         if self.args.cycle_loss:
             # minimise cosine error between latent code & re-encoded latent code `latent VS Encode(Decode(latent))`
+            # compare each sample's latent tokens joined into one code
             target = 1.0 * torch.ones(interpolated_latent.size(0), device=self.args.device)
             old = model.config.use_extra_logs
             model.config.use_extra_logs = False
-            cycle_loss = torch.nn.CosineEmbeddingLoss()(
-                model(inputs_embeds=interpolated_last_hidden_state).latent, interpolated_latent, target
-            )
+            with self._autocast():
+                cycle_latent = model(inputs_embeds=interpolated_last_hidden_state).latent
+            cycle_loss = torch.nn.CosineEmbeddingLoss()(cycle_latent.float().flatten(1), interpolated_latent.float().flatten(1), target)
             model.config.use_extra_logs = old
             cycle_loss *= self.args.cycle_weight
             cycle_loss /= interpolated_latent.size(0)
             cycle_loss.backward(retain_graph=True)
-            model.latest_logs['cycle_loss'] = model.latest_logs.get('cycle_loss', 0) + cycle_loss.item()
+            model.metrics.add(cycle_loss=cycle_loss)
         elif self.args.vae_cycle_loss:
             target = 1.0 * torch.ones(interpolated_latent.size(0), device=self.args.device)
             old = model.config.use_extra_logs
             model.config.use_extra_logs = False
-            cycle_loss = torch.nn.CosineEmbeddingLoss()(
-                model.vae(reconstructed_encoding, skip_reg_loss=True).latent, interpolated_latent, target
-            )
+            with self._autocast():
+                cycle_latent = model.vae(reconstructed_encoding, skip_reg_loss=True).latent
+            cycle_loss = torch.nn.CosineEmbeddingLoss()(cycle_latent.float().flatten(1), interpolated_latent.float().flatten(1), target)
             model.config.use_extra_logs = old
             cycle_loss *= self.args.cycle_weight
             cycle_loss /= interpolated_latent.size(0)
             cycle_loss.backward(retain_graph=True)
-            model.latest_logs['cycle_loss'] = model.latest_logs.get('cycle_loss', 0) + cycle_loss.item()
+            model.metrics.add(cycle_loss=cycle_loss)
 
         if model.critic:
-            if self.state.global_step > self.args.min_critic_steps:
-                # update model
-                # accumulate compute graph on critic loss variable
-                critic_loss_on_model = model.critic(interpolated_last_hidden_state).mean() * self.args.advisery_weight / interpolated_last_hidden_state.size(0)
-                # get gradients of the output only w.r.t the inputs and not model.critic
-                critic_loss_to_last_hidden = autograd.grad(outputs=critic_loss_on_model, inputs=interpolated_last_hidden_state, only_inputs=True, retain_graph=True)
-                # acumulate gradient in VAE model (will only be the VAE-decoder)
-                interpolated_last_hidden_state.backward(critic_loss_to_last_hidden, retain_graph=True)
-                model.latest_logs['critic_loss_on_model'] = model.latest_logs.get('critic_loss_on_model', 0) + critic_loss_on_model.item()
-
-            # update critic
-            # real samples
-            final_decoder_hidden_states.size(), latent.size()
-            critic_loss = model.critic(final_decoder_hidden_states, torch.zeros((latent.size(0), 1), device=self.args.device)).mean()
-            # interpolate samples
-            interpolated_last_hidden_state_d = interpolated_last_hidden_state.detach()
-            critic_loss += model.critic(interpolated_last_hidden_state_d, target_a.detach().view(-1, 1)).mean()
-            # average between the 2 losses
-            critic_loss /= 2 * latent.size(0)
-            critic_loss.backward(retain_graph=True)  # accumulate gradient on critic
-            model.latest_logs['critic_loss'] = model.latest_logs.get('critic_loss', 0) + critic_loss.item()
+            with self._critic_timer:
+                self._critic_step(final_decoder_hidden_states, interpolated_last_hidden_state, target_a, model)
+
+    def _create_sample_stash(self):
+        '''
+            Stash `interpolate_training_step_rate` batches of samples, interpolation losses are run each time it fills up.
+        '''
+        t5_config = self.model.config.t5
+        return SampleStash(
+            self.args.interpolate_training_step_rate * self.args.train_batch_size, STASH_DTYPES[self.args.stash_dtype], self.args.device,
+            offload=self.args.stash_offload,
+            row_shapes={"final_decoder_hidden_states": (t5_config.n_positions, t5_config.d_model), "input_ids": (t5_config.n_positions,)},
+            pad_values={"input_ids": t5_config.pad_token_id},
+        )
 
     def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
         """
@@ -383,23 +466,56 @@ class VAE_Trainer(trainer_script.Trainer):
         Adv is currently put on/off single GPU, will need to switch for multi-GPU training.
         """
         model.train()
+        # count on the CPU batch to avoid a device sync
+        self._tokens_since_log += int(inputs["input_ids"].ne(self.tokenizer.pad_token_id).sum())
+        self._padded_tokens_since_log += inputs["input_ids"].numel()
         inputs = self._prepare_inputs(inputs)
+        if self.model.config.checkpoint_memory_budget and self.checkpoint_plan is None:
+            self.checkpoint_plan = plan_checkpointing(self.model, inputs)
+            self._checkpoint_logs = self.checkpoint_plan.logs()
 
         if self.label_smoother is not None and "labels" in inputs:
             labels = inputs.pop("labels")
         else:
             labels = None
-        outputs = model(**inputs, output_hidden_states=True)
-
-        if (hasattr(model, 'critic') and model.critic) or self.args.cycle_loss:
-            pos = self.args.train_batch_size * (self.state.global_step % self.args.interpolate_training_step_rate)
-            self.latent_stack[pos:pos + self.args.train_batch_size] = outputs.latent.detach()
-            self.final_decoder_hidden_state_stack[pos:pos + self.args.train_batch_size] = outputs.decoder_hidden_states[-1].detach()
-            if self.state.global_step > 0 and pos == 0:
-                self.training_interpolation_step(self.final_decoder_hidden_state_stack, self.latent_stack, model)
+        with self._autocast():
+            outputs = model(**inputs, output_hidden_states=True)
+
+        if (hasattr(model, 'critic') and model.critic) or self.args.cycle_loss or self.args.vae_cycle_loss:
+            if self.sample_stash is None:
+                self.sample_stash = self._create_sample_stash()
+            # batches may be padded to less than `n_positions`
+            stash_filled = self.sample_stash.add(
+                latent=outputs.latent, final_decoder_hidden_states=outputs.decoder_hidden_states[-1], input_ids=inputs["input_ids"]
+            )
+            if stash_filled:
+                stashed = self.sample_stash.get(self.args.device)
+                self.training_interpolation_step(stashed["final_decoder_hidden_states"], stashed["latent"], model, stashed["input_ids"])
 
         return self.get_loss_grad(outputs, labels)
 
+    def log(self, logs: Dict[str, float]) -> None:
+        '''
+            Adds training throughput in non-padding tokens/sec, padding efficiency, step time & the critic's share of it to the training logs.
+            The first training log also gets the chosen checkpointing plan's memory & recompute estimates.
+            Also logs the results of finished background evaluations.
+        '''
+        if self._async_evals:
+            self._log_async_latent_evals()
+        if "loss" in logs:
+            logs.update(self._checkpoint_logs)
+            self._checkpoint_logs = {}
+            now = time.time()
+            elapsed = max(now - self._last_log_time, 1e-6)
+            logs["train_tokens_per_second"] = self._tokens_since_log / elapsed
+            logs["train_padding_efficiency"] = self._tokens_since_log / max(self._padded_tokens_since_log, 1)
+            logs["train_step_time"] = elapsed / max(self.state.global_step - self._last_log_step, 1)
+            if self.model.critic:
+                logs["train_critic_time_share"] = self._critic_timer.seconds() / elapsed
+            self._tokens_since_log, self._padded_tokens_since_log = 0, 0
+            self._last_log_time, self._last_log_step = now, self.state.global_step
+        super().log(logs)
+
     def evaluate(self, eval_dataset: Optional[Dataset] = None) -> Dict[str, float]:
         """
         Run evaluation and returns metrics.
@@ -410,20 +526,61 @@ class VAE_Trainer(trainer_script.Trainer):
         if class column provided?
         - tSNE plots with class-label colouring.
         """
-        if self.state.global_step < wandb.run.history._step:
-            self.state.global_step = wandb.run.history._step
-        if is_wandb_available():
-            start_eval = time.time()
+        # a resumed run may have logged later steps
+        self.state.global_step = max(self.state.global_step, self.metrics_sink.last_step())
+        start_eval = time.time()
+        if self.args.async_latent_eval:
+            self._log_async_latent_evals()
+            if self.is_world_process_zero():
+                self._submit_async_latent_eval(eval_dataset)
+        else:
             with torch.no_grad():
                 self.model.eval()
                 self._evaluate_latent_samples(eval_dataset=eval_dataset)
-            generate_time = time.time() - start_eval
+        generate_time = time.time() - start_eval
         output_metrics = super().evaluate(eval_dataset=eval_dataset)
-        if is_wandb_available():
-            wandb.log({"eval_get_test_loss_time": time.time() - start_eval + generate_time}, step=self.state.global_step)  # type: ignore
-            wandb.log({"eval_generate_time": generate_time}, step=self.state.global_step)  # type: ignore
+        self.metrics_sink.log(
+            {"eval_get_test_loss_time": time.time() - start_eval - generate_time, "eval_generate_time": generate_time}, self.state.global_step
+        )
         return output_metrics
 
+    def _submit_async_latent_eval(self, eval_dataset=None):
+        '''
+            Run `_evaluate_latent_samples` on a snapshot of the weights in a worker process while training continues.
+            The worker uses the CPU so it doesn't take memory from training, its logs are replayed at their original step.
+        '''
+        if self._async_eval_executor is None:
+            self._async_eval_executor = ProcessPoolExecutor(max_workers=1, mp_context=torch.multiprocessing.get_context("spawn"))
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in self.model.state_dict().items()}
+        worker_args = dataclasses.replace(
+            self.args, no_cuda=True, local_rank=-1, fp16=False, deepspeed=None, sharded_ddp=False, report_to=[], async_latent_eval=False
+        )
+        self._async_evals.append(self._async_eval_executor.submit(
+            _evaluate_latent_samples_in_worker, self.model.config, state_dict, worker_args, self.state.global_step,
+            eval_dataset if eval_dataset is not None else self.eval_dataset, self.tokenizer, self.data_collator, self.custom_methods,
+        ))
+
+    def _log_async_latent_evals(self, wait=False):
+        '''
+            Log the results of finished background evaluations, with `wait` waits for all of them.
+        '''
+        pending = []
+        for future in self._async_evals:
+            if wait or future.done():
+                future.result().replay(self.metrics_sink)
+            else:
+                pending.append(future)
+        self._async_evals = pending
+
+    def finish_async_evals(self):
+        '''
+            Wait for background evaluations, log their results & stop the worker.
+        '''
+        self._log_async_latent_evals(wait=True)
+        if self._async_eval_executor is not None:
+            self._async_eval_executor.shutdown()
+            self._async_eval_executor = None
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -468,7 +625,8 @@ class VAE_Trainer(trainer_script.Trainer):
                 with trainer_script.autocast():
                     outputs = model(**inputs)
             else:
-                outputs = model(**inputs)
+                with self._autocast():
+                    outputs = model(**inputs)
 
             if has_labels:
                 if isinstance(outputs, dict):
@@ -504,3 +662,26 @@ class VAE_Trainer(trainer_script.Trainer):
             labels = labels
 
         return (loss, logits, labels)
+
+
+def _evaluate_latent_samples_in_worker(
+    config, state_dict, args, global_step, eval_dataset, tokenizer, data_collator, custom_methods
+) -> RecordingSink:
+    from transformer_vae.model import Funnel_T5_VAE_Model
+
+    start = time.time()
+    # leave the other CPU cores to the training process
+    torch.set_num_threads(1)
+    model = Funnel_T5_VAE_Model(config)
+    model.load_state_dict(state_dict)
+    sink = RecordingSink()
+    trainer = VAE_Trainer(
+        model, args, custom_methods, metrics_sink=sink, eval_dataset=eval_dataset, tokenizer=tokenizer, data_collator=data_collator
+    )
+    trainer.state.global_step = global_step
+    with torch.no_grad():
+        model.eval()
+        trainer._evaluate_latent_samples()
+    # time taken off the training process by evaluating here
+    sink.log({"eval_async_latent_samples_time": time.time() - start}, global_step)
+    return sink
@@ -34,3 +34,21 @@ class WandbCallbackUseModelLogs(WandbCallback):
         if logs:
             logs = {**logs, **model.get_latest_logs()}
         super().on_log(args, state, control, model=model, logs=logs, **kwargs)
+
+
+class MetricsSinkCallback(TrainerCallback):
+    """
+    Logs the trainer's & model's internal logs to a `transformer_vae.sinks.MetricsSink`.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+
+    def on_log(self, args, state, control, model=None, logs=None, **kwargs):
+        if logs:
+            # every process gets the model logs as they are averaged across processes
+            logs = {**logs, **model.get_latest_logs()}
+            if state.is_world_process_zero:
+                self.sink.log(logs, state.global_step)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.sink.flush()
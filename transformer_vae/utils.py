@@ -1,6 +1,10 @@
-from typing import List
+import time
+import contextlib
+from collections import namedtuple
+from typing import Any, Dict, List
 import torch
 import numpy as np
+from torch.nn import functional as F
 from torch.utils.data import Sampler
 
 
@@ -14,7 +18,140 @@ def assertIn(actual, expected, msg, first="Got", second="Expected one of"):
         raise ValueError(msg + f' {first}: "{actual}" {second}: {expected}')
 
 
-def slerp(ratio: float, t1: torch.FloatTensor, t2: torch.FloatTensor):
+def assert_async(condition: torch.Tensor, msg: str):
+    '''
+        Check `condition` on its device without waiting for the result (no host sync on CUDA & traceable by `torch.compile`).
+        Falls back to a normal assert on PyTorch versions without `torch._assert_async(tensor, msg)`.
+        Like `assert` it is skipped when running with `python -O`.
+    '''
+    if not __debug__:
+        return
+    try:
+        torch._assert_async(condition, msg)
+    except (AttributeError, TypeError):
+        assert condition.item(), msg
+
+
+def tensors_to_floats(values: Dict[str, Any]) -> Dict[str, float]:
+    '''
+        Convert a dict of tensors & numbers to floats, waits on each device once rather than once per tensor.
+    '''
+    result = {k: float(v) for k, v in values.items() if not isinstance(v, torch.Tensor)}
+    by_device: Dict[torch.device, List[str]] = {}
+    for k, v in values.items():
+        if isinstance(v, torch.Tensor):
+            by_device.setdefault(v.device, []).append(k)
+    for keys in by_device.values():
+        floats = torch.stack([values[k].detach().float().reshape(()) for k in keys]).tolist()
+        result.update(zip(keys, floats))
+    return {k: result[k] for k in values}
+
+
+class SectionTimer:
+    '''
+        Sums the time spent in `with timer:` sections.
+        On CUDA sections are timed with events so timing doesn't wait on the device until `seconds` is called.
+    '''
+    def __init__(self, device):
+        self.use_events = torch.device(device).type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self._seconds, self._events, self._start = 0.0, [], None
+
+    def __enter__(self):
+        if self.use_events:
+            self._start = torch.cuda.Event(enable_timing=True)
+            self._start.record()
+        else:
+            self._start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.use_events:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self._events.append((self._start, end))
+        else:
+            self._seconds += time.perf_counter() - self._start
+
+    def seconds(self, reset=True) -> float:
+        for _, end in self._events:
+            end.synchronize()
+        seconds = self._seconds + sum(start.elapsed_time(end) for start, end in self._events) / 1000
+        if reset:
+            self.reset()
+        return seconds
+
+
+def autocast_bf16(device_type, enabled=True):
+    '''
+        bfloat16 autocast on CPU or CUDA, does nothing when not `enabled`.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, "autocast"):
+        raise ValueError("bf16 autocast needs `torch.autocast`, please update PyTorch.")
+    return torch.autocast(device_type, dtype=torch.bfloat16)
+
+
+def autocast_state():
+    '''
+        Current autocast settings, cached outputs computed under different settings have different dtypes.
+    '''
+    state = (torch.is_autocast_enabled(),)
+    if hasattr(torch, "get_autocast_gpu_dtype"):
+        state += (torch.get_autocast_gpu_dtype(), torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())
+    return state
+
+
+def autocast_disabled(device_type):
+    '''
+        Turn off autocast so numerically sensitive code runs in fp32, cast its inputs with `.float()`.
+    '''
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type, enabled=False)
+    if device_type == "cuda":
+        return torch.cuda.amp.autocast(enabled=False)
+    return contextlib.nullcontext()
+
+
+SlerpEndpoints = namedtuple("SlerpEndpoints", ["start", "end", "omega", "sin_omega", "dtype"])
+
+# keeps `acos` away from +-1 where its gradient is infinite
+SLERP_MAX_DOT = 1 - 1e-7
+# below this `sin(omega)` the endpoints are (anti)parallel & slerp is replaced by a linear interpolation
+SLERP_MIN_SIN_OMEGA = 1e-3
+
+
+def slerp_endpoints(t1: torch.FloatTensor, t2: torch.FloatTensor) -> SlerpEndpoints:
+    '''
+        Precompute the angles between pairs of vectors (the last dim of `t1` & `t2`) to slerp them at many ratios.
+    '''
+    dtype = t1.dtype
+    with autocast_disabled(t1.device.type):
+        t1, t2 = t1.float(), t2.float()
+        dot = (F.normalize(t1, dim=-1) * F.normalize(t2, dim=-1)).sum(-1)
+        omega = torch.acos(dot.clamp(-SLERP_MAX_DOT, SLERP_MAX_DOT))
+        return SlerpEndpoints(t1, t2, omega, torch.sin(omega), dtype)
+
+
+def slerp_from_endpoints(ratio, endpoints: SlerpEndpoints):
+    '''
+        Slerp precomputed endpoints, `ratio` is broadcast against the endpoints' batch dims.
+        E.g. ratios of shape (R, 1) with (K, D) endpoints give (R, K, D) interpolations.
+    '''
+    start, end, omega, sin_omega, dtype = endpoints
+    with autocast_disabled(start.device.type):
+        ratio = torch.as_tensor(ratio, dtype=torch.float, device=start.device)
+        use_lerp = sin_omega < SLERP_MIN_SIN_OMEGA
+        safe_sin_omega = torch.where(use_lerp, torch.ones_like(sin_omega), sin_omega)
+        start_weight = torch.where(use_lerp, 1.0 - ratio, torch.sin((1.0 - ratio) * omega) / safe_sin_omega)
+        end_weight = torch.where(use_lerp, ratio, torch.sin(ratio * omega) / safe_sin_omega)
+        res = start_weight.unsqueeze(-1) * start + end_weight.unsqueeze(-1) * end
+    return res.to(dtype)
+
+
+def slerp(ratio, t1: torch.FloatTensor, t2: torch.FloatTensor):
     '''
         Perform a spherical interpolation between 2 vectors.
         Most of the volume of a high-dimensional orange is in the skin, not the pulp.
@@ -22,16 +159,24 @@ def slerp(ratio: float, t1: torch.FloatTensor, t2: torch.FloatTensor):
         To that end we can interpolate between samples by following the surface of a n-dimensional sphere rather than a straight line.
 
         Args:
-            ratio: Interpolation ratio.
-            t1: Tensor1
+            ratio: Interpolation ratio, a float or a tensor broadcast against the batch dims of `t1` & `t2`.
+            t1: Tensor1, vectors in the last dim.
             t2: Tensor2
+
+        Computed in fp32 (`acos` is badly conditioned near 1) & returned in the dtype of `t1`.
+        Falls back to a linear interpolation for (anti)parallel vectors.
+        Use `slerp_endpoints` & `slerp_from_endpoints` to interpolate the same vectors at many ratios.
     '''
-    low_norm = t1 / torch.norm(t1, dim=1, keepdim=True)
-    high_norm = t2 / torch.norm(t2, dim=1, keepdim=True)
-    omega = torch.acos((low_norm * high_norm).sum(1))
-    so = torch.sin(omega)
-    res = (torch.sin((1.0 - ratio) * omega) / so).unsqueeze(1) * t1 + (torch.sin(ratio * omega) / so).unsqueeze(1) * t2
-    return res
+    return slerp_from_endpoints(ratio, slerp_endpoints(t1, t2))
+
+
+def tensor_version(tensor):
+    '''
+        Counter that increases with in-place edits, `None` for inference mode tensors which don't track it.
+    '''
+    if getattr(tensor, "is_inference", None) and tensor.is_inference():
+        return None
+    return tensor._version
 
 
 class AttrDict(dict):
@@ -52,22 +197,33 @@ class SortishSampler(Sampler):
     """
     Go through the text data by order of src length with a bit of randomness. From fastai repo.
     Modified to use shortest sequences first.
+
+    Give the batch size as `bs` to keep sequences of similar length in the same batch.
     """
 
-    def __init__(self, data, shuffle=True):
-        self.data, self.shuffle = data, shuffle
+    def __init__(self, data, shuffle=True, bs=1):
+        self.data, self.shuffle, self.bs = data, shuffle, bs
 
     def __len__(self) -> int:
         return len(self.data)
 
     def __iter__(self):
-        return iter(sortish_sampler_indices(self.data, 1, shuffle=self.shuffle)[::-1].tolist())
+        batches = sortish_sampler_batches(self.data, self.bs, shuffle=self.shuffle)[::-1]
+        # keep a smaller batch last so the dataloader's batches line up with these
+        batches.sort(key=lambda batch: len(batch) < self.bs)
+        return iter(np.concatenate(batches).tolist())
 
 
 def sortish_sampler_indices(data: List, bs: int, shuffle=True) -> np.array:
     "Go through the text data by order of src length with a bit of randomness. From fastai repo."
+    return np.concatenate(sortish_sampler_batches(data, bs, shuffle))
+
+
+def sortish_sampler_batches(data: List, bs: int, shuffle=True) -> List[np.array]:
+    "Same as `sortish_sampler_indices` but keeps indices split into batches of size `bs`."
     if not shuffle:
-        return np.argsort(np.array(data) * -1)
+        sort_idx = np.argsort(np.array(data) * -1)
+        return [sort_idx[i : i + bs] for i in range(0, len(sort_idx), bs)]
 
     def key_fn(i):
         return data[i]
@@ -80,6 +236,5 @@ def sortish_sampler_indices(data: List, bs: int, shuffle=True) -> np.array:
     ck_idx = [sort_idx[i : i + sz] for i in range(0, len(sort_idx), sz)]
     max_ck = np.argmax([key_fn(ck[0]) for ck in ck_idx])  # find the chunk with the largest key,
     ck_idx[0], ck_idx[max_ck] = ck_idx[max_ck], ck_idx[0]  # then make sure it goes first.
-    sort_idx = np.concatenate(np.random.permutation(ck_idx[1:])) if len(ck_idx) > 1 else np.array([], dtype=np.int)
-    sort_idx = np.concatenate((ck_idx[0], sort_idx))
-    return sort_idx
+    # permute chunk positions since the last chunk may be shorter
+    return [ck_idx[0]] + [ck_idx[i] for i in np.random.permutation(len(ck_idx) - 1) + 1]